@@ -2,14 +2,17 @@
 import argparse
 import json
 import os
+import queue
 import re
 import shutil
 import sys
 import subprocess
+import threading
+from collections import OrderedDict
 from pathlib import Path
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox, simpledialog
-from typing import Dict, List, Any
+from typing import Callable, Dict, List, Any, Optional, Tuple
 
 APP_TITLE = "AquariusOS Registry Editor"
 VALUE_EXT = ".rv"
@@ -27,6 +30,11 @@ HIVE_SHORT_MAP: Dict[str, str] = {
     "HKCU": "HKEY_CURRENT_USER",
     "HKVM": "HKEY_VOLATILE_MEMORY",
 }
+
+# Hives libreg can compact into an image next to their root (see libreg.compact).
+# Reads prefer the image, so every change made here removes it, as libreg's writes do.
+IMAGED_HIVES = ["HKEY_LOCAL_MACHINE"]
+IMAGE_EXT = ".image"
 # --- End Hive Configuration ---
 
 TYPE_LABELS = {
@@ -41,9 +49,23 @@ TYPE_LABELS = {
 }
 LABEL_TO_TYPE = {v: k for k, v in TYPE_LABELS.items()}
 
+# Value files with these headers are in the newer libreg formats (see libreg.py);
+# the editor shows them in the original text formats and saves them that way
+LIST_HEADER = "#!list/2\n"
+BYTES_HEADER = b"#!bytes/1\n"
+LIST_UNESCAPE = {"r": "\r", "n": "\n"}
+
 ICON_SIZE = 12  # px
 PREVIEW_MAX = 40  # ~40 characters in preview column
 
+TREE_BATCH = 200        # subkeys inserted into the tree per UI tick
+UI_POLL_MS = 30         # how often the UI drains results from the background scanner
+UI_TICK_BUDGET = 4      # result batches applied per UI tick before yielding back to Tk
+SCAN_CACHE_MAX = 4096   # scanned keys remembered by the scanner
+VALUE_BATCH = 100       # value rows inserted into the value pane per UI tick
+PREVIEW_READ = 4096     # bytes of a value file read to render its preview
+PREVIEW_CACHE_MAX = 8192  # previews remembered by (path, mtime, size)
+
 def parse_value_filename(filename: str):
     """
     <value name>.<type>.rv  -> returns (name, type) or (None, None) if not valid.
@@ -167,6 +189,27 @@ def serialize_value(value_str: str, vtype: str):
         return s
     raise ValueError(f"Unsupported type: {vtype}")
 
+def decode_value_text(data: bytes, partial: bool = False) -> str:
+    """Decode a value file's bytes into editor text. partial=True accepts a cut-off prefix."""
+    if data.startswith(BYTES_HEADER):
+        return data[len(BYTES_HEADER):].hex()
+    text = data.decode("utf-8", errors="ignore" if partial else "strict")
+    if text.startswith(LIST_HEADER):
+        items = text[len(LIST_HEADER):].split("\n")
+        if items[-1] == "": items.pop()
+        items = [re.sub(r"\\(.)", lambda m: LIST_UNESCAPE.get(m.group(1), m.group(1)), i, flags=re.DOTALL) for i in items]
+        return ", ".join(i.replace(",", "\\,") for i in items)
+    return text
+
+def read_value_text(path: Path) -> str:
+    return decode_value_text(path.read_bytes())
+
+def read_value_preview(path: str, limit: int = PREVIEW_READ) -> str:
+    """Read just enough of a value file to render preview_for(); the rest is read by the edit dialog."""
+    with open(path, "rb") as f: data = f.read(limit + 1)
+    if len(data) <= limit: return decode_value_text(data)
+    return decode_value_text(data[:limit], partial=True)
+
 def deserialize_value(content: str, vtype: str) -> str:
     # if vtype == "list":
     #     # New format: find all quoted strings, join them with a comma for the editor
@@ -208,6 +251,120 @@ class Icons:
         img.put("goldenrod", to=(1, 5, w - 2, h - 2))
         img.put("khaki", to=(1, 1, int(w*0.55), 6)); return img
 
+def has_subkeys(path: str) -> bool:
+    try:
+        with os.scandir(path) as it:
+            return any(e.is_dir() for e in it)
+    except OSError:
+        return False
+
+class KeyScanner:
+    """
+    Lists subkeys on a background thread so wide keys do not block the Tk main loop.
+    DirEntry.is_dir() answers from d_type, so a scan is one scandir of the key plus one
+    of each subkey (stopping at its first directory) to decide whether it gets an expander.
+
+    Results are handed back as callbacks on ui_queue, in batches of TREE_BATCH subkeys,
+    and the editor runs them from Tk's event loop. Finished scans are cached per key and
+    reused while the key directory's mtime is unchanged.
+    """
+    def __init__(self, ui_queue: "queue.Queue[Callable[[], None]]"):
+        self.ui_queue = ui_queue
+        self._requests: "queue.Queue[Tuple[str, Callable]]" = queue.Queue()
+        self._cache: "OrderedDict[str, Tuple[int, List[Tuple[str, bool]]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._work, name="regedit-scanner", daemon=True)
+        self._thread.start()
+    def cached(self, path: str) -> Optional[List[Tuple[str, bool]]]:
+        with self._lock:
+            entry = self._cache.get(path)
+        if entry is None: return None
+        try: mtime = os.stat(path).st_mtime_ns
+        except OSError: mtime = None
+        if mtime != entry[0]: self.invalidate(path); return None
+        with self._lock:
+            if path in self._cache: self._cache.move_to_end(path)
+        return entry[1]
+    def invalidate(self, path: str):
+        with self._lock: self._cache.pop(path, None)
+    def request(self, path: str, deliver: Callable[[List[Tuple[str, bool]]], None]):
+        """Scan path; deliver(rows) is queued for the UI once per batch of (name, has_subkeys)."""
+        self._requests.put((path, deliver))
+    def _work(self):
+        while True:
+            path, deliver = self._requests.get()
+            try: mtime = os.stat(path).st_mtime_ns
+            except OSError: mtime = None
+            names = []
+            try:
+                with os.scandir(path) as it:
+                    names = sorted(e.name for e in it if e.is_dir())
+            except OSError: pass
+            rows: List[Tuple[str, bool]] = []
+            for start in range(0, len(names), TREE_BATCH):
+                batch = [(n, has_subkeys(os.path.join(path, n))) for n in names[start:start + TREE_BATCH]]
+                rows.extend(batch)
+                self.ui_queue.put(lambda b=batch: deliver(b))
+            if not names: self.ui_queue.put(lambda: deliver([]))
+            if mtime is not None:
+                with self._lock:
+                    self._cache[path] = (mtime, rows)
+                    self._cache.move_to_end(path)
+                    while len(self._cache) > SCAN_CACHE_MAX: self._cache.popitem(last=False)
+
+class ValueLoader:
+    """
+    Fills the value pane from a background thread. Only the first PREVIEW_READ bytes of
+    each value file are read, and previews are cached by (path, mtime, size), so revisiting
+    a key only costs a scandir and a stat per value.
+
+    The pane shows one key at a time, so only the latest request is kept: a new request
+    replaces a queued one and stops a running one at its next batch.
+    """
+    def __init__(self, ui_queue: "queue.Queue[Callable[[], None]]"):
+        self.ui_queue = ui_queue
+        self._cond = threading.Condition()
+        self._pending: Optional[Tuple[str, Callable]] = None
+        self._serial = 0
+        self._previews: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+        self._thread = threading.Thread(target=self._work, name="regedit-values", daemon=True)
+        self._thread.start()
+    def request(self, path: str, deliver: Callable[[List[Tuple[str, str, str]]], None]):
+        """Load path's values; deliver(rows) is queued for the UI once per batch of (name, type, preview)."""
+        with self._cond:
+            self._serial += 1
+            self._pending = (path, deliver)
+            self._cond.notify()
+    def _preview(self, entry: os.DirEntry, vtype: str) -> str:
+        try: st = entry.stat()
+        except OSError: return preview_for(vtype, "")
+        key = (entry.path, st.st_mtime_ns, st.st_size)
+        cached = self._previews.get(key)
+        if cached is not None: self._previews.move_to_end(key); return cached
+        try: raw_text = read_value_preview(entry.path)
+        except Exception: raw_text = ""
+        preview = preview_for(vtype, raw_text)
+        self._previews[key] = preview
+        while len(self._previews) > PREVIEW_CACHE_MAX: self._previews.popitem(last=False)
+        return preview
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._pending is None: self._cond.wait()
+                (path, deliver), serial = self._pending, self._serial
+                self._pending = None
+            try:
+                with os.scandir(path) as it:
+                    entries = sorted((e for e in it if e.name.endswith(VALUE_EXT) and e.is_file()), key=lambda e: e.name)
+            except OSError: entries = []
+            for start in range(0, len(entries), VALUE_BATCH):
+                if serial != self._serial: break
+                batch = []
+                for e in entries[start:start + VALUE_BATCH]:
+                    name, vtype = parse_value_filename(e.name)
+                    if name: batch.append((name, vtype, self._preview(e, vtype)))
+                self.ui_queue.put(lambda b=batch: deliver(b))
+
 class ValueEditorDialog(tk.Toplevel):
     def __init__(self, parent, title, initial_name="", initial_type="str", initial_value=""):
         super().__init__(parent)
@@ -259,19 +416,41 @@ class RegistryEditor(tk.Tk):
         self.privileged_hives = {
             h_name for h_name in [HIVE_SHORT_MAP.get("HKLM"), HIVE_SHORT_MAP.get("HKVM")] if h_name
         }
+        self.ui_queue: "queue.Queue[Callable[[], None]]" = queue.Queue()
+        self.scanner = KeyScanner(self.ui_queue)
+        self.value_loader = ValueLoader(self.ui_queue)
+        self._tree_gen: Dict[str, int] = {}
+        self._values_gen = 0
         self._build_ui(); self._wire_events(); self.refresh_tree()
         self.protocol("WM_DELETE_WINDOW", self._on_closing)
+        self.after(UI_POLL_MS, self._drain_ui_queue)
 
     def _on_closing(self):
         """Ensure the helper process is terminated before exiting."""
         self.executor.close()
         self.destroy()
 
+    def _drain_ui_queue(self):
+        """Apply a few pending background results, then yield so Tk can redraw and handle input."""
+        for _ in range(UI_TICK_BUDGET):
+            try: callback = self.ui_queue.get_nowait()
+            except queue.Empty: break
+            try: callback()
+            except tk.TclError: pass
+        self.after(1 if not self.ui_queue.empty() else UI_POLL_MS, self._drain_ui_queue)
+
     def _get_executor(self, path: Path):
-        """Get the correct executor based on the path."""
-        if self.is_root or not self._is_privileged_path(path):
-            return self.direct_executor
-        return self.executor
+        """Get the correct executor based on the path. Only used to change the registry."""
+        executor = self.direct_executor if self.is_root or not self._is_privileged_path(path) else self.executor
+        self._discard_hive_image(path, executor)
+        return executor
+
+    def _discard_hive_image(self, path: Path, executor):
+        abs_path = path.resolve()
+        for hive_name in IMAGED_HIVES:
+            hive_path = self.hives.get(hive_name)
+            if hive_path and abs_path.is_relative_to(hive_path.resolve()):
+                executor.unlink(Path(f"{os.path.normpath(hive_path)}{IMAGE_EXT}"))
 
     def _build_ui(self):
         menubar = tk.Menu(self)
@@ -335,44 +514,52 @@ class RegistryEditor(tk.Tk):
     def refresh_tree(self):
         self.tree.delete(*self.tree.get_children())
         self.values.delete(*self.values.get_children())
+        self._tree_gen.clear()
         for display_name, path in sorted(self.hives.items()):
             hive_node = self.tree.insert("", "end", text=display_name, image=self.icons.folder, values=(str(path),))
-            if path.is_dir():
-                try:
-                    for child in sorted(path.iterdir()):
-                        if child.is_dir():
-                            node = self.tree.insert(hive_node, "end", text=child.name, image=self.icons.folder, values=(str(child),))
-                            if any(p.is_dir() for p in child.iterdir()): self._set_placeholder(node)
-                except PermissionError: pass
+            if path.is_dir(): self._rebuild_children(hive_node)
             self.tree.item(hive_node, open=True)
     def _set_placeholder(self, item_id):
         for cid in self.tree.get_children(item_id): self.tree.delete(cid)
         self.tree.insert(item_id, "end", text="...", values=("",))
-    def _rebuild_children(self, item_id):
-        path = self._tree_node_path(item_id)
-        self.tree.delete(*self.tree.get_children(item_id))
-        try:
-            for p in sorted(p for p in path.iterdir() if p.is_dir()):
-                node = self.tree.insert(item_id, "end", text=p.name, image=self.icons.folder, values=(str(p),))
-                if any(c.is_dir() for c in p.iterdir()): self.tree.insert(node, "end", text="...", values=("",))
-        except PermissionError: pass
+    def _rebuild_children(self, item_id, rescan: bool = False):
+        """
+        Replace item_id's children with its subkeys. The current children stay until the
+        first batch arrives; subkeys come from the scanner cache or a background scan.
+        """
+        path = str(self._tree_node_path(item_id))
+        gen = self._tree_gen.get(item_id, 0) + 1
+        self._tree_gen[item_id] = gen
+        if rescan: self.scanner.invalidate(path)
+        first = [True]
+        deliver = lambda rows: self._insert_subkeys(item_id, gen, path, rows, first)
+        rows = self.scanner.cached(path)
+        if rows is None: self.scanner.request(path, deliver); return
+        for start in range(0, max(len(rows), 1), TREE_BATCH):
+            self.ui_queue.put(lambda b=rows[start:start + TREE_BATCH]: deliver(b))
+    def _insert_subkeys(self, item_id, gen: int, path: str, rows: List[Tuple[str, bool]], first: List[bool]):
+        # Drop batches for nodes that were removed or rebuilt since the scan was requested
+        if self._tree_gen.get(item_id) != gen or not self.tree.exists(item_id): return
+        if first[0]:
+            self.tree.delete(*self.tree.get_children(item_id)); first[0] = False
+        for name, expandable in rows:
+            node = self.tree.insert(item_id, "end", text=name, image=self.icons.folder, values=(os.path.join(path, name),))
+            if expandable: self.tree.insert(node, "end", text="...", values=("",))
     def on_tree_open(self, event):
         item = self.tree.focus(); self._rebuild_children(item)
     def on_tree_select(self, event):
         item = self.tree.focus(); self.populate_values(self._tree_node_path(item))
     def populate_values(self, key_path: Path):
         self.values.delete(*self.values.get_children())
+        self._values_gen += 1
         if not key_path.is_dir(): return
         self._ensure_values_tree_has_icon_column()
-        try:
-            files = [p for p in key_path.iterdir() if p.is_file() and p.name.endswith(VALUE_EXT)]
-        except PermissionError: files = []
-        for f in sorted(files, key=lambda x: x.name):
-            name, vtype = parse_value_filename(f.name)
-            if not name: continue
-            try: raw_text = f.read_text(encoding="utf-8")
-            except Exception: raw_text = ""
-            iid = self.values.insert("", "end", values=(name, TYPE_LABELS.get(vtype, vtype), preview_for(vtype, raw_text)))
+        gen = self._values_gen
+        self.value_loader.request(str(key_path), lambda rows: self._insert_values(gen, rows))
+    def _insert_values(self, gen: int, rows: List[Tuple[str, str, str]]):
+        if gen != self._values_gen: return
+        for name, vtype, preview in rows:
+            iid = self.values.insert("", "end", values=(name, TYPE_LABELS.get(vtype, vtype), preview))
             self.values.item(iid, image=self.icons.type_icons.get(vtype, ""))
     def _ensure_values_tree_has_icon_column(self):
         if self.values.cget("show") == "tree headings": return
@@ -405,7 +592,7 @@ class RegistryEditor(tk.Tk):
         except FileExistsError: messagebox.showerror("Error", "A key with that name already exists."); return
         except Exception as e: messagebox.showerror("Error", f"Failed to create key:\n{e}"); return
         parent_item = self.tree.focus()
-        if parent_item: self._rebuild_children(parent_item); self.tree.item(parent_item, open=True)
+        if parent_item: self._rebuild_children(parent_item, rescan=True); self.tree.item(parent_item, open=True)
     def action_new_value(self):
         key_path = self._get_selected_key_path()
         if not key_path: messagebox.showwarning("No Key Selected", "Select a key to create a value in."); return
@@ -425,7 +612,7 @@ class RegistryEditor(tk.Tk):
         name, vtype = self._get_selected_value_parts()
         if not name or not vtype: return
         fpath = key_path / f"{name}.{vtype}{VALUE_EXT}"
-        try: content = fpath.read_text(encoding="utf-8")
+        try: content = read_value_text(fpath)
         except Exception: content = ""
         dlg = ValueEditorDialog(self, "Edit Value", initial_name=name, initial_type=vtype, initial_value=deserialize_value(content, vtype))
         if not dlg.result: return
@@ -455,7 +642,7 @@ class RegistryEditor(tk.Tk):
             if not executor.rename(key_path, target): return
         except Exception as e: messagebox.showerror("Error", f"Failed to rename key:\n{e}"); return
         parent_item = self.tree.parent(self.tree.focus())
-        if parent_item: self._rebuild_children(parent_item); self.tree.item(parent_item, open=True)
+        if parent_item: self._rebuild_children(parent_item, rescan=True); self.tree.item(parent_item, open=True)
         else: self.refresh_tree()
     def _rename_value(self):
         key_path = self._get_selected_key_path(); name, vtype = self._get_selected_value_parts()
@@ -480,7 +667,7 @@ class RegistryEditor(tk.Tk):
         try:
             if not executor.rmtree(key_path): return
         except Exception as e: messagebox.showerror("Error", f"Failed to delete key:\n{e}"); return
-        parent_item = self.tree.parent(self.tree.focus()); self._rebuild_children(parent_item)
+        parent_item = self.tree.parent(self.tree.focus()); self._rebuild_children(parent_item, rescan=True)
     def _delete_value(self):
         key_path = self._get_selected_key_path(); name, vtype = self._get_selected_value_parts()
         if not all([key_path, name, vtype]): messagebox.showwarning("No Value Selected", "Select a value to delete."); return
@@ -540,7 +727,7 @@ class RegistryEditor(tk.Tk):
         except Exception as e: messagebox.showerror("Error", f"Failed to {verb.lower()}:\n{e}")
         self.populate_values(key_path)
         current_item = self.tree.focus()
-        if current_item: self._rebuild_children(current_item)
+        if current_item: self._rebuild_children(current_item, rescan=True)
     def action_import(self): self._import_or_merge(clear_first=True)
     def action_merge(self): self._import_or_merge(clear_first=False)
 
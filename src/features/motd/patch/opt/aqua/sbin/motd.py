@@ -27,20 +27,24 @@ def main():
 
     # Load messages from registry
     for hive in hives:
+        # One pass over the whole MoTD subtree of the hive
+        try:
+            tree: dict = reg.read_tree(f"{hive}/{base_path}", {}, depth=3)
+        except Exception:
+            continue
         for keep_type in keep_types:
             for alert_type in alert_types:
                 for message_type in message_types:
                     key_path = f"{hive}/{base_path}/{keep_type}/{alert_type}/{message_type}"
                     print(f"Reading messages from: {key_path}")
                     try:
-                        messages: dict[str, str] = reg.read(key_path, None)
+                        messages = tree.get(keep_type, {}).get(alert_type, {}).get(message_type)
                         print(f"Messages found: {messages}")
-                        if messages is None:
+                        if not isinstance(messages, dict):
                             continue
-                        for name, val_type in messages.items():
-                            if val_type != "str":
+                        for name, message in messages.items():
+                            if not isinstance(message, str):
                                 continue
-                            message: str = reg.read(f"{key_path}/{name}", "")
                             entry = {
                                 "Location": f"{key_path}/{name}",
                                 "KeepType": keep_type,
@@ -42,6 +42,9 @@ public class RegistryEdit {
             "dword", "qword", "bool", "str", "list", "hex", "float", "double"
     );
 
+    // Hives libreg can compact into an image next to their root
+    private static final Set<String> IMAGED_HIVES = Set.of("HKEY_LOCAL_MACHINE", "HKEY_LOCAL_MACHINE_NOINST");
+
     // ----------------------------
     // Internal Helpers
     // ----------------------------
@@ -133,15 +136,30 @@ public class RegistryEdit {
         return null;
     }
 
+    // Value file formats with a header line (see libreg.py); files without one are the
+    // original text formats, which are still read.
+    private static final String LIST_HEADER = "#!list/2\n";
+    private static final byte[] BYTES_HEADER = "#!bytes/1\n".getBytes(StandardCharsets.UTF_8);
+    private static final Pattern LEGACY_LIST_SEPARATOR = Pattern.compile("(?<!\\\\),");
+
     private static Object readValueFile(String pathStr) {
         Path path = Paths.get(pathStr);
-        String data;
+        byte[] raw;
         try {
-            data = Files.readString(path, StandardCharsets.UTF_8).trim();
+            raw = Files.readAllBytes(path);
         } catch (IOException e) {
             return null;
         }
 
+        if (pathStr.endsWith(".hex.rv") && startsWith(raw, BYTES_HEADER)) {
+            return Arrays.copyOfRange(raw, BYTES_HEADER.length, raw.length);
+        }
+        String data = new String(raw, StandardCharsets.UTF_8);
+        if (pathStr.endsWith(".list.rv")) {
+            return data.startsWith(LIST_HEADER) ? decodeList(data) : decodeLegacyList(data);
+        }
+        data = data.trim();
+
         if (pathStr.endsWith(".dword.rv") || pathStr.endsWith(".qword.rv")) {
             try { return Long.parseLong(data); } catch (NumberFormatException e) { return 0; }
         }
@@ -151,16 +169,6 @@ public class RegistryEdit {
         if (pathStr.endsWith(".hex.rv")) {
             try { return Integer.parseInt(data, 16); } catch (NumberFormatException e) { return 0; }
         }
-        if (pathStr.endsWith(".list.rv")) {
-            String sentinel = UUID.randomUUID().toString().replace("-", "");
-            String temp = data.replace("\\,", sentinel);
-            String[] items = temp.split(",");
-            List<String> list = new ArrayList<>();
-            for (String item : items) {
-                list.add(item.strip().replace(sentinel, ","));
-            }
-            return list;
-        }
         if (pathStr.endsWith(".bool.rv")) {
             String lower = data.toLowerCase();
             return List.of("1", "true", "yes", "on").contains(lower);
@@ -171,6 +179,65 @@ public class RegistryEdit {
         return data;
     }
 
+    private static boolean startsWith(byte[] data, byte[] prefix) {
+        if (data.length < prefix.length) return false;
+        for (int i = 0; i < prefix.length; i++) {
+            if (data[i] != prefix[i]) return false;
+        }
+        return true;
+    }
+
+    private static List<String> decodeList(String data) {
+        List<String> list = new ArrayList<>();
+        String body = data.substring(LIST_HEADER.length());
+        int start = 0;
+        while (start < body.length()) {
+            int end = body.indexOf('\n', start);
+            if (end < 0) end = body.length();
+            String item = body.substring(start, end);
+            if (item.indexOf('\\') >= 0) {
+                StringBuilder sb = new StringBuilder(item.length());
+                for (int i = 0; i < item.length(); i++) {
+                    char c = item.charAt(i);
+                    if (c == '\\' && i + 1 < item.length()) {
+                        char next = item.charAt(++i);
+                        sb.append(next == 'n' ? '\n' : next == 'r' ? '\r' : next);
+                    } else {
+                        sb.append(c);
+                    }
+                }
+                item = sb.toString();
+            }
+            list.add(item);
+            start = end + 1;
+        }
+        return list;
+    }
+
+    private static List<String> decodeLegacyList(String data) {
+        List<String> list = new ArrayList<>();
+        for (String item : LEGACY_LIST_SEPARATOR.split(data.trim(), -1)) {
+            list.add(item.strip().replace("\\,", ","));
+        }
+        return list;
+    }
+
+    private static String encodeList(List<?> items) {
+        StringBuilder sb = new StringBuilder(LIST_HEADER);
+        for (Object o : items) {
+            String item = String.valueOf(o);
+            for (int i = 0; i < item.length(); i++) {
+                char c = item.charAt(i);
+                if (c == '\\') sb.append("\\\\");
+                else if (c == '\n') sb.append("\\n");
+                else if (c == '\r') sb.append("\\r");
+                else sb.append(c);
+            }
+            sb.append('\n');
+        }
+        return sb.toString();
+    }
+
     private static void ensureDir(String pathStr) throws IOException {
         Files.createDirectories(Paths.get(pathStr));
     }
@@ -286,6 +353,19 @@ public class RegistryEdit {
         return defaultValue;
     }
 
+    /**
+     * Remove the image libreg compacted a hive into (see libreg.compact), if it has one.
+     * Reads prefer the image, so every write and delete has to remove it.
+     */
+    private static void discardHiveImage(String hive, String root) {
+        if (!IMAGED_HIVES.contains(hive)) return;
+        try {
+            Files.deleteIfExists(Paths.get(Paths.get(root).normalize() + ".image"));
+        } catch (IOException e) {
+            System.err.println("Warning: Could not remove the image of " + hive + ": " + e.getMessage());
+        }
+    }
+
     /**
      * Write a value.
      */
@@ -351,8 +431,22 @@ public class RegistryEdit {
         // Determine file path and data
         String filePath;
         String data;
-
-        if (typeDef != null) {
+        byte[] bytes = null;
+
+        if (value instanceof byte[] && (typeDef == null || typeDef.equalsIgnoreCase("hex"))) {
+            filePath = baseNoExt.toString() + ".hex.rv";
+            byte[] v = (byte[]) value;
+            bytes = Arrays.copyOf(BYTES_HEADER, BYTES_HEADER.length + v.length);
+            System.arraycopy(v, 0, bytes, BYTES_HEADER.length, v.length);
+            data = null;
+        } else if (value instanceof List && (typeDef == null || typeDef.equalsIgnoreCase("list"))) {
+            filePath = baseNoExt.toString() + ".list.rv";
+            data = encodeList((List<?>) value);
+        } else if ("list".equalsIgnoreCase(typeDef)) {
+            // A string is the original comma-separated format
+            filePath = baseNoExt.toString() + ".list.rv";
+            data = encodeList(decodeLegacyList(String.valueOf(value)));
+        } else if (typeDef != null) {
             typeDef = typeDef.toLowerCase();
             filePath = baseNoExt.toString() + "." + typeDef + ".rv";
             data = String.valueOf(value);
@@ -375,10 +469,6 @@ public class RegistryEdit {
                 filePath = baseNoExt.toString() + ".double.rv";
             }
             data = String.valueOf(v);
-        } else if (value instanceof List) {
-            filePath = baseNoExt.toString() + ".list.rv";
-            List<?> l = (List<?>) value;
-            data = l.stream().map(o -> String.valueOf(o).replace(",", "\\,")).collect(Collectors.joining(", "));
         } else {
             // String fallback
             filePath = baseNoExt.toString() + ".str.rv";
@@ -386,7 +476,8 @@ public class RegistryEdit {
         }
 
         Path targetFile = Paths.get(filePath);
-        Files.writeString(targetFile, data, StandardCharsets.UTF_8);
+        Files.write(targetFile, bytes != null ? bytes : data.getBytes(StandardCharsets.UTF_8));
+        discardHiveImage(targetHive, root);
 
         // Apply ownership to the file
         if ("HKEY_CURRENT_USER".equals(targetHive) && owner != null) {
@@ -412,6 +503,7 @@ public class RegistryEdit {
         if (root == null) return false;
 
         Path target = Paths.get(root, split.relativePath);
+        discardHiveImage(targetHive, root);
 
         if (Files.isDirectory(target)) {
             // Recursive delete
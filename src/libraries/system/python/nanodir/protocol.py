@@ -16,11 +16,12 @@ def client_get_current_machine_id() -> str:
     return reg.read("HKEY_LOCAL_MACHINE/SYSTEM/ControlSet/Control/GroupEnrollment/CurrentMachine/ComputerName", "")
 
 def client_get_dc_address() -> dict[str, str]:
+    dc: dict = reg.read_tree("HKEY_LOCAL_MACHINE/SYSTEM/ControlSet/Control/GroupEnrollment/DomainController", {}, depth=0)
     return {
-        "ipv4": reg.read("HKEY_LOCAL_MACHINE/SYSTEM/ControlSet/Control/GroupEnrollment/DomainController/AddressIPv4", ""),
-        "url": reg.read("HKEY_LOCAL_MACHINE/SYSTEM/ControlSet/Control/GroupEnrollment/DomainController/AddressURL", ""),
-        "port": reg.read("HKEY_LOCAL_MACHINE/SYSTEM/ControlSet/Control/GroupEnrollment/DomainController/Port", ""),
-        "use_ssl": reg.read("HKEY_LOCAL_MACHINE/SYSTEM/ControlSet/Control/GroupEnrollment/DomainController/UseSSL", True),
+        "ipv4": dc.get("AddressIPv4", ""),
+        "url": dc.get("AddressURL", ""),
+        "port": dc.get("Port", ""),
+        "use_ssl": dc.get("UseSSL", True),
     }
 
 def client_get_pk() -> str:
@@ -1,10 +1,35 @@
+import atexit
+import concurrent.futures
+import contextlib
+import ctypes
+import fcntl
+import functools
+import json
+import mmap
 import os
+import re
 import subprocess
 import shlex
 import shutil
+import socket
+import stat
+import struct
+import sys
+import threading
+import time
 import uuid
 import urllib.parse
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+try:
+    from AppContext import AppContext
+except ImportError:
+    AppContext = None
 
 # ----------------------------
 # Hive configuration (extensible)
@@ -66,6 +91,24 @@ def _expand_hive_paths(hive_map: Optional[Dict[str, str]] = None) -> Dict[str, s
     return out
 
 
+def user_hive_map(user: str) -> Dict[str, str]:
+    """
+    Hive map whose HKCU is `user`'s registry rather than the calling process's.
+    """
+    custom_hive_map = _HIVE_MAP.copy()
+    custom_hive_map["HKEY_CURRENT_USER"] = os.path.join(
+        os.path.expanduser(f"~{user}"), _DEFAULT_LOCAL_PATH
+    )
+    return custom_hive_map
+
+
+def get_hive_roots(hive_map: Optional[Dict[str, str]] = None) -> Dict[str, str]:
+    """
+    Canonical hive name -> absolute filesystem root.
+    """
+    return _expand_hive_paths(hive_map)
+
+
 def _split_hive_and_rel(registry_path: str) -> Tuple[Optional[str], str]:
     """
     If path starts with a hive name (long or short), return (canonical_hive, relpath_without_hive).
@@ -87,15 +130,45 @@ def _value_file_candidates(base_no_ext: str) -> List[str]:
 
 
 def _detect_value_file(base_no_ext: str) -> Optional[str]:
-    for f in _value_file_candidates(base_no_ext):
-        if os.path.isfile(f):
-            return f
-    return None
+    index = _key_dir_index(os.path.dirname(base_no_ext))
+    if index is None:
+        return None
+    hit = index.values.get(os.path.basename(base_no_ext))
+    return hit[1] if hit is not None else None
+
+
+# Value file formats with a header line. Files without one are the original text formats,
+# which are still read (and written for everything else):
+#   .list.rv  _LIST_HEADER, then one item per line; backslash, CR and LF escaped as
+#             \\, \r and \n. The original format is "a, b\,c" (comma-separated, items stripped).
+#   .hex.rv   _BYTES_HEADER, then the raw bytes; read back as bytes. Without the header
+#             the file is a hex number, read back as int.
+_LIST_HEADER = "#!list/2\n"
+_BYTES_HEADER = b"#!bytes/1\n"
+_LIST_ESCAPE = {"\\": "\\\\", "\r": "\\r", "\n": "\\n"}
+_LIST_UNESCAPE = {"r": "\r", "n": "\n"}
+_LIST_ESCAPED = re.compile(r"\\(.)", re.DOTALL)
+_LEGACY_LIST_SEPARATOR = re.compile(r"(?<!\\),")
 
 
 def _read_value_file(path: str) -> Any:
-    with open(path, "r", encoding="utf-8") as f:
-        data = f.read().strip()
+    with open(path, "rb") as f:
+        return _decode_value(path, f.read())
+
+
+def _decode_value(path: str, raw: bytes) -> Any:
+    """
+    Decode the contents of a value file; the type comes from the file name.
+    """
+    if path.endswith(".hex.rv") and raw.startswith(_BYTES_HEADER):
+        return raw[len(_BYTES_HEADER):]
+    data = raw.decode("utf-8")
+    if path.endswith(".list.rv"):
+        if data.startswith(_LIST_HEADER):
+            return _decode_list(data)
+        return _decode_legacy_list(data)
+
+    data = data.strip()
 
     if path.endswith(".dword.rv") or path.endswith(".qword.rv"):
         return int(data)
@@ -103,11 +176,6 @@ def _read_value_file(path: str) -> Any:
         return float(data)
     if path.endswith(".hex.rv"):
         return int(data, 16)
-    if path.endswith(".list.rv"):
-        sentinel = uuid.uuid4().hex
-        data = data.replace("\\,", sentinel)
-        items = [item.strip() for item in data.split(",")]
-        return [i.replace(sentinel, ",") for i in items]
     if path.endswith(".bool.rv"):
         return data.lower() in ("1", "true", "yes", "on")
     if path.endswith(".str.rv"):
@@ -115,6 +183,50 @@ def _read_value_file(path: str) -> Any:
     return data  # Fallback raw text
 
 
+def _read_hook_text(path: str) -> str:
+    """
+    Text ActionHooks get for {} for the value stored in `path`: what _encode_value gave
+    the writer's own hooks. Raises ValueError if the file cannot be decoded.
+    """
+    with open(path, "rb") as f:
+        raw = f.read()
+    if path.endswith(".hex.rv") and raw.startswith(_BYTES_HEADER):
+        return raw[len(_BYTES_HEADER):].hex()
+    if path.endswith(".list.rv"):
+        return _list_hook_text(_decode_value(path, raw))
+    return raw.decode("utf-8")
+
+
+def _list_hook_text(items: List[Any]) -> str:
+    return ", ".join(str(item).replace(",", "\\,") for item in items)
+
+
+def _unescape_list_item(match: "re.Match") -> str:
+    char = match.group(1)
+    return _LIST_UNESCAPE.get(char, char)
+
+
+def _encode_list(items: List[Any]) -> str:
+    lines = [_LIST_HEADER]
+    for item in items:
+        text = str(item)
+        if "\\" in text or "\r" in text or "\n" in text:
+            text = "".join(_LIST_ESCAPE.get(char, char) for char in text)
+        lines.append(text + "\n")
+    return "".join(lines)
+
+
+def _decode_list(data: str) -> List[str]:
+    items = data[len(_LIST_HEADER):].split("\n")
+    if items[-1] == "":
+        items.pop()  # Every item ends with a newline
+    return [_LIST_ESCAPED.sub(_unescape_list_item, item) if "\\" in item else item for item in items]
+
+
+def _decode_legacy_list(data: str) -> List[str]:
+    return [item.strip().replace("\\,", ",") for item in _LEGACY_LIST_SEPARATOR.split(data.strip())]
+
+
 def _ensure_dir(path: str) -> None:
     os.makedirs(path, exist_ok=True)
 
@@ -131,273 +243,2021 @@ def _priority_hives() -> List[str]:
     return result
 
 
+_TYPE_RANK: Dict[str, int] = {t: i for i, t in enumerate(_TYPES_AVAILABLE)}
+
+
+class _KeyDirIndex:
+    """
+    Everything a lookup needs from one key directory, gathered by a single os.scandir.
+
+    values:  encoded value name -> (type, file path); when several typed files share a
+             name, the type listed first in _TYPES_AVAILABLE wins.
+    subkeys: subkey directory names, in directory order.
+    listing: decoded value name -> type, subkey name -> "key" (what read() returns).
+    image:   the HiveImage the index came from, which then also holds the value data;
+             None for an index of the directory itself.
+    """
+    __slots__ = ("values", "subkeys", "listing", "image")
+
+    def __init__(
+        self,
+        values: Dict[str, Tuple[str, str]],
+        subkeys: List[str],
+        listing: Dict[str, str],
+        image: Optional["HiveImage"] = None,
+    ):
+        self.values = values
+        self.subkeys = subkeys
+        self.listing = listing
+        self.image = image
+
+
+def _scan_key_dir(base: str) -> Optional[_KeyDirIndex]:
+    """
+    Index `base`, or None if it is not a directory.
+    """
+    values: Dict[str, Tuple[str, str]] = {}
+    subkeys: List[str] = []
+    listing: Dict[str, str] = {}
+    try:
+        it = os.scandir(base)
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    with it:
+        for entry in it:
+            fname = entry.name
+            if fname.endswith(".rv") and entry.is_file():
+                try:
+                    name, type_ext, _rv = fname.rsplit(".", 2)
+                except ValueError:
+                    continue
+
+                rank = _TYPE_RANK.get(type_ext)
+                if rank is not None:
+                    current = values.get(name)
+                    if current is None or rank < _TYPE_RANK[current[0]]:
+                        values[name] = (type_ext, entry.path)
+
+                # URL Decode patch
+                listing[decode_key(name)] = type_ext
+            elif entry.is_dir():
+                subkeys.append(fname)
+                listing[decode_key(fname)] = "key"
+    return _KeyDirIndex(values, subkeys, listing)
+
+
+def _key_dir_index(base: str) -> Optional[_KeyDirIndex]:
+    """
+    Index of a key directory, reused from the read cache when it is enabled.
+    """
+    cache = _cache
+    if cache is None:
+        return _scan_key_dir(base)
+    return cache.lookup(base, "index", lambda: (None, _scan_key_dir(base)))
+
+
 # ----------------------------
-# Public API
+# Read cache (opt-in)
 # ----------------------------
-def read(
-    registry_path: str,
-    default: Any = None,
-    *,
-    hive_map: Optional[Dict[str, str]] = None,
-) -> Any:
+# Enable per process with enable_cache(), or for every process with AQUA_REGISTRY_CACHE=1.
+_CACHE_ENV = "AQUA_REGISTRY_CACHE"
+
+# Directory timestamps newer than this are not trusted in stat mode, since the
+# kernel's coarse clock can give two quick writes the same mtime.
+_CACHE_RACY_NS = 50_000_000
+_CACHE_MAX_DIRS = 4096
+_CACHE_MAX_WATCHES = 1024
+
+
+def _stat_stamp(path: str) -> Optional[Tuple[int, int, int]]:
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+class _CachedDir:
+    __slots__ = ("stamp", "watched", "results")
+
+    def __init__(self, stamp: Optional[Tuple[int, int, int]], watched: bool):
+        self.stamp = stamp
+        self.watched = watched
+        # lookup key -> (value file stamp or None, result)
+        self.results: Dict[Any, Tuple[Optional[Tuple[int, int, int]], Any]] = {}
+
+
+class RegistryCache:
     """
-    Read a key or value.
+    Process-wide cache of key listings and decoded values, keyed by filesystem path.
 
-    Semantics:
-      - If path explicitly starts with a hive (long or short), read ONLY from that hive.
-      - If no hive specified, search in the order given by _PRIORITY (earlier wins).
-      - Reading a directory returns a merged mapping from ALL searched hives, where
-        higher-priority hives override lower-priority names on collision.
+    Every entry belongs to the directory whose contents it was derived from. A directory
+    is invalidated as a whole when inotify reports a change in it, or, when pyinotify is
+    unavailable (or the directory cannot be watched), when its stat stamp changes.
     """
-    expanded_map = _expand_hive_paths(hive_map)
-    explicit_hive, rel = _split_hive_and_rel(registry_path)
 
-    if explicit_hive:
-        # Strictly from the specified hive
-        root = expanded_map.get(explicit_hive)
-        if not root:
-            return default
-
-        # URL Encode patch
-        # base = os.path.join(root, rel)
-        base = get_encoded_path(root, rel)
-
-        if os.path.isdir(base):
-            # Single-hive directory listing
-            listing: Dict[str, str] = {}
-            for fname in os.listdir(base):
-                fpath = os.path.join(base, fname)
-                if os.path.isfile(fpath) and fpath.endswith(".rv"):
-                    try:
-                        name, type_ext, _rv = fname.rsplit(".", 2)
+    def __init__(self, use_inotify: bool = True):
+        self._lock = threading.RLock()
+        self._dirs: Dict[str, _CachedDir] = {}
+        self._wds: Dict[str, int] = {}
+        self.hits = 0
+        self.misses = 0
 
-                        # URL Decode patch
-                        name = decode_key(name)
+        self._wm = None
+        self._notifier = None
+        if use_inotify and pyinotify is not None:
+            try:
+                self._wm = pyinotify.WatchManager()
+                self._notifier = pyinotify.Notifier(self._wm, default_proc_fun=self._on_event)
+            except Exception:
+                self._wm = None
+                self._notifier = None
+
+    # -- invalidation --
+    def _on_event(self, event) -> None:
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            self._dirs.clear()
+            return
+        path = getattr(event, "path", None)
+        if not path:
+            return
+        self._dirs.pop(path, None)
+        if event.mask & (pyinotify.IN_IGNORED | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF):
+            self._wds.pop(path, None)
 
-                        listing[name] = type_ext
-                    except ValueError:
-                        pass
-                elif os.path.isdir(fpath):
-                    listing[fname] = "key"
-            return listing
+    def _drain(self) -> None:
+        if self._notifier is None:
+            return
+        try:
+            while self._notifier.check_events(timeout=0):
+                self._notifier.read_events()
+                self._notifier.process_events()
+        except Exception:
+            # A broken inotify descriptor must never serve stale data
+            self._dirs.clear()
+            self._notifier = None
+            self._wm = None
+            self._wds.clear()
+
+    def _watch(self, dir_path: str) -> bool:
+        if dir_path in self._wds:
+            return True
+        if self._wm is None or len(self._wds) >= _CACHE_MAX_WATCHES or not os.path.isdir(dir_path):
+            return False
+        mask = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MODIFY
+                | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO
+                | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF)
+        try:
+            wd = self._wm.add_watch(dir_path, mask, rec=False, quiet=True).get(dir_path, -1)
+        except Exception:
+            return False
+        if wd < 0:
+            return False
+        self._wds[dir_path] = wd
+        return True
 
-        cand = _detect_value_file(base)
-        if cand is not None:
-            return _read_value_file(cand)
-        return default
+    def invalidate(self, dir_path: Optional[str] = None) -> None:
+        """
+        Drop cached entries of one directory, or everything when dir_path is None.
+        """
+        with self._lock:
+            if dir_path is None:
+                self._dirs.clear()
+            else:
+                self._dirs.pop(os.path.normpath(dir_path), None)
+
+    def invalidate_tree(self, dir_path: str) -> None:
+        """
+        Drop cached entries of a directory and everything below it.
+        """
+        dir_path = os.path.normpath(dir_path)
+        prefix = dir_path + os.sep
+        with self._lock:
+            for cached in [d for d in self._dirs if d == dir_path or d.startswith(prefix)]:
+                del self._dirs[cached]
+
+    # -- lookup --
+    def _valid(self, dir_path: str, entry: _CachedDir) -> bool:
+        if entry.watched:
+            return True
+        return _stat_stamp(dir_path) == entry.stamp
+
+    def lookup(self, dir_path: str, key: Any, compute: Callable[[], Tuple[Optional[str], Any]]) -> Any:
+        """
+        Return the cached result for `key` in `dir_path`, or run `compute()` and cache it.
+        `compute` returns (value file path or None, result); the file path is stat-checked
+        on later hits when the directory is not watched.
+        """
+        dir_path = os.path.normpath(dir_path)
+        with self._lock:
+            self._drain()
+            entry = self._dirs.get(dir_path)
+            if entry is not None and not self._valid(dir_path, entry):
+                del self._dirs[dir_path]
+                entry = None
+            if entry is not None and key in entry.results:
+                file_stamp, result = entry.results[key]
+                if entry.watched or file_stamp is None or _stat_stamp(file_stamp[0]) == file_stamp[1]:
+                    self.hits += 1
+                    _profile_cache_lookup(True)
+                    return _copy_result(result)
+
+            self.misses += 1
+            _profile_cache_lookup(False)
+            if entry is None:
+                if len(self._dirs) >= _CACHE_MAX_DIRS:
+                    self._dirs.clear()
+                # Watch before computing so that a concurrent change always shows up as an event
+                watched = self._watch(dir_path)
+                entry = _CachedDir(_stat_stamp(dir_path), watched)
+                # Registered up front: compute() may itself look up this directory (e.g. its index)
+                self._dirs[dir_path] = entry
+
+            file_path, result = compute()
+
+            cacheable = entry.watched
+            file_stamp = None
+            if not cacheable:
+                cacheable = entry.stamp is None or time.time_ns() - entry.stamp[0] > _CACHE_RACY_NS
+                if cacheable and file_path is not None:
+                    stamp = _stat_stamp(file_path)
+                    cacheable = stamp is not None and time.time_ns() - stamp[0] > _CACHE_RACY_NS
+                    file_stamp = (file_path, stamp)
+            if cacheable:
+                entry.results[key] = (file_stamp, result)
+            return _copy_result(result)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / total) if total else 0.0,
+                "directories": len(self._dirs),
+                "watches": len(self._wds),
+                "mode": "inotify" if self._wm is not None else "stat",
+            }
+
+
+def _profile_cache_lookup(hit: bool) -> None:
+    profiler = _profiler
+    if profiler is not None:
+        profiler.note_cache(hit)
+
+
+def _copy_result(result: Any) -> Any:
+    if isinstance(result, dict):
+        return dict(result)
+    if isinstance(result, list):
+        return list(result)
+    return result
 
-    # No hive specified: search by priority
-    merged_listing: Dict[str, str] = {}
-    candidates: List[str] = []
-    for hive in _priority_hives():
-        root = expanded_map.get(hive)
-        if not root:
-            continue
-        base = os.path.join(root, rel)
-        candidates.append(base)
 
-    # Directory read: if ANY candidate dir exists, perform merged listing by priority order
-    any_dir = any(os.path.isdir(b) for b in candidates)
-    if any_dir:
-        for base in candidates:
-            if not os.path.isdir(base):
-                continue
-            for fname in os.listdir(base):
-                fpath = os.path.join(base, fname)
-                if os.path.isfile(fpath) and fpath.endswith(".rv"):
-                    try:
-                        name, type_ext, _rv = fname.rsplit(".", 2)
-
-                        # URL Decode patch
-                        name = decode_key(name)
-
-                        # Respect priority: first hit wins
-                        if name not in merged_listing:
-                            merged_listing[name] = type_ext
-                    except ValueError:
-                        pass
-                elif os.path.isdir(fpath):
-                    if fname not in merged_listing:
-                        merged_listing[fname] = "key"
-        return merged_listing
+_cache: Optional[RegistryCache] = None
+_cache_lock = threading.Lock()
 
-    # Value read: try each hive in priority order
-    for base in candidates:
-        cand = _detect_value_file(base)
-        if cand is not None:
-            return _read_value_file(cand)
-    return default
+
+def enable_cache(use_inotify: bool = True) -> RegistryCache:
+    """
+    Turn on the process-wide read cache (idempotent) and return it.
+    """
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = RegistryCache(use_inotify=use_inotify)
+        return _cache
 
 
+def disable_cache() -> None:
+    global _cache
+    with _cache_lock:
+        _cache = None
 
-def _exec_hook_secure(hook: str, new_value: str):
-    try:
-        parts = shlex.split(hook)
-        cmd_args = [part.replace("{}", new_value) for part in parts]
-        subprocess.run(cmd_args, check=True)
-    except Exception as e:
-        print(f"Warning: Failed to execute hook '{hook}': {e}")
-        pass  # Ignore hook execution errors
 
-def encode_key(key_part: str) -> str:
+def cache_stats() -> Dict[str, Any]:
     """
-    특수문자, 공백, 유니코드 등을 퍼센트 인코딩하여 파일시스템 호환성 및 보안 확보
-    예: "배경 화면" -> "%EB%B0%B0%EA%B2%BD%20%ED%99%94%EB%A9%B4"
+    Hit/miss counters of the read cache. Empty dict if the cache is disabled.
     """
-    # safe='' 로 설정하여 슬래시(/)를 제외한 모든 특수문자 인코딩
-    # 키 경로 자체에 슬래시가 포함된다면 split 후 각각 인코딩해야 함
-    return urllib.parse.quote(key_part, safe='')
+    cache = _cache
+    return cache.stats() if cache is not None else {}
 
-def decode_key(encoded_part: str) -> str:
-    return urllib.parse.unquote(encoded_part)
 
-def get_encoded_path(root: str, rel_path: str) -> str:
+def _invalidate_cached(path: str) -> None:
+    cache = _cache
+    if cache is not None:
+        cache.invalidate(path)
+
+
+def _invalidate_cached_tree(path: str) -> None:
+    cache = _cache
+    if cache is not None:
+        cache.invalidate_tree(path)
+
+
+_Indexer = Callable[[str], Optional[_KeyDirIndex]]
+
+
+def _lookup_listing(base: str, index_of: _Indexer = _key_dir_index) -> Optional[Dict[str, str]]:
     """
-    상대 경로(Software/MyConfig)를 받아 인코딩된 절대 경로를 반환
+    Listing of `base` if it is a key directory, None otherwise.
     """
-    parts = rel_path.split('/')
-    encoded_parts = [encode_key(p) for p in parts]
-    return os.path.join(root, *encoded_parts)
+    # A missing key is indexed (and cached) as None under its own absent path;
+    # stat mode notices when it appears.
+    index = index_of(base)
+    return dict(index.listing) if index is not None else None
 
-def write(
-    as_user: str,
-    registry_path: str,
-    value: Any,
-    *,
-    hive_map: Optional[Dict[str, str]] = None,
-    typedef: Optional[str] = None,
-) -> None:
-    """
-    Write a value.
 
-    Semantics:
-      - If path starts with a hive (long or short), write ONLY to that hive.
-      - Otherwise, write to HKCU by default.
-      - HKCU and HKLM are always modifiable; other hives depend on their mapped paths.
+def _read_indexed_value(dir_path: str, name: str, file_path: str) -> Any:
     """
-    expanded_map = _expand_hive_paths(hive_map)
-    explicit_hive, rel = _split_hive_and_rel(registry_path)
+    Decode a value file already located through a key directory index.
+    """
+    cache = _cache
+    if cache is None:
+        return _read_value_file(file_path)
+    _found, value = cache.lookup(dir_path, ("value", name), lambda: (file_path, (True, _read_value_file(file_path))))
+    return _copy_result(value)
 
-    if explicit_hive:
-        target_hive = explicit_hive
-    else:
-        # Default write hive is HKCU
-        target_hive = _canonical_hive_name("HKCU")
-        if target_hive is None:
-            raise RuntimeError("HKCU is not defined in the hive map.")
 
-    root = expanded_map.get(target_hive)
-    if not root:
-        raise RuntimeError(f"Hive '{target_hive}' has no valid root path.")
+def _read_index_hit(index: _KeyDirIndex, dir_path: str, name: str) -> Any:
+    """
+    Decode value `name` of an index, from its hive image or its file.
+    """
+    _type, file_path = index.values[name]
+    if index.image is not None:
+        return index.image.read_value(file_path)
+    return _read_indexed_value(dir_path, name, file_path)
 
 
-    # URL Encode patch
-    # base_no_ext = os.path.join(root, rel)
-    base_no_ext = get_encoded_path(root, rel)
+def _lookup_value(
+    base: str,
+    index_of: _Indexer = _key_dir_index,
+    opened: Optional[List[str]] = None,
+) -> Tuple[bool, Any]:
+    """
+    (found, decoded value) of the value at `base` (path without type extension).
+    The value file that was decoded is appended to `opened`, if given.
+    """
+    dir_path, name = os.path.split(base)
+    index = index_of(dir_path)
+    hit = index.values.get(name) if index is not None else None
+    if hit is None:
+        return False, None
+    if opened is not None:
+        opened.append(index.image.path if index.image is not None else hit[1])
+    return True, _read_index_hit(index, dir_path, name)
 
-    dir_path = os.path.dirname(base_no_ext)
-    _ensure_dir(dir_path)
 
-    # Get uid gid of specified user for HKCU ownership
-    uid = os.getuid()
-    gid = os.getgid()
-    if target_hive == "HKEY_CURRENT_USER":
-        import pwd
-        user_home = os.path.expanduser(f"~{as_user}")
-        pw_record = pwd.getpwnam(os.path.basename(user_home))
-        uid = pw_record.pw_uid
-        gid = pw_record.pw_gid
-        # print(f"Writing as user UID: {uid}, GID: {gid}")
+if os.environ.get(_CACHE_ENV, "").lower() in ("1", "true", "yes", "on"):
+    enable_cache()
 
-    # If current hive is HKCU, make sure to set proper ownership (current user)
-    if target_hive == "HKEY_CURRENT_USER":
-        dir_components = dir_path.replace(root, "").split(os.sep)
-        cumulative_path = root
-        for component in dir_components:
-            cumulative_path = os.path.join(cumulative_path, component)
-            try:
-                os.chown(cumulative_path, uid, gid)
-            except PermissionError:
-                pass  # Ignore if we don't have permission to change ownership
 
-    if typedef is not None:
-        typedef = typedef.lower()
-        file_path = base_no_ext + f".{typedef}.rv"
-        data = str(value)
-    elif isinstance(value, bool):
-        file_path = base_no_ext + ".bool.rv"
-        data = "1" if value else "0"
-    elif isinstance(value, int):
-        if -(2**31) <= value < 2**31:
-            file_path = base_no_ext + ".dword.rv"
-        else:
-            file_path = base_no_ext + ".qword.rv"
-        data = str(value)
-    elif isinstance(value, float):
-        if abs(value) < 3.4e38:
-            file_path = base_no_ext + ".float.rv"
-        else:
-            file_path = base_no_ext + ".double.rv"
-        data = str(value)
-    elif isinstance(value, list):
-        file_path = base_no_ext + ".list.rv"
-        escaped = [str(item).replace(",", "\\,") for item in value]
-        data = ", ".join(escaped)
-    elif isinstance(value, str):
-        file_path = base_no_ext + ".str.rv"
-        data = value
-    else:
-        raise ValueError("Unsupported value type for registry.")
+# ----------------------------
+# Hive images (compiled read-mostly hives)
+# ----------------------------
+# `libreg compact` packs a whole hive into one file next to its root (<root>.image):
+#
+#   header   b"AQREGIMG", u32 version, u32 entry count
+#   table    per entry: u32 key offset, u32 key length, u32 data offset, u32 data length,
+#            sorted by key bytes
+#   blob     keys and data
+#
+# Keys are b"D" + key directory path or b"V" + value file path, relative to the hive root.
+# A directory entry holds the JSON of its _KeyDirIndex; a value entry holds the file text.
+# Reads memory-map the image and binary-search it instead of touching the hive directory.
+# Any write through libreg removes the image of the hive it changes, and so do the Java
+# RegistryEdit and regedit; RegistryPropagator does the same for any other writer (such as
+# a hand edit), so an image is only ever used while current.
+_IMAGE_HIVES = ("HKEY_LOCAL_MACHINE", "HKEY_LOCAL_MACHINE_NOINST")
+_IMAGE_MAGIC = b"AQREGIMG"
+_IMAGE_VERSION = 2
+_IMAGE_HEADER = struct.Struct("<8sII")
+_IMAGE_ENTRY = struct.Struct("<IIII")
+_IMAGE_COMPACT_ATTEMPTS = 3
+
+
+def hive_image_path(root: str) -> str:
+    return os.path.normpath(root) + ".image"
+
+
+class HiveImage:
+    """
+    A memory-mapped hive image. Instances are immutable; a rebuilt image is a new file.
+    """
 
-    # This code is unsafe when concurrent writes are possible.
-    # Use code below.
-    # with open(file_path, "w", encoding="utf-8") as f:
-    #     f.write(data)
+    def __init__(self, path: str, root: str):
+        self.path = path
+        self.root = os.path.normpath(root)
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if st.st_size else b""
+        self.stamp = (st.st_ino, st.st_mtime_ns, st.st_size)
+        if len(self._map) < _IMAGE_HEADER.size:
+            raise ValueError(f"Truncated hive image: {path}")
+        magic, version, self._count = _IMAGE_HEADER.unpack_from(self._map, 0)
+        if magic != _IMAGE_MAGIC or version != _IMAGE_VERSION:
+            raise ValueError(f"Not a hive image (or an unsupported version): {path}")
+        if _IMAGE_HEADER.size + self._count * _IMAGE_ENTRY.size > len(self._map):
+            raise ValueError(f"Truncated hive image: {path}")
+        self._dirs: Dict[str, Optional[_KeyDirIndex]] = {}
+
+    def covers(self, path: str) -> bool:
+        return path == self.root or path.startswith(self.root + os.sep)
+
+    def _find(self, key: bytes) -> Optional[bytes]:
+        data = self._map
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            key_off, key_len, data_off, data_len = _IMAGE_ENTRY.unpack_from(data, _IMAGE_HEADER.size + mid * _IMAGE_ENTRY.size)
+            probe = data[key_off:key_off + key_len]
+            if probe == key:
+                return data[data_off:data_off + data_len]
+            if probe < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return None
 
-    temp_file_path = file_path + f".tmp.{uuid.uuid4().hex}"
+    def _rel(self, path: str) -> str:
+        return "" if path == self.root else os.path.relpath(path, self.root)
+
+    def key_dir_index(self, base: str) -> Optional[_KeyDirIndex]:
+        """
+        Index of key directory `base` as compacted, or None if it did not exist.
+        """
+        base = os.path.normpath(base)
+        if base in self._dirs:
+            return self._dirs[base]
+        raw = self._find(b"D" + self._rel(base).encode("utf-8"))
+        index = None
+        if raw is not None:
+            record = json.loads(raw)
+            values = {name: (type_ext, os.path.join(base, f"{name}.{type_ext}.rv"))
+                      for name, type_ext in record["values"].items()}
+            index = _KeyDirIndex(values, record["subkeys"], record["listing"], self)
+        self._dirs[base] = index
+        return index
+
+    def read_value(self, file_path: str) -> Any:
+        raw = self._find(b"V" + self._rel(file_path).encode("utf-8"))
+        if raw is None:
+            return _read_value_file(file_path)
+        return _decode_value(file_path, raw)
+
+
+_images: Dict[str, HiveImage] = {}
+_images_lock = threading.Lock()
+
+
+def _load_hive_image(root: str) -> Optional[HiveImage]:
+    """
+    Current image of the hive at `root`, or None if it has none (or cannot be read).
+    """
+    path = hive_image_path(root)
     try:
-        with open(temp_file_path, "w", encoding="utf-8") as f:
-            f.write(data)
-            f.flush()
-            os.fsync(f.fileno())
+        st = os.stat(path)
+    except OSError:
+        _images.pop(path, None)
+        return None
+    image = _images.get(path)
+    if image is not None and image.stamp == (st.st_ino, st.st_mtime_ns, st.st_size):
+        return image
+    with _images_lock:
+        try:
+            image = HiveImage(path, root)
+        except (OSError, ValueError):
+            return None
+        _images[path] = image
+    return image
 
-        if os.path.exists(file_path):
-            shutil.copymode(file_path, temp_file_path)
 
-        os.replace(temp_file_path, file_path)
+def _with_images(expanded_map: Dict[str, str], index_of: _Indexer) -> _Indexer:
+    """
+    Wrap an indexer so key directories of imaged hives are answered from their images.
+    """
+    images = [image for hive in _IMAGE_HIVES if expanded_map.get(hive)
+              for image in (_load_hive_image(expanded_map[hive]),) if image is not None]
+    if not images:
+        return index_of
 
-    except Exception:
-        # Cleanup temp file if something fails
-        if os.path.exists(temp_file_path):
-            os.remove(temp_file_path)
-        raise
+    def imaged(base: str) -> Optional[_KeyDirIndex]:
+        for image in images:
+            if image.covers(base):
+                return image.key_dir_index(base)
+        return index_of(base)
 
-    if target_hive == "HKEY_CURRENT_USER":
+    return imaged
+
+
+def _discard_hive_image(hive: str, root: str) -> None:
+    if hive in _IMAGE_HIVES:
         try:
-            os.chown(file_path, uid, gid)
-        except PermissionError:
-            pass  # Ignore if we don't have permission to change ownership
+            os.remove(hive_image_path(root))
+        except FileNotFoundError:
+            pass
 
-    # Check update hooks
-    #
-    # keyPath_explicit_path = rel.replace("/", "<d>")
-    # keyPath_implicit_path = registry_path.lstrip("/").replace("/", "<d>")
-    keyPath_explicit_path = rel
-    keyPath_implicit_path = registry_path.lstrip("/")
-    hook_path = "HKEY_LOCAL_MACHINE/SYSTEM/Services/me.hysong.aqua/RegistryPropagator/ActionHooks/"
-    hooks_explicit_path = read(f"{hook_path}/{keyPath_explicit_path}", default=[])
-    hooks_implicit_path = read(f"{hook_path}/{keyPath_implicit_path}", default=[])
 
-    # Explicit goes higher priority than implicit
-    if isinstance(hooks_explicit_path, list) and hooks_explicit_path:
-        hooks = hooks_explicit_path
-    else:
-        hooks = hooks_implicit_path
+def _snapshot_hive(root: str) -> Tuple[Dict[bytes, bytes], Dict[str, int]]:
+    """
+    Image entries of the hive at `root`, and the mtimes they were taken at.
+    """
+    entries: Dict[bytes, bytes] = {}
+    mtimes: Dict[str, int] = {}
+    pending = [root]
+    while pending:
+        dir_path = pending.pop()
+        mtimes[dir_path] = os.stat(dir_path).st_mtime_ns
+        index = _scan_key_dir(dir_path)
+        if index is None:
+            continue
+        rel_dir = "" if dir_path == root else os.path.relpath(dir_path, root)
+        record = {
+            "values": {name: type_ext for name, (type_ext, _path) in index.values.items()},
+            "subkeys": index.subkeys,
+            "listing": index.listing,
+        }
+        entries[b"D" + rel_dir.encode("utf-8")] = json.dumps(record).encode("utf-8")
+        for _type, file_path in index.values.values():
+            with open(file_path, "rb") as f:
+                entries[b"V" + os.path.join(rel_dir, os.path.basename(file_path)).encode("utf-8")] = f.read()
+            mtimes[file_path] = os.stat(file_path).st_mtime_ns
+        pending.extend(os.path.join(dir_path, name) for name in index.subkeys)
+    return entries, mtimes
+
+
+def _unchanged(mtimes: Dict[str, int]) -> bool:
+    for path, mtime in mtimes.items():
+        try:
+            if os.stat(path).st_mtime_ns != mtime:
+                return False
+        except OSError:
+            return False
+    return True
 
-    if isinstance(hooks, list):
-        for exec_line in hooks:
-            # Each exec_line is a path to an executable hook
-            # Split by shell escape
+
+def _world_readable(root: str) -> bool:
+    for dir_path, dirs, files in os.walk(root):
+        if os.stat(dir_path).st_mode & 0o005 != 0o005:
+            return False
+        for name in files:
+            if os.stat(os.path.join(dir_path, name)).st_mode & 0o004 == 0:
+                return False
+    return True
+
+
+def compact(hive: str, *, hive_map: Optional[Dict[str, str]] = None) -> str:
+    """
+    Compile a read-mostly hive (HKLM or HKNS) into its image and return the image path.
+
+    Reads then consult the image before the loose .rv files, until the next write to the
+    hive removes it. The image is readable by everyone only if every file of the hive is;
+    otherwise only its owner uses it and everyone else keeps reading the files.
+    """
+    canonical = _canonical_hive_name(hive)
+    if canonical not in _IMAGE_HIVES:
+        raise ValueError(f"Only {', '.join(_IMAGE_HIVES)} can be compacted, not '{hive}'.")
+    root = os.path.normpath(_expand_hive_paths(hive_map)[canonical])
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f"Hive root '{root}' does not exist.")
+
+    # Retry if the hive changes while it is being read; an image must be a consistent snapshot
+    for _attempt in range(_IMAGE_COMPACT_ATTEMPTS):
+        entries, mtimes = _snapshot_hive(root)
+        if _unchanged(mtimes):
+            break
+    else:
+        raise RuntimeError(f"Hive '{canonical}' kept changing while being compacted.")
+
+    keys = sorted(entries)
+    blob_start = _IMAGE_HEADER.size + len(keys) * _IMAGE_ENTRY.size
+    table = bytearray()
+    blob = bytearray()
+    for key in keys:
+        data = entries[key]
+        key_off = blob_start + len(blob)
+        blob += key
+        data_off = blob_start + len(blob)
+        blob += data
+        table += _IMAGE_ENTRY.pack(key_off, len(key), data_off, len(data))
+
+    path = hive_image_path(root)
+    temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            f.write(_IMAGE_HEADER.pack(_IMAGE_MAGIC, _IMAGE_VERSION, len(keys)))
+            f.write(table)
+            f.write(blob)
+            f.flush()
+            os.fsync(f.fileno())
+        os.chmod(temp_path, 0o644 if _world_readable(root) else 0o600)
+        if not _unchanged(mtimes):
+            raise RuntimeError(f"Hive '{canonical}' changed while being compacted.")
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path
+
+
+def upgrade(hive: str, *, hive_map: Optional[Dict[str, str]] = None) -> int:
+    """
+    Rewrite the .list.rv files of a hive that are still in the original comma-separated
+    format into the current one, in place. Returns how many files were rewritten.
+
+    Each file is replaced atomically and keeps its mode and owner; values read the same
+    before and after. Hex numbers are left alone: only bytes values use the bytes format.
+    """
+    canonical = _canonical_hive_name(hive)
+    if canonical is None:
+        raise ValueError(f"Unknown hive '{hive}'.")
+    root = os.path.normpath(_expand_hive_paths(hive_map)[canonical])
+    if not os.path.isdir(root):
+        raise FileNotFoundError(f"Hive root '{root}' does not exist.")
+
+    upgraded = 0
+    for dir_path, _dirs, files in os.walk(root):
+        changed = False
+        for name in files:
+            if not name.endswith(".list.rv"):
+                continue
+            file_path = os.path.join(dir_path, name)
+            with open(file_path, "rb") as f:
+                raw = f.read()
+            if raw.startswith(_LIST_HEADER.encode("utf-8")):
+                continue
+            data = _encode_list(_decode_legacy_list(raw.decode("utf-8"))).encode("utf-8")
+            st = os.stat(file_path)
+            temp_file_path = _stage_value_file(file_path, data)
+            try:
+                os.chown(temp_file_path, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+            os.replace(temp_file_path, file_path)
+            changed = True
+            upgraded += 1
+        if changed:
+            _fsync_dir(dir_path)
+            _invalidate_cached(dir_path)
+    if upgraded:
+        _discard_hive_image(canonical, root)
+    return upgraded
+
+
+# ----------------------------
+# Export and diff
+# ----------------------------
+# Both walk their sources as streams of entries in one fixed order: depth first, the
+# children of each key sorted by name, a value before a subkey of the same name. Two
+# such streams are compared in a single merge pass, so memory stays bounded by the
+# largest key, not the size of the tree.
+
+class _TreeEntry:
+    __slots__ = ("parts", "type", "value", "text", "optional")
+
+    def __init__(self, parts: Tuple[str, ...], type_ext: str, value: Any, text: Optional[str],
+                 optional: bool = False):
+        self.parts = parts
+        self.type = type_ext      # "key" for keys
+        self.value = value        # Decoded value; None for keys
+        self.text = text          # The value as written in a .regtree; None if not representable
+        self.optional = optional  # A "?" line: only applies if the path does not exist yet
+
+    def order(self) -> Tuple[Tuple[str, ...], int]:
+        return self.parts, 1 if self.type == "key" else 0
+
+
+def _short_hive_name(canonical: str) -> str:
+    for short, long_name in _HIVE_SHORT_MAP.items():
+        if long_name == canonical:
+            return short
+    return canonical
+
+
+def _split_parts(rel: str) -> Tuple[str, ...]:
+    return tuple(part for part in rel.split("/") if part)
+
+
+def _regtree_text(type_ext: str, value: Any) -> Optional[str]:
+    """
+    How a value is written after `path:type=` in a .regtree, or None if a .regtree
+    cannot hold it (bytes, line breaks, surrounding blanks) and install would change it.
+    """
+    if isinstance(value, bytes):
+        return None
+    if type_ext == "list":
+        text = ", ".join(str(item).replace(",", "\\,") for item in value)
+    elif type_ext == "bool":
+        text = "1" if value else "0"
+    elif type_ext == "hex":
+        text = format(value, "x")
+    elif type_ext in ("float", "double"):
+        text = repr(value)
+    else:
+        text = str(value)
+    if "\n" in text or "\r" in text or text != text.strip():
+        return None
+    if _decode_value(f"_.{type_ext}.rv", _encode_value("_", text, type_ext)[1]) != value:
+        return None
+    return text
+
+
+def _walk_hive(bases: List[str], parts: Tuple[str, ...]) -> Iterator[_TreeEntry]:
+    """
+    Entries below the key directories `bases` (one key, possibly stored under both an
+    encoded and a legacy raw name), in export order.
+    """
+    values: Dict[str, Tuple[str, str]] = {}
+    subkeys: Dict[str, List[str]] = {}
+    for base in bases:
+        index = _scan_key_dir(base)
+        if index is None:
+            continue
+        for name, hit in index.values.items():
+            values.setdefault(decode_key(name), hit)
+        for name in index.subkeys:
+            subkeys.setdefault(decode_key(name), []).append(os.path.join(base, name))
+
+    children = [(name, 0) for name in values] + [(name, 1) for name in subkeys]
+    for name, is_key in sorted(children):
+        child = parts + (name,)
+        if is_key:
+            yield _TreeEntry(child, "key", None, None)
+            yield from _walk_hive(subkeys[name], child)
+            continue
+        type_ext, file_path = values[name]
+        try:
+            value = _read_value_file(file_path)
+        except (OSError, ValueError):
+            continue  # Removed meanwhile, or not a valid value of its type
+        yield _TreeEntry(child, type_ext, value, _regtree_text(type_ext, value))
+
+
+def _hive_source(registry_path: str, hive_map: Optional[Dict[str, str]]) -> Tuple[str, Iterator[_TreeEntry]]:
+    """
+    (path prefix, entries relative to it) of a registry key. Paths without a hive are HKCU.
+    """
+    target_hive, root, rel = _resolve_write_target(registry_path, _expand_hive_paths(hive_map))
+    prefix = "/".join((_short_hive_name(target_hive),) + _split_parts(rel))
+    return prefix, _walk_hive(_hive_bases(root, rel.strip("/")), ())
+
+
+def _regtree_entries(lines: Iterator[str]) -> Iterator[_TreeEntry]:
+    last_key: Tuple[str, ...] = ()
+    for line in lines:
+        parsed = _parse_regtree_line(line)
+        if parsed is None or parsed[0] == "-":
+            continue
+        flag, key_path, typedef, raw_value = parsed
+        hive, rel = _split_hive_and_rel(key_path)
+        parts = (_short_hive_name(hive or "HKEY_CURRENT_USER"),) + _split_parts(rel)
+
+        # Keys exist implicitly above every line; skip those just yielded
+        key_parts = parts if raw_value is None else parts[:-1]
+        for i in range(1, len(key_parts) + 1):
+            if last_key[:i] != key_parts[:i]:
+                yield _TreeEntry(key_parts[:i], "key", None, None)
+        last_key = key_parts
+        if raw_value is None:
+            continue
+
+        file_path, data, _text = _encode_value("_", raw_value, typedef)
+        try:
+            value = _decode_value(file_path, data)
+        except ValueError:
+            value = raw_value  # Not valid for its type; compares unequal to any valid value
+        yield _TreeEntry(parts, file_path.rsplit(".", 2)[1], value, raw_value, flag == "?")
+
+
+def _regtree_source(regtree_path: str) -> Iterator[_TreeEntry]:
+    """
+    Entries of a .regtree file in export order, with full paths.
+
+    Lines of an exported file are already in that order and are streamed. Any other
+    file is sorted in memory first. Later lines for the same path win, as on install,
+    except "?" lines.
+    """
+    def read_lines() -> Iterator[str]:
+        with open(regtree_path, "r", encoding="utf-8") as f:
+            yield from f
+
+    def deduplicated(entries: Iterator[_TreeEntry]) -> Iterator[_TreeEntry]:
+        pending = None
+        for entry in entries:
+            if pending is not None and entry.order() != pending.order():
+                yield pending
+            elif pending is not None and entry.optional:
+                continue
+            pending = entry
+        if pending is not None:
+            yield pending
+
+    previous = None
+    for entry in _regtree_entries(read_lines()):
+        if previous is not None and entry.order() < previous:
+            entries = sorted(_regtree_entries(read_lines()), key=_TreeEntry.order)  # Stable: keeps line order
+            return deduplicated(iter(entries))
+        previous = entry.order()
+    return deduplicated(_regtree_entries(read_lines()))
+
+
+def _full_paths(prefix: str, entries: Iterator[_TreeEntry]) -> Iterator[_TreeEntry]:
+    base = _split_parts(prefix)
+    for i in range(1, len(base) + 1):
+        yield _TreeEntry(base[:i], "key", None, None)
+    for entry in entries:
+        entry.parts = base + entry.parts
+        yield entry
+
+
+def _is_regtree_file(source: str) -> bool:
+    return source.endswith(".regtree") and os.path.isfile(source)
+
+
+def _regtree_line(path: str, entry: _TreeEntry) -> str:
+    if entry.type == "key":
+        return path
+    if entry.text is None:
+        return f"# Skipped {path}:{entry.type}: not representable in a .regtree"
+    return f"{path}:{entry.type}={entry.text}"
+
+
+def export(registry_path: str, *, hive_map: Optional[Dict[str, str]] = None) -> Iterator[str]:
+    """
+    Yield a key and everything below it as .regtree lines (without line breaks).
+    Installing them recreates the subtree. Paths without a hive are HKCU.
+    """
+    prefix, entries = _hive_source(registry_path, hive_map)
+    yield prefix
+    for entry in entries:
+        yield _regtree_line("/".join((prefix,) + entry.parts), entry)
+
+
+def diff(old: str, new: str, *, hive_map: Optional[Dict[str, str]] = None) -> Iterator[str]:
+    """
+    Yield the .regtree lines that turn `old` into `new`: `path:type=value` for added and
+    changed values, `path` for added keys and `-path` for removed ones.
+
+    Each side is a registry key (e.g. HKLM/SOFTWARE) or a .regtree file. Two keys are
+    compared relative to themselves, and lines name paths below `old`. When a .regtree is
+    involved, full paths are compared instead.
+    """
+    if not _is_regtree_file(old) and not _is_regtree_file(new):
+        prefix, old_entries = _hive_source(old, hive_map)
+        _new_prefix, new_entries = _hive_source(new, hive_map)
+        base: Tuple[str, ...] = (prefix,)
+    else:
+        old_entries, new_entries = (
+            _regtree_source(side) if _is_regtree_file(side) else _full_paths(*_hive_source(side, hive_map))
+            for side in (old, new)
+        )
+        base = ()
+
+    def path_of(entry: _TreeEntry) -> str:
+        return "/".join(base + entry.parts)
+
+    a = next(old_entries, None)
+    b = next(new_entries, None)
+    removed: Optional[Tuple[str, ...]] = None
+    while a is not None or b is not None:
+        if a is not None and removed is not None and a.parts[:len(removed)] == removed:
+            a = next(old_entries, None)  # Below a removed key
+            continue
+        if b is None or (a is not None and a.order() < b.order()):
+            yield f"-{path_of(a)}"
+            if a.type == "key":
+                removed = a.parts
+            a = next(old_entries, None)
+        elif a is None or b.order() < a.order():
+            yield _regtree_line(path_of(b), b)
+            b = next(new_entries, None)
+        else:
+            if a.type != b.type and not b.optional:
+                yield f"-{path_of(a)}"  # Otherwise the value of the old type would still be found
+                yield _regtree_line(path_of(b), b)
+            elif a.value != b.value and not b.optional:
+                yield _regtree_line(path_of(b), b)
+            a = next(old_entries, None)
+            b = next(new_entries, None)
+
+
+# ----------------------------
+# Registry daemon (regd) client
+# ----------------------------
+# A running regd (me.hysong.aqua.services.RegistryDaemon) answers requests over a Unix
+# socket from its warm caches. Frames are netstrings: b"<length>:<payload>,".
+# A payload starting with "{" is a JSON request from libreg, answered with a JSON reply.
+# Anything else is a tab-separated reg.sh command line (user, action, path, args...),
+# answered with "<exit code>\t<output>", or with "DECLINED" if the caller has to do it itself.
+# Whenever regd is absent or declines, libreg accesses the hive files directly.
+#
+# The socket lives in a root-owned directory that only root can write, and clients check
+# that the listening peer runs as root: anyone could otherwise plant a socket that answers
+# reads with forged values or swallows writes.
+_RUN_DIR = "/run/aqua"
+_REGD_SOCKET = os.path.join(_RUN_DIR, "regd.sock")
+_REGD_ENV = "AQUA_REGD"  # "0" makes this process always access hive files directly
+_REGD_TIMEOUT = 2.0
+_REGD_RETRY_SECONDS = 5.0
+_REGD_MAX_FRAME = 64 * 1024 * 1024
+_REGD_CRED = struct.Struct("3i")  # struct ucred: pid, uid, gid
+
+
+def ensure_run_dir(path: str = _RUN_DIR) -> str:
+    """
+    Create the directory root services publish their sockets and indexes in, or check an
+    existing one. Raises PermissionError unless it is a real directory owned by root that
+    no one else can write.
+    """
+    os.makedirs(path, mode=0o755, exist_ok=True)
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != 0 or st.st_mode & 0o022:
+        raise PermissionError(f"'{path}' must be a directory owned by root and writable only by root.")
+    return path
+
+
+def regd_frame(payload: bytes) -> bytes:
+    return b"%d:%s," % (len(payload), payload)
+
+
+def regd_read_frame(stream) -> Optional[bytes]:
+    """
+    Read one frame from a binary stream. None on a clean end of stream.
+    Raises ValueError on malformed or oversized frames.
+    """
+    header = b""
+    while True:
+        c = stream.read(1)
+        if not c:
+            if header:
+                raise ValueError("truncated regd frame")
+            return None
+        if c == b":":
+            break
+        if not c.isdigit() or len(header) > 10:
+            raise ValueError("malformed regd frame")
+        header += c
+    length = int(header or b"-1")
+    if length < 0 or length > _REGD_MAX_FRAME:
+        raise ValueError("malformed regd frame")
+    payload = stream.read(length)
+    if len(payload) != length or stream.read(1) != b",":
+        raise ValueError("truncated regd frame")
+    return payload
+
+
+class _RegdClient:
+    """
+    One persistent connection to regd, shared by the threads of a process.
+    """
+
+    def __init__(self, socket_path: str):
+        self.socket_path = socket_path
+        self._lock = threading.Lock()
+        self._sock: Optional[socket.socket] = None
+        self._stream = None
+        self._pid = os.getpid()
+        self._retry_at = 0.0
+
+    def _close(self) -> None:
+        if self._sock is not None:
+            try:
+                self._stream.close()
+                self._sock.close()
+            except OSError:
+                pass
+        self._sock = None
+        self._stream = None
+
+    def _connect(self) -> None:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(_REGD_TIMEOUT)
+        try:
+            sock.connect(self.socket_path)
+            _pid, uid, _gid = _REGD_CRED.unpack(sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _REGD_CRED.size))
+            if uid != 0:
+                raise PermissionError(f"{self.socket_path} is not served by root")
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._stream = sock.makefile("rb")
+
+    def request(self, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """
+        Send one request. Returns the reply if regd handled it, None otherwise.
+        """
+        if time.monotonic() < self._retry_at:
+            return None
+        try:
+            frame = regd_frame(json.dumps(message).encode("utf-8"))
+        except (TypeError, ValueError):
+            return None  # Not representable on the wire
+
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked: the connection belongs to the parent
+                self._sock = None
+                self._stream = None
+                self._pid = os.getpid()
+
+            # A kept connection may have gone stale (regd restarted); retry once on a new one
+            for fresh in ((False, True) if self._sock is not None else (True,)):
+                try:
+                    if fresh:
+                        self._close()
+                        self._connect()
+                    self._sock.sendall(frame)
+                    payload = regd_read_frame(self._stream)
+                    if payload is None:
+                        raise ConnectionError("regd closed the connection")
+                    reply = json.loads(payload)
+                    break
+                except (OSError, ValueError):
+                    self._close()
+                    if fresh:
+                        self._retry_at = time.monotonic() + _REGD_RETRY_SECONDS
+                        return None
+            else:
+                return None
+
+        if not isinstance(reply, dict) or not reply.get("ok"):
+            return None
+        return reply
+
+
+_regd: Optional[_RegdClient] = None if os.environ.get(_REGD_ENV) == "0" else _RegdClient(_REGD_SOCKET)
+
+
+def use_daemon(enabled: bool = True, socket_path: str = _REGD_SOCKET) -> None:
+    """
+    Turn use of regd on or off for this process. regd itself turns it off.
+    """
+    global _regd
+    _regd = _RegdClient(socket_path) if enabled else None
+
+
+def _regd_request(message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    client = _regd
+    if client is None:
+        return None
+    return client.request(message)
+
+
+# ----------------------------
+# Profiler (opt-in)
+# ----------------------------
+# Enable per process with enable_profiler(), for every process with AQUA_REGISTRY_PROFILE=1,
+# or system-wide with HKLM/SYSTEM/Services/me.hysong.aqua/RegistryProfiler/Enabled:bool=true
+# (AQUA_REGISTRY_PROFILE=0 overrides the registry flag).
+#
+# read(), write() and delete() calls are tallied per (op, key) in memory and flushed about
+# once a second into a ring buffer on the VFS tmpfs, one per user (<_PROFILE_RING>.<uid>):
+#
+#   header   b"AQREGPRF", u32 version, u32 capacity, u64 records ever written
+#   records  capacity slots of _PROFILE_RECORD; record n goes into slot n % capacity
+#
+# Writers append under flock(LOCK_EX). `reg stats` sums up whatever the rings still hold.
+# Anyone can create files in the VFS, so a process only ever writes to a ring that is a
+# regular file it owns, not reached through a symlink and not linked anywhere else.
+_PROFILE_ENV = "AQUA_REGISTRY_PROFILE"
+_PROFILE_FLAG = "SYSTEM/Services/me.hysong.aqua/RegistryProfiler/Enabled"
+_PROFILE_RING = "/opt/aqua/vfs/registry.profile"
+_PROFILE_MAGIC = b"AQREGPRF"
+_PROFILE_VERSION = 1
+_PROFILE_CAPACITY = 8192
+_PROFILE_HEADER = struct.Struct("<8sIIQ")
+# time, calls, cache hits, cache lookups, total ns, op, hive, caller, key
+_PROFILE_RECORD = struct.Struct("<dIIIQ8s16s64s160s")
+_PROFILE_FLUSH_SECONDS = 1.0
+_PROFILE_FLUSH_PENDING = 256
+
+
+def _profile_caller() -> str:
+    """
+    AppContext id of this process, or its program name outside of apprun.
+    """
+    if AppContext is not None:
+        try:
+            return str(AppContext().id())
+        except Exception:
+            pass
+    return os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else f"pid {os.getpid()}"
+
+
+def _profile_field(text: str, size: int) -> bytes:
+    data = text.encode("utf-8")
+    if len(data) <= size:
+        return data
+    # Keep the end of long keys, it tells them apart; never split a character
+    return data[len(data) - size:].decode("utf-8", "ignore").encode("utf-8")
+
+
+def _profile_text(field: bytes) -> str:
+    return field.rstrip(b"\0").decode("utf-8", "replace")
+
+
+class _Tally:
+    __slots__ = ("calls", "hits", "lookups", "total_ns")
+
+    def __init__(self):
+        self.calls = 0
+        self.hits = 0
+        self.lookups = 0
+        self.total_ns = 0
+
+
+class RegistryProfiler:
+    """
+    Per-process collector behind enable_profiler(). Only the outermost registry call of a
+    thread is measured; reads that write() or delete() make themselves count towards them.
+    """
+
+    def __init__(self, ring_path: Optional[str] = None, capacity: int = _PROFILE_CAPACITY):
+        # None: the ring of whichever user this process runs as when it flushes
+        self.ring_path = ring_path
+        self.capacity = capacity
+        self.caller = _profile_caller()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._pending: Dict[Tuple[str, str, str], _Tally] = {}
+        self._last_flush = time.monotonic()
+
+    def measure(self, op: str, registry_path: str, call: Callable[[], Any]) -> Any:
+        local = self._local
+        if getattr(local, "active", False):
+            return call()
+        local.active = True
+        local.hits = 0
+        local.lookups = 0
+        start = time.perf_counter_ns()
+        try:
+            return call()
+        finally:
+            elapsed = time.perf_counter_ns() - start
+            local.active = False
+            self._record(op, registry_path, elapsed, local.hits, local.lookups)
+
+    def note_cache(self, hit: bool) -> None:
+        local = self._local
+        if getattr(local, "active", False):
+            local.lookups += 1
+            if hit:
+                local.hits += 1
+
+    def _record(self, op: str, registry_path: str, elapsed_ns: int, hits: int, lookups: int) -> None:
+        hive, rel = _split_hive_and_rel(registry_path)
+        rel = "/".join(_split_parts(rel))
+        if hive is not None:
+            hive = _short_hive_name(hive)
+            key = f"{hive}/{rel}" if rel else hive
+        else:
+            # Implicit reads search every hive in _PRIORITY; implicit writes and deletes go to HKCU
+            hive = "*" if op == "read" else "HKCU"
+            key = rel
+        with self._lock:
+            tally = self._pending.get((op, hive, key))
+            if tally is None:
+                tally = self._pending[(op, hive, key)] = _Tally()
+            tally.calls += 1
+            tally.hits += hits
+            tally.lookups += lookups
+            tally.total_ns += elapsed_ns
+            due = (len(self._pending) >= _PROFILE_FLUSH_PENDING
+                   or time.monotonic() - self._last_flush >= _PROFILE_FLUSH_SECONDS)
+        if due:
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Append everything tallied so far to the ring buffer.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return
+        now = time.time()
+        caller = _profile_field(self.caller, 64)
+        records = [
+            _PROFILE_RECORD.pack(now, tally.calls, tally.hits, tally.lookups, tally.total_ns,
+                                 op.encode("ascii"), _profile_field(hive, 16), caller, _profile_field(key, 160))
+            for (op, hive, key), tally in pending.items()
+        ]
+        with self._flush_lock:
+            try:
+                _append_profile_ring(self.ring_path or _profile_ring_path(), self.capacity, records)
+            except OSError:
+                pass  # No VFS (or no usable ring): profiling must never break registry access
+
+    def _after_fork(self) -> None:
+        # The parent flushes its own tallies
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self.caller = _profile_caller()
+
+
+def _profile_ring_path(uid: Optional[int] = None) -> str:
+    return f"{_PROFILE_RING}.{os.geteuid() if uid is None else uid}"
+
+
+def _profile_ring_paths() -> List[str]:
+    """
+    Rings of every user that has one.
+    """
+    directory, prefix = os.path.split(_PROFILE_RING)
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(os.path.join(directory, name) for name in names
+                  if name.startswith(prefix + ".") and name[len(prefix) + 1:].isdigit())
+
+
+def _append_profile_ring(path: str, capacity: int, records: List[bytes]) -> None:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o644)
+    try:
+        st = os.fstat(fd)
+        if not stat.S_ISREG(st.st_mode) or st.st_uid != os.geteuid() or st.st_nlink != 1:
+            raise PermissionError(f"Not a profile ring of this user: {path}")
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        header = os.pread(fd, _PROFILE_HEADER.size, 0)
+        written = 0
+        if len(header) == _PROFILE_HEADER.size:
+            magic, version, ring_capacity, ring_written = _PROFILE_HEADER.unpack(header)
+            if magic == _PROFILE_MAGIC and version == _PROFILE_VERSION and ring_capacity > 0:
+                capacity, written = ring_capacity, ring_written
+        if written == 0:
+            # New (or unrecognised) ring of ours: start over; `reg stats` of others may read it
+            os.ftruncate(fd, 0)
+            os.fchmod(fd, 0o644)
+
+        skipped = max(0, len(records) - capacity)
+        written += skipped
+        for record in records[skipped:]:
+            os.pwrite(fd, record, _PROFILE_HEADER.size + (written % capacity) * _PROFILE_RECORD.size)
+            written += 1
+        os.pwrite(fd, _PROFILE_HEADER.pack(_PROFILE_MAGIC, _PROFILE_VERSION, capacity, written), 0)
+    finally:
+        os.close(fd)
+
+
+def _read_profile_ring(path: str) -> Iterator[Tuple[float, int, int, int, int, str, str, str, str]]:
+    """
+    Records of the ring buffer, oldest first; nothing if there is no ring.
+    """
+    try:
+        f = os.fdopen(os.open(path, os.O_RDONLY | os.O_NOFOLLOW | os.O_NONBLOCK), "rb")
+    except OSError:
+        return
+    with f:
+        if not stat.S_ISREG(os.fstat(f.fileno()).st_mode):
+            return
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        header = f.read(_PROFILE_HEADER.size)
+        if len(header) < _PROFILE_HEADER.size:
+            return
+        magic, version, capacity, written = _PROFILE_HEADER.unpack(header)
+        if magic != _PROFILE_MAGIC or version != _PROFILE_VERSION or capacity == 0:
+            return
+        slots = f.read(min(written, capacity) * _PROFILE_RECORD.size)
+
+    count = len(slots) // _PROFILE_RECORD.size
+    first = written % capacity if written > capacity else 0
+    for i in range(count):
+        offset = ((first + i) % count) * _PROFILE_RECORD.size
+        ts, calls, hits, lookups, total_ns, op, hive, caller, key = _PROFILE_RECORD.unpack_from(slots, offset)
+        yield (ts, calls, hits, lookups, total_ns, _profile_text(op), _profile_text(hive),
+               _profile_text(caller), _profile_text(key))
+
+
+_profiler: Optional[RegistryProfiler] = None
+_profiler_lock = threading.Lock()
+
+
+def enable_profiler(ring_path: Optional[str] = None) -> RegistryProfiler:
+    """
+    Turn on the profiler for this process (idempotent) and return it.
+    """
+    global _profiler
+    with _profiler_lock:
+        if _profiler is None:
+            _profiler = RegistryProfiler(ring_path)
+            atexit.register(_profiler.flush)
+            os.register_at_fork(after_in_child=_profiler._after_fork)
+        return _profiler
+
+
+def disable_profiler() -> None:
+    global _profiler
+    with _profiler_lock:
+        profiler, _profiler = _profiler, None
+    if profiler is not None:
+        profiler.flush()
+
+
+def _profiled(op: str, path_arg: int = 0):
+    """
+    Measure calls of a public API function, whose registry path is positional argument
+    `path_arg`, while the profiler is on.
+    """
+    def decorate(func: Callable[..., Any]) -> Callable[..., Any]:
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            profiler = _profiler
+            if profiler is None:
+                return func(*args, **kwargs)
+            registry_path = args[path_arg] if len(args) > path_arg else kwargs.get("registry_path", "")
+            return profiler.measure(op, registry_path, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorate
+
+
+def _profile_requested() -> bool:
+    env = os.environ.get(_PROFILE_ENV, "").lower()
+    if env:
+        return env in ("1", "true", "yes", "on")
+    flag = os.path.join(_HIVE_MAP["HKEY_LOCAL_MACHINE"], f"{_PROFILE_FLAG}.bool.rv")
+    try:
+        return _read_value_file(flag) is True
+    except (OSError, ValueError):
+        return False
+
+
+def profile_stats(limit: int = 10, *, prefix: str = "", ring_path: Optional[str] = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Summary of the profiler ring buffers of every user (or of `ring_path` only), limited to
+    keys at or below `prefix`:
+      - "keys":    hottest keys, by number of calls
+      - "hives":   slowest hives, by mean latency
+      - "callers": worst callers, by total time spent in registry calls
+    Times are in microseconds; hit_rate is of the read cache, None if it was never asked.
+    """
+    prefix_hive, prefix_rel = _split_hive_and_rel(prefix)
+    prefix_parts = _split_parts(prefix_rel)
+
+    def matches(hive: str, key: str) -> bool:
+        if not prefix:
+            return True
+        parts = _split_parts(key)
+        if prefix_hive is not None:
+            if hive != _short_hive_name(prefix_hive):
+                return False
+            parts = parts[1:]
+        return parts[:len(prefix_parts)] == prefix_parts
+
+    groups: Dict[str, Dict[str, Dict[str, Any]]] = {"keys": {}, "hives": {}, "callers": {}}
+    records = (record for path in ([ring_path] if ring_path else _profile_ring_paths())
+               for record in _read_profile_ring(path))
+    for _ts, calls, hits, lookups, total_ns, op, hive, caller, key in records:
+        if not matches(hive, key):
+            continue
+        for group, name in (("keys", key), ("hives", hive), ("callers", caller)):
+            row = groups[group].get(name)
+            if row is None:
+                row = groups[group][name] = {"name": name, "calls": 0, "read": 0, "write": 0, "delete": 0,
+                                             "hits": 0, "lookups": 0, "total_ns": 0}
+            row["calls"] += calls
+            row[op] = row.get(op, 0) + calls
+            row["hits"] += hits
+            row["lookups"] += lookups
+            row["total_ns"] += total_ns
+
+    def finish(row: Dict[str, Any]) -> Dict[str, Any]:
+        hits, lookups, total_ns = row.pop("hits"), row.pop("lookups"), row.pop("total_ns")
+        row["total_us"] = round(total_ns / 1000, 1)
+        row["mean_us"] = round(total_ns / row["calls"] / 1000, 1)
+        row["hit_rate"] = (hits / lookups) if lookups else None
+        return row
+
+    orders = {"keys": "calls", "hives": "mean_us", "callers": "total_us"}
+    return {
+        group: sorted((finish(row) for row in rows.values()), key=lambda r: r[orders[group]], reverse=True)[:limit]
+        for group, rows in groups.items()
+    }
+
+
+if _profile_requested():
+    enable_profiler()
+
+
+# ----------------------------
+# Public API
+# ----------------------------
+@_profiled("read")
+def read(
+    registry_path: str,
+    default: Any = None,
+    *,
+    hive_map: Optional[Dict[str, str]] = None,
+) -> Any:
+    """
+    Read a key or value.
+
+    Semantics:
+      - If path explicitly starts with a hive (long or short), read ONLY from that hive.
+      - If no hive specified, search in the order given by _PRIORITY (earlier wins).
+      - Reading a directory returns a merged mapping from ALL searched hives, where
+        higher-priority hives override lower-priority names on collision.
+    """
+    expanded_map = _expand_hive_paths(hive_map)
+    # A process with its own read cache answers faster than a round trip
+    if _cache is None:
+        reply = _regd_request({"op": "read", "path": registry_path, "hive_map": expanded_map})
+        if reply is not None:
+            return reply["value"] if reply.get("found") else default
+    return _read_resolved(registry_path, default, expanded_map, _with_images(expanded_map, _key_dir_index))
+
+
+def read_traced(
+    registry_path: str,
+    default: Any = None,
+    *,
+    hive_map: Optional[Dict[str, str]] = None,
+) -> Tuple[Any, List[str], List[str]]:
+    """
+    read() straight from the hive files, also returning what it looked at:
+    (result, key directories probed whether they exist or not, files read).
+    Used by regd to check that a peer could have read the same files itself.
+    A key directory answered from a hive image counts as probed, and the image as read.
+    """
+    probed: List[str] = []
+    opened: List[str] = []
+    expanded_map = _expand_hive_paths(hive_map)
+    imaged = _with_images(expanded_map, _key_dir_index)
+
+    def index_of(base: str) -> Optional[_KeyDirIndex]:
+        probed.append(base)
+        index = imaged(base)
+        if index is not None and index.image is not None:
+            opened.append(index.image.path)
+        return index
+
+    result = _read_resolved(registry_path, default, expanded_map, index_of, opened)
+    return result, probed, opened
+
+
+def _candidate_bases(registry_path: str, expanded_map: Dict[str, str]) -> Tuple[bool, List[str]]:
+    """
+    Filesystem bases (without type extension) a read of `registry_path` consults,
+    in priority order. The flag tells whether the hive was given explicitly.
+    """
+    explicit_hive, rel = _split_hive_and_rel(registry_path)
+
+    if explicit_hive:
+        root = expanded_map.get(explicit_hive)
+        if not root:
+            return True, []
+        return True, _hive_bases(root, rel)
+
+    candidates: List[str] = []
+    for hive in _priority_hives():
+        root = expanded_map.get(hive)
+        if not root:
+            continue
+        candidates.extend(_hive_bases(root, rel))
+    return False, candidates
+
+
+def _read_resolved(
+    registry_path: str,
+    default: Any,
+    expanded_map: Dict[str, str],
+    index_of: _Indexer,
+    opened: Optional[List[str]] = None,
+) -> Any:
+    explicit, candidates = _candidate_bases(registry_path, expanded_map)
+
+    if explicit:
+        # Strictly from the specified hive
+        for base in candidates:
+            listing = _lookup_listing(base, index_of)
+            if listing is not None:
+                # Single-hive directory listing
+                return listing
+
+        for base in candidates:
+            found, value = _lookup_value(base, index_of, opened)
+            if found:
+                return value
+        return default
+
+    # No hive specified: search by priority
+    merged_listing: Dict[str, str] = {}
+
+    # Directory read: if ANY candidate dir exists, perform merged listing by priority order
+    listings = [_lookup_listing(base, index_of) for base in candidates]
+    if any(listing is not None for listing in listings):
+        for listing in listings:
+            if listing is None:
+                continue
+            for name, type_ext in listing.items():
+                # Respect priority: first hit wins
+                if name not in merged_listing:
+                    merged_listing[name] = type_ext
+        return merged_listing
+
+    # Value read: try each hive in priority order
+    for base in candidates:
+        found, value = _lookup_value(base, index_of, opened)
+        if found:
+            return value
+    return default
+
+
+def _batch_indexer() -> _Indexer:
+    """
+    Key directory indexer that scans each directory at most once per batch call.
+    """
+    memo: Dict[str, Optional[_KeyDirIndex]] = {}
+
+    def index_of(base: str) -> Optional[_KeyDirIndex]:
+        if base not in memo:
+            memo[base] = _key_dir_index(base)
+        return memo[base]
+
+    return index_of
+
+
+def read_many(
+    registry_paths: List[str],
+    default: Any = None,
+    *,
+    hive_map: Optional[Dict[str, str]] = None,
+) -> Dict[str, Any]:
+    """
+    Read several keys or values at once.
+
+    Returns a mapping of each requested path to what read() would return for it.
+    Hive paths are expanded once and each key directory is scanned once for the whole batch.
+    """
+    expanded_map = _expand_hive_paths(hive_map)
+    index_of = _with_images(expanded_map, _batch_indexer())
+    return {p: _read_resolved(p, default, expanded_map, index_of) for p in registry_paths}
+
+
+def _read_tree_at(bases: List[str], depth: Optional[int], index_of: _Indexer) -> Optional[Dict[str, Any]]:
+    present = [(base, index) for base in bases for index in (index_of(base),) if index is not None]
+    if not present:
+        return None
+
+    tree: Dict[str, Any] = {}
+
+    # A name that is a subkey in ANY hive reads as a key, as in read()
+    subkey_bases: Dict[str, List[str]] = {}
+    for base, index in present:
+        for name in index.subkeys:
+            subkey_bases.setdefault(decode_key(name), []).append(os.path.join(base, name))
+
+    for base, index in present:
+        for name in index.values:
+            decoded = decode_key(name)
+            if decoded in subkey_bases or decoded in tree:
+                continue
+            # Earlier hives were already searched for this name
+            tree[decoded] = _read_index_hit(index, base, name)
+
+    if depth is None or depth > 0:
+        for name, child_bases in subkey_bases.items():
+            subtree = _read_tree_at(child_bases, None if depth is None else depth - 1, index_of)
+            if subtree is not None:
+                tree[name] = subtree
+    return tree
+
+
+def read_tree(
+    registry_path: str,
+    default: Any = None,
+    *,
+    depth: Optional[int] = None,
+    hive_map: Optional[Dict[str, str]] = None,
+) -> Any:
+    """
+    Read a whole key with its values and subkeys in one pass.
+
+    Returns a nested mapping: value names map to decoded values, subkey names map to
+    nested mappings. `depth` limits how many subkey levels are descended (0 = values of
+    the key only; None = unlimited); subkeys beyond it are left out.
+    Hive resolution and priority merging are the same as for read(). Returns `default`
+    if the key does not exist.
+    """
+    expanded_map = _expand_hive_paths(hive_map)
+    _explicit, candidates = _candidate_bases(registry_path, expanded_map)
+    tree = _read_tree_at(candidates, depth, _with_images(expanded_map, _batch_indexer()))
+    return tree if tree is not None else default
+
+
+
+def _exec_hook_secure(hook: str, new_value: str):
+    try:
+        parts = shlex.split(hook)
+        cmd_args = [part.replace("{}", new_value) for part in parts]
+        subprocess.run(cmd_args, check=True)
+    except Exception as e:
+        print(f"Warning: Failed to execute hook '{hook}': {e}")
+        pass  # Ignore hook execution errors
+
+def encode_key(key_part: str) -> str:
+    """
+    특수문자, 공백, 유니코드 등을 퍼센트 인코딩하여 파일시스템 호환성 및 보안 확보
+    예: "배경 화면" -> "%EB%B0%B0%EA%B2%BD%20%ED%99%94%EB%A9%B4"
+    """
+    # safe='' 로 설정하여 슬래시(/)를 제외한 모든 특수문자 인코딩
+    # 키 경로 자체에 슬래시가 포함된다면 split 후 각각 인코딩해야 함
+    return urllib.parse.quote(key_part, safe='')
+
+def decode_key(encoded_part: str) -> str:
+    return urllib.parse.unquote(encoded_part)
+
+@functools.lru_cache(maxsize=8192)
+def _encode_rel(rel_path: str) -> Tuple[str, Optional[str]]:
+    """
+    (인코딩된 상대 경로, 인코딩 전 경로) - 둘이 같으면 두 번째는 None.
+    Keys written without encoding (e.g. by the Java libreg) live under the raw path.
+    """
+    parts = rel_path.split('/')
+    encoded = os.path.join(*[encode_key(p) for p in parts])
+    raw = os.path.join(*parts)
+    return encoded, (raw if raw != encoded else None)
+
+
+def get_encoded_path(root: str, rel_path: str) -> str:
+    """
+    상대 경로(Software/MyConfig)를 받아 인코딩된 절대 경로를 반환
+    """
+    return os.path.join(root, _encode_rel(rel_path)[0])
+
+
+def _hive_bases(root: str, rel_path: str) -> List[str]:
+    """
+    Bases to look `rel_path` up under in one hive: the encoded path, then the raw path
+    if it differs.
+    """
+    encoded, raw = _encode_rel(rel_path)
+    if raw is None:
+        return [os.path.join(root, encoded)]
+    return [os.path.join(root, encoded), os.path.join(root, raw)]
+
+
+def _existing_bases(root: str, rel_path: str) -> List[str]:
+    """
+    Bases of `rel_path` in one hive that a delete has to remove: every variant that
+    exists, or just the encoded path if none (or only it) can.
+    """
+    bases = _hive_bases(root, rel_path)
+    if len(bases) == 1:
+        return bases
+    existing = [base for base in bases if os.path.isdir(base) or _detect_value_file(base) is not None]
+    return existing or bases[:1]
+
+def _resolve_write_target(registry_path: str, expanded_map: Dict[str, str]) -> Tuple[str, str, str]:
+    """
+    Return (target_hive, hive_root, rel) for a write or delete.
+    Paths without an explicit hive go to HKCU.
+    """
+    explicit_hive, rel = _split_hive_and_rel(registry_path)
+
+    if explicit_hive:
+        target_hive = explicit_hive
+    else:
+        # Default write hive is HKCU
+        target_hive = _canonical_hive_name("HKCU")
+        if target_hive is None:
+            raise RuntimeError("HKCU is not defined in the hive map.")
+
+    root = expanded_map.get(target_hive)
+    if not root:
+        raise RuntimeError(f"Hive '{target_hive}' has no valid root path.")
+    return target_hive, root, rel
+
+
+def _encode_value(base_no_ext: str, value: Any, typedef: Optional[str]) -> Tuple[str, bytes, str]:
+    """
+    Return (value file path, file contents, text) for a value. The text is what ActionHooks
+    get for {}: the value in the original text format.
+    """
+    if typedef is not None:
+        typedef = typedef.lower()
+    if typedef == "list" or (typedef is None and isinstance(value, list)):
+        # A string is the original comma-separated format, e.g. from reg.sh or a .regtree
+        items = value if isinstance(value, list) else _decode_legacy_list(str(value))
+        text = _list_hook_text(items)
+        return base_no_ext + ".list.rv", _encode_list(items).encode("utf-8"), text
+    if isinstance(value, (bytes, bytearray)) and typedef in (None, "hex"):
+        return base_no_ext + ".hex.rv", _BYTES_HEADER + bytes(value), value.hex()
+
+    if typedef is not None:
+        file_path = base_no_ext + f".{typedef}.rv"
+        data = str(value)
+    elif isinstance(value, bool):
+        file_path = base_no_ext + ".bool.rv"
+        data = "1" if value else "0"
+    elif isinstance(value, int):
+        if -(2**31) <= value < 2**31:
+            file_path = base_no_ext + ".dword.rv"
+        else:
+            file_path = base_no_ext + ".qword.rv"
+        data = str(value)
+    elif isinstance(value, float):
+        if abs(value) < 3.4e38:
+            file_path = base_no_ext + ".float.rv"
+        else:
+            file_path = base_no_ext + ".double.rv"
+        data = str(value)
+    elif isinstance(value, str):
+        file_path = base_no_ext + ".str.rv"
+        data = value
+    else:
+        raise ValueError("Unsupported value type for registry.")
+    return file_path, data.encode("utf-8"), data
+
+
+def _hive_owner(target_hive: str, as_user: str) -> Tuple[int, int]:
+    """
+    uid/gid new registry files should belong to: the user for HKCU, this process otherwise.
+    """
+    if target_hive == "HKEY_CURRENT_USER":
+        context = for_user(as_user)
+        return context.uid, context.gid
+    return os.getuid(), os.getgid()
+
+
+def _stage_value_file(file_path: str, data: bytes, durable: bool = True, tag: str = "") -> str:
+    """
+    Write data to a unique temp file next to file_path and return its path.
+    The caller os.replace()s it into place.
+    """
+    temp_file_path = file_path + f"{tag}.tmp.{uuid.uuid4().hex}"
+    try:
+        with open(temp_file_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            if durable:
+                os.fsync(f.fileno())
+
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_file_path)
+
+    except Exception:
+        # Cleanup temp file if something fails
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+    return temp_file_path
+
+
+def _fsync_dir(path: str) -> None:
+    """Best-effort fsync of a directory."""
+    try:
+        dirfd = os.open(path, os.O_DIRECTORY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+    except OSError:
+        pass
+
+
+def _load_syncfs() -> Optional[Callable[[int], int]]:
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        syncfs = libc.syncfs
+    except (OSError, AttributeError):
+        return None
+    syncfs.argtypes = [ctypes.c_int]
+    syncfs.restype = ctypes.c_int
+    return syncfs
+
+
+_libc_syncfs = _load_syncfs()
+
+
+def _syncfs(paths) -> bool:
+    """
+    Flush every filesystem holding one of `paths` with one syncfs(2) each.
+    Returns False if syncfs is unavailable or failed, leaving the caller to fsync.
+    """
+    if _libc_syncfs is None:
+        return False
+    devices: Dict[int, str] = {}
+    try:
+        for path in paths:
+            devices.setdefault(os.stat(path).st_dev, path)
+        for path in devices.values():
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                if _libc_syncfs(fd) != 0:
+                    return False
+            finally:
+                os.close(fd)
+    except OSError:
+        return False
+    return True
+
+
+_ACTION_HOOKS_PATH = "HKEY_LOCAL_MACHINE/SYSTEM/Services/me.hysong.aqua/RegistryPropagator/ActionHooks/"
+
+# Compiled ActionHooks, maintained by the RegistryPropagator service. Kept on the /run
+# tmpfs so a stale index never survives a reboot; absent means "service not running".
+# Writers run the commands it names, so only an index root (or the caller) wrote is used.
+_ACTION_HOOK_INDEX_FILE = os.path.join(_RUN_DIR, "registry.actionhooks.json")
+_ACTION_HOOK_INDEX_VERSION = 1
+
+# Writers that run the hooks of a value themselves rename it into place from a temp file
+# next to it carrying this tag, and RegistryPropagator skips such renames. They are waited
+# writes, and the first values of a key the writer created: the service may not be
+# watching a new key directory yet, so it cannot be relied on to see them.
+_WRITER_HOOKS_TAG = ".hooked"
+
+
+def hooks_run_by_writer(moved_from: str) -> bool:
+    """
+    Whether the writer of a value renamed into place from `moved_from` ran its hooks itself.
+    """
+    return f"{_WRITER_HOOKS_TAG}.tmp." in os.path.basename(moved_from)
+
+
+class ActionHookIndex:
+    """
+    Prefix trie of the ActionHooks subtree.
+
+    Nodes are keyed by encoded path component, as on disk. A node carries the decoded
+    hook value ("h") of the value file at its path, unless a subkey of the same name
+    exists there (read() would return a listing, which never runs hooks).
+    """
+
+    def __init__(self, trie: Optional[Dict[str, Any]] = None, source: str = "", dispatch_roots: Optional[List[str]] = None):
+        self.trie: Dict[str, Any] = trie if trie is not None else {"c": {}}
+        self.source = source
+        # Hive roots whose changes the publishing service dispatches hooks for by itself
+        self.dispatch_roots: List[str] = dispatch_roots or []
+
+    @classmethod
+    def compile(cls, hooks_dir: str) -> "ActionHookIndex":
+        def build(path: str) -> Dict[str, Any]:
+            node: Dict[str, Any] = {"c": {}}
+            index = _scan_key_dir(path)
+            if index is None:
+                return node
+            for name in index.subkeys:
+                node["c"][name] = build(os.path.join(path, name))
+            for name, (_type, file_path) in index.values.items():
+                if name in node["c"]:
+                    continue
+                try:
+                    node["c"][name] = {"c": {}, "h": _read_value_file(file_path)}
+                except (OSError, ValueError):
+                    continue
+            return node
+
+        return cls(build(hooks_dir), os.path.normpath(hooks_dir))
+
+    def lookup(self, rel: str, default: Any = None) -> Any:
+        """
+        Hook value registered for `rel` (a hive-relative registry path), or `default`.
+        """
+        node = self.trie
+        for part in rel.split("/"):
+            if not part:
+                continue
+            node = node["c"].get(encode_key(part))
+            if node is None:
+                return default
+        return node.get("h", default)
+
+    def hooks_for_change(self, hive: str, rel: str) -> Any:
+        """
+        Hooks to fire for a change to `rel` in `hive` seen on disk, where the path the
+        writer used is unknown: hive-relative registrations win (as in write()), then
+        registrations under the long or short hive name. Either a list of hooks or a single
+        hook string, like _find_hooks().
+        """
+        names = [hive] + [short for short, long in _HIVE_SHORT_MAP.items() if long == hive]
+        for path in [rel] + [f"{name}/{rel}" for name in names]:
+            hooks = self.lookup(path, [])
+            if isinstance(hooks, (list, str)) and hooks:
+                return hooks
+        return []
+
+    def to_json(self) -> str:
+        return json.dumps({
+            "version": _ACTION_HOOK_INDEX_VERSION,
+            "source": self.source,
+            "dispatch_roots": self.dispatch_roots,
+            "trie": self.trie,
+        })
+
+    @classmethod
+    def from_json(cls, text: str) -> Optional["ActionHookIndex"]:
+        obj = json.loads(text)
+        if obj.get("version") != _ACTION_HOOK_INDEX_VERSION:
+            return None
+        return cls(obj.get("trie"), obj.get("source", ""), obj.get("dispatch_roots"))
+
+    def dispatches(self, file_path: str) -> bool:
+        """
+        Whether the publishing service fires hooks for changes to `file_path` itself.
+        """
+        return any(file_path.startswith(root + os.sep) for root in self.dispatch_roots)
+
+
+def get_action_hooks_dir() -> str:
+    """
+    Filesystem directory holding the ActionHooks subtree in HKLM.
+    """
+    _hive, rel = _split_hive_and_rel(_ACTION_HOOKS_PATH.rstrip("/"))
+    return get_encoded_path(_expand_hive_paths()["HKEY_LOCAL_MACHINE"], rel)
+
+
+def rebuild_action_hook_index(
+    index_file: str = _ACTION_HOOK_INDEX_FILE,
+    dispatch_roots: Optional[List[str]] = None,
+) -> ActionHookIndex:
+    """
+    Compile the ActionHooks subtree and atomically publish it to `index_file`.
+    Called by the RegistryPropagator service whenever the subtree changes.
+    `dispatch_roots` lists the hive roots the service watches and fires hooks for;
+    writers leave hooks of values under them to the service.
+    """
+    index = ActionHookIndex.compile(get_action_hooks_dir())
+    index.dispatch_roots = [os.path.normpath(r) for r in dispatch_roots or []]
+    _ensure_dir(os.path.dirname(index_file))
+    temp_file_path = _stage_value_file(index_file, index.to_json().encode("utf-8"), durable=False)
+    os.chmod(temp_file_path, 0o644)  # Readers ignore an index others could have changed
+    os.replace(temp_file_path, index_file)
+    return index
+
+
+def remove_action_hook_index(index_file: str = _ACTION_HOOK_INDEX_FILE) -> None:
+    """
+    Withdraw the published index, so writers fall back to reading ActionHooks directly.
+    """
+    try:
+        os.remove(index_file)
+    except FileNotFoundError:
+        pass
+
+
+_hook_index_cache: Optional[RegistryCache] = None
+
+
+def _action_hook_index() -> Optional[ActionHookIndex]:
+    """
+    The published ActionHook index, or None if the service has not published one
+    (or it was compiled for another HKLM root). Cached; with inotify a hit costs no
+    filesystem lookup at all.
+    """
+    global _hook_index_cache
+    if _hook_index_cache is None:
+        _hook_index_cache = RegistryCache()
+
+    def load() -> Tuple[Optional[str], Optional[ActionHookIndex]]:
+        try:
+            with open(_ACTION_HOOK_INDEX_FILE, "r", encoding="utf-8") as f:
+                st = os.fstat(f.fileno())
+                if st.st_uid not in (0, os.geteuid()) or st.st_mode & 0o022:
+                    return None, None  # Planted or tamperable: ignore it
+                return _ACTION_HOOK_INDEX_FILE, ActionHookIndex.from_json(f.read())
+        except (OSError, ValueError):
+            return None, None
+
+    index = _hook_index_cache.lookup(os.path.dirname(_ACTION_HOOK_INDEX_FILE), "actionhooks", load)
+    if index is None or index.source != os.path.normpath(get_action_hooks_dir()):
+        return None
+    return index
+
+
+def _find_hooks(registry_path: str, rel: str) -> Any:
+    # Check update hooks
+    #
+    # keyPath_explicit_path = rel.replace("/", "<d>")
+    # keyPath_implicit_path = registry_path.lstrip("/").replace("/", "<d>")
+    keyPath_explicit_path = rel
+    keyPath_implicit_path = registry_path.lstrip("/")
+
+    index = _action_hook_index()
+    if index is not None:
+        hooks_explicit_path = index.lookup(keyPath_explicit_path, [])
+        hooks_implicit_path = index.lookup(keyPath_implicit_path, [])
+    else:
+        hook_path = _ACTION_HOOKS_PATH
+        hooks_explicit_path = read(f"{hook_path}/{keyPath_explicit_path}", default=[])
+        hooks_implicit_path = read(f"{hook_path}/{keyPath_implicit_path}", default=[])
+
+    # Explicit goes higher priority than implicit
+    if isinstance(hooks_explicit_path, list) and hooks_explicit_path:
+        return hooks_explicit_path
+    return hooks_implicit_path
+
+
+def _exec_hooks(hooks: Any, data: str) -> None:
+    if isinstance(hooks, list):
+        for exec_line in hooks:
+            # Each exec_line is a path to an executable hook
+            # Split by shell escape
             hook = exec_line.strip()
             _exec_hook_secure(hook, data)
             # Alternative insecure way (vulnerable to injection):
@@ -406,22 +2266,208 @@ def write(
             # if os.path.isfile(command_bin) and os.access(command_bin, os.X_OK):
             #     os.system(hook)
 
-    elif isinstance(hooks, str):
-        exec_line = hooks.strip()
-        _exec_hook_secure(exec_line, data)
-        # Alternative insecure way (vulnerable to injection):
-        # exec_line = exec_line.replace("{}", f'"{data}"')
-        # command_bin = exec_line.split()[0]
-        # if os.path.isfile(command_bin) and os.access(command_bin, os.X_OK):
-        #     os.system(exec_line)
+    elif isinstance(hooks, str):
+        exec_line = hooks.strip()
+        _exec_hook_secure(exec_line, data)
+        # Alternative insecure way (vulnerable to injection):
+        # exec_line = exec_line.replace("{}", f'"{data}"')
+        # command_bin = exec_line.split()[0]
+        # if os.path.isfile(command_bin) and os.access(command_bin, os.X_OK):
+        #     os.system(exec_line)
+
+    else:
+        pass  # No hooks to run
+
+
+_HOOK_WORKERS = 4
+_HOOK_QUEUE_MAX = 256
+
+
+class HookDispatcher:
+    """
+    Bounded worker pool running ActionHooks off the writer's thread.
+
+    Work is coalesced per key: while a key's hooks are queued, newer writes only replace
+    the value they will receive, and a key never runs on two workers at once. When the
+    queue is full, submit() runs the hooks on the writer's thread and try_submit() refuses
+    them. Pending hooks are drained at exit.
+    """
+
+    def __init__(self, workers: int = _HOOK_WORKERS, max_pending: int = _HOOK_QUEUE_MAX):
+        self._workers = workers
+        self._max_pending = max_pending
+        self._cond = threading.Condition()
+        self._pending: Dict[str, Tuple[Any, str]] = {}
+        self._running: set = set()
+        self._threads: List[threading.Thread] = []
+
+    def submit(self, key: str, hooks: Any, data: str) -> None:
+        if not self.try_submit(key, hooks, data):
+            _exec_hooks(hooks, data)
+
+    def try_submit(self, key: str, hooks: Any, data: str) -> bool:
+        """
+        Queue hooks like submit(), but never run them on the caller's thread: returns False,
+        queuing nothing, when the queue is full.
+        """
+        with self._cond:
+            if key not in self._pending and len(self._pending) >= self._max_pending:
+                return False
+            self._pending[key] = (hooks, data)
+            if len(self._threads) < self._workers:
+                t = threading.Thread(target=self._work, name="libreg-hooks", daemon=True)
+                self._threads.append(t)
+                t.start()
+            self._cond.notify()
+        return True
+
+    def _next(self) -> Tuple[str, Any, str]:
+        with self._cond:
+            while True:
+                for key in self._pending:
+                    if key not in self._running:
+                        hooks, data = self._pending.pop(key)
+                        self._running.add(key)
+                        return key, hooks, data
+                self._cond.wait()
+
+    def _work(self) -> None:
+        while True:
+            key, hooks, data = self._next()
+            try:
+                _exec_hooks(hooks, data)
+            finally:
+                with self._cond:
+                    self._running.discard(key)
+                    self._cond.notify_all()
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every queued hook has run. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._running:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+_hook_dispatcher = HookDispatcher()
+atexit.register(_hook_dispatcher.drain)
+
+
+def wait_for_hooks(timeout: Optional[float] = None) -> bool:
+    """
+    Block until hooks dispatched by earlier writes have finished. Returns False on timeout.
+    """
+    return _hook_dispatcher.drain(timeout)
+
+
+def _run_hooks(registry_path: str, rel: str, data: str, key: str, file_path: str, wait: bool = True,
+               tagged: bool = True) -> None:
+    """
+    Run the ActionHooks of a written value, inline when `wait` is set, otherwise through
+    the dispatcher, coalesced on `key` (the canonical hive path of the value).
+    Unless the value was renamed into place from a _WRITER_HOOKS_TAG temp file (`tagged`),
+    values watched by the RegistryPropagator service are left to it.
+    """
+    if not tagged:
+        index = _action_hook_index()
+        if index is not None and index.dispatches(file_path):
+            return
+    hooks = _find_hooks(registry_path, rel)
+    if not hooks or not isinstance(hooks, (list, str)):
+        return  # No hooks to run
+    if wait:
+        _exec_hooks(hooks, data)
+    else:
+        _hook_dispatcher.submit(key, hooks, data)
+
+
+@_profiled("write", 1)
+def write(
+    as_user: str,
+    registry_path: str,
+    value: Any,
+    *,
+    hive_map: Optional[Dict[str, str]] = None,
+    typedef: Optional[str] = None,
+    wait: bool = False,
+) -> None:
+    """
+    Write a value.
+
+    Semantics:
+      - If path starts with a hive (long or short), write ONLY to that hive.
+      - Otherwise, write to HKCU by default.
+      - HKCU and HKLM are always modifiable; other hives depend on their mapped paths.
+      - ActionHooks of the value run in the background, coalesced per value, unless
+        wait=True, which runs them before returning.
+    """
+    expanded_map = _expand_hive_paths(hive_map)
+
+    # regd only writes for root
+    if _regd is not None and os.geteuid() == 0:
+        reply = _regd_request({"op": "write", "user": as_user, "path": registry_path, "value": value,
+                               "typedef": typedef, "wait": wait, "hive_map": expanded_map})
+        if reply is not None:
+            return
+
+    target_hive, root, rel = _resolve_write_target(registry_path, expanded_map)
+
+    # URL Encode patch
+    # base_no_ext = os.path.join(root, rel)
+    base_no_ext = get_encoded_path(root, rel)
+
+    dir_path = os.path.dirname(base_no_ext)
 
+    # Get uid gid of specified user for HKCU ownership
+    uid, gid = _hive_owner(target_hive, as_user)
+    tagged = wait or not os.path.isdir(dir_path)
+
+    # If current hive is HKCU, make sure to set proper ownership (current user)
+    if target_hive == "HKEY_CURRENT_USER":
+        for_user(as_user).ensure_key_dir(root, dir_path)
     else:
-        pass  # No hooks to run
+        _ensure_dir(dir_path)
+
+    file_path, data, text = _encode_value(base_no_ext, value, typedef)
+
+    # This code is unsafe when concurrent writes are possible.
+    # Use code below.
+    # with open(file_path, "w", encoding="utf-8") as f:
+    #     f.write(data)
+
+    temp_file_path = _stage_value_file(file_path, data, tag=_WRITER_HOOKS_TAG if tagged else "")
+    try:
+        os.replace(temp_file_path, file_path)
+        _invalidate_cached(dir_path)
+        _discard_hive_image(target_hive, root)
+
+    except Exception:
+        # Cleanup temp file if something fails
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
 
+    if target_hive == "HKEY_CURRENT_USER":
+        try:
+            os.chown(file_path, uid, gid)
+        except PermissionError:
+            pass  # Ignore if we don't have permission to change ownership
+
+    _run_hooks(registry_path, rel, text, f"{target_hive}/{rel}", file_path, wait, tagged)
+
+
+@_profiled("delete")
 def delete(
     registry_path: str,
     *,
     hive_map: Optional[Dict[str, str]] = None,
+    background: bool = False,
 ) -> bool:
     """
     Delete a value or key.
@@ -429,8 +2475,18 @@ def delete(
     Semantics:
       - If path starts with a hive (long or short), delete ONLY in that hive.
       - Otherwise, delete ONLY in HKCU (no implicit cross-hive deletion).
+      - A key is first renamed out of the hive in one step, so readers see it either
+        whole or gone. With background=True its contents are then removed on a
+        background thread and delete() returns right away.
     """
     expanded_map = _expand_hive_paths(hive_map)
+
+    if _regd is not None and os.geteuid() == 0:
+        reply = _regd_request({"op": "delete", "path": registry_path, "hive_map": expanded_map,
+                               "background": background})
+        if reply is not None:
+            return bool(reply.get("value"))
+
     explicit_hive, rel = _split_hive_and_rel(registry_path)
 
     if explicit_hive:
@@ -444,15 +2500,25 @@ def delete(
     if not root:
         return False
 
-    target = os.path.join(root, rel)
+    _discard_hive_image(target_hive, root)
+    found = False
+    for target in _existing_bases(root, rel):
+        found = _delete_base(root, target, background) or found
+    return found
+
 
+def _delete_base(root: str, target: str, background: bool) -> bool:
     if os.path.isdir(target):
-        for root_dir, dirs, files in os.walk(target, topdown=False):
-            for name in files:
-                os.remove(os.path.join(root_dir, name))
-            for name in dirs:
-                os.rmdir(os.path.join(root_dir, name))
-        os.rmdir(target)
+        moved = _move_to_trash(root, target)
+        _invalidate_cached_tree(target)
+        _invalidate_cached(os.path.dirname(target))
+        if moved is None:
+            # Trash not usable here (e.g. no permission): remove in place
+            _remove_tree(target)
+        elif background:
+            _trash_reaper.submit(moved)
+        else:
+            _remove_tree(moved)
         return True
 
     found = False
@@ -461,9 +2527,921 @@ def delete(
             os.remove(fpath)
             found = True
             break
+    if found:
+        _invalidate_cached(os.path.dirname(target))
     return found
 
 
+# ----------------------------
+# Transactions
+# ----------------------------
+def _trash_dir(root: str) -> str:
+    """
+    Holding area for keys removed from a hive: a sibling of the hive root, so it is on
+    the same filesystem (rename works) but never shows up in key listings.
+    """
+    return os.path.normpath(root) + ".trash"
+
+
+_TRASH_DELETED_SUFFIX = ".deleted"
+
+
+def _move_to_trash(root: str, path: str) -> Optional[str]:
+    """
+    Rename a key directory into the hive's trash. Returns where it went, or None if it
+    could not be moved.
+    """
+    trash = _trash_dir(root)
+    moved = os.path.join(trash, uuid.uuid4().hex + _TRASH_DELETED_SUFFIX)
+    try:
+        if not os.path.isdir(trash):
+            _ensure_dir(trash)
+            # The trash belongs to whoever owns the hive (HKCU: its user)
+            st = os.stat(root)
+            try:
+                os.chown(trash, st.st_uid, st.st_gid)
+            except PermissionError:
+                pass
+        os.rename(path, moved)
+    except OSError:
+        return None
+    return moved
+
+
+def _remove_tree(path: str) -> None:
+    """
+    Remove a directory tree. Works relative to open directory descriptors (unlinkat and
+    friends through dir_fd) and reads each directory once with os.scandir, so no full
+    path is resolved again per entry.
+    """
+    parent_fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        _remove_tree_at(parent_fd, os.path.basename(path))
+    finally:
+        os.close(parent_fd)
+
+
+def _remove_tree_at(parent_fd: int, name: str) -> None:
+    fd = os.open(name, os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW, dir_fd=parent_fd)
+    try:
+        with os.scandir(fd) as it:
+            entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in it]
+        for entry_name, is_dir in entries:
+            if is_dir:
+                _remove_tree_at(fd, entry_name)
+            else:
+                os.unlink(entry_name, dir_fd=fd)
+    finally:
+        os.close(fd)
+    os.rmdir(name, dir_fd=parent_fd)
+
+
+class _TrashReaper:
+    """
+    Removes keys deleted with background=True from the trash on a background thread.
+    Leftovers of earlier processes are picked up the next time the same trash is used.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending: List[str] = []
+        self._queued: set = set()
+        self._busy = False
+        self._thread: Optional[threading.Thread] = None
+
+    def submit(self, path: str) -> None:
+        trash = os.path.dirname(path)
+        try:
+            leftovers = [os.path.join(trash, name) for name in os.listdir(trash) if name.endswith(_TRASH_DELETED_SUFFIX)]
+        except OSError:
+            leftovers = []
+        with self._cond:
+            for item in [path] + leftovers:
+                if item not in self._queued:
+                    self._queued.add(item)
+                    self._pending.append(item)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name="libreg-reaper", daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def _work(self) -> None:
+        while True:
+            with self._cond:
+                while not self._pending:
+                    self._cond.wait()
+                path = self._pending.pop(0)
+                self._busy = True
+            try:
+                _remove_tree(path)
+            except OSError:
+                pass  # Gone already, or reaped by another process
+            finally:
+                with self._cond:
+                    self._queued.discard(path)
+                    self._busy = False
+                    self._cond.notify_all()
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until every submitted key is removed. Returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._pending or self._busy:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+
+_trash_reaper = _TrashReaper()
+
+
+def wait_for_deletes(timeout: Optional[float] = None) -> bool:
+    """
+    Wait until keys deleted with background=True are gone from disk.
+    Returns False on timeout.
+    """
+    return _trash_reaper.drain(timeout)
+
+
+class RegistryTransaction:
+    """
+    A batch of writes and deletes applied all-or-nothing by commit().
+
+    Staged operations touch nothing until commit. Commit writes every temp file, flushes
+    each hive filesystem once with syncfs, swaps the files into place and flushes again
+    (fsyncing every temp file and touched key directory where syncfs is missing). If any
+    step fails, already applied steps are undone and the error is re-raised. ActionHooks run once per written path, after a
+    successful commit, with the last value written to it; in the background unless the
+    transaction was created with wait=True.
+
+    With workers > 1, the file work of independent subtrees (keys directly below a hive
+    root) is spread over that many threads: staging, fsyncs and cleanup. The swap into
+    place stays in order on the calling thread.
+
+    Use through transaction():
+
+        with libreg.transaction("root") as tx:
+            tx.write("HKLM/SYSTEM/Foo/Bar", 1)
+            tx.create_key("HKLM/SYSTEM/Foo/Empty")
+            tx.delete("HKLM/SYSTEM/Foo/Old")
+    """
+
+    def __init__(self, as_user: str, *, hive_map: Optional[Dict[str, str]] = None, wait: bool = False,
+                 workers: int = 1):
+        self.as_user = as_user
+        self.wait = wait
+        self.workers = workers
+        self._expanded_map = _expand_hive_paths(hive_map)
+        self._ops: List[Tuple[str, str, Any, Optional[str]]] = []
+        self.committed = False
+
+    def write(self, registry_path: str, value: Any, *, typedef: Optional[str] = None) -> None:
+        # Resolve now so that bad paths and values fail at the call site
+        _target_hive, root, rel = _resolve_write_target(registry_path, self._expanded_map)
+        _encode_value(get_encoded_path(root, rel), value, typedef)
+        self._ops.append(("write", registry_path, value, typedef))
+
+    def create_key(self, registry_path: str) -> None:
+        _resolve_write_target(registry_path, self._expanded_map)
+        self._ops.append(("key", registry_path, None, None))
+
+    def delete(self, registry_path: str) -> None:
+        _resolve_write_target(registry_path, self._expanded_map)
+        self._ops.append(("delete", registry_path, None, None))
+
+    def __len__(self) -> int:
+        return len(self._ops)
+
+    def commit(self) -> None:
+        if self.committed:
+            raise RuntimeError("Transaction already committed.")
+
+        # (kind, path, backup path or None); undone in reverse order on failure
+        applied: List[Tuple[str, str, Optional[str]]] = []
+        staging_dirs: Dict[str, None] = {}
+        created_dirs: List[str] = []
+        new_dirs: set = set()  # Every key directory this commit created
+        tagged: set = set()  # Values renamed into place via a _WRITER_HOOKS_TAG name
+        touched_dirs: Dict[str, None] = {}
+        trashed: List[str] = []
+        owned: Dict[str, Tuple[str, int, int]] = {}
+        owned_keys: Dict[str, str] = {}
+        hooks: Dict[str, Tuple[str, str, str, str]] = {}
+        imaged: Dict[str, str] = {}
+        txid = uuid.uuid4().hex
+
+        try:
+            # 1. Stage every written value in a per-hive staging area.
+            #    Key directories are not touched yet, so a staged delete of a key followed by
+            #    writes below it works.
+            staged: List[Tuple[str, str, str, str]] = []
+            staging_writes: Dict[Tuple[str, str], List[Tuple[str, bytes, str]]] = {}
+            for kind, registry_path, value, typedef in self._ops:
+                target_hive, root, rel = _resolve_write_target(registry_path, self._expanded_map)
+                base_no_ext = get_encoded_path(root, rel)
+                if kind == "write":
+                    file_path, data, text = _encode_value(base_no_ext, value, typedef)
+                    staging = os.path.join(_trash_dir(root), f"{txid}.staging")
+                    if staging not in staging_dirs:
+                        _ensure_dir(staging)
+                        staging_dirs[staging] = None
+                    temp_file_path = os.path.join(staging, str(len(staged)))
+                    staging_writes.setdefault(_subtree_of(root, file_path), []).append((temp_file_path, data, file_path))
+                    staged.append((kind, file_path, temp_file_path, root))
+                    if target_hive == "HKEY_CURRENT_USER":
+                        owned[file_path] = (root,) + _hive_owner(target_hive, self.as_user)
+                    hooks[registry_path] = (rel, text, f"{target_hive}/{rel}", file_path)
+                elif kind == "key":
+                    staged.append((kind, base_no_ext, "", root))
+                    if target_hive == "HKEY_CURRENT_USER":
+                        owned_keys[base_no_ext] = root
+                else:
+                    staged.extend((kind, base, "", root) for base in _existing_bases(root, rel))
+                imaged[root] = target_hive
+
+            # One syncfs per hive filesystem makes the staged files durable; without it every
+            # file is fsynced as it is written
+            batched = _libc_syncfs is not None
+            _run_grouped(functools.partial(_stage_files, durable=not batched), staging_writes.values(), self.workers)
+            if batched and staging_dirs and not _syncfs(staging_dirs):
+                batched = False
+                _run_grouped(_stage_files, staging_writes.values(), self.workers)
+
+            # Images of the hives about to change are stale from here on
+            for root, target_hive in imaged.items():
+                _discard_hive_image(target_hive, root)
+
+            # 2. Swap everything into place, keeping what it replaces for rollback
+            for kind, path, temp_file_path, root in staged:
+                if kind == "write":
+                    dir_path = os.path.dirname(path)
+                    if not os.path.isdir(dir_path):
+                        top = dir_path
+                        while not os.path.exists(os.path.dirname(top)):
+                            top = os.path.dirname(top)
+                        _ensure_dir(dir_path)
+                        created_dirs.append(top)
+                        new_dirs.update(_dirs_between(top, dir_path))
+                        touched_dirs.update(dict.fromkeys(_dirs_between(os.path.dirname(top), dir_path)))
+                    backup = None
+                    if os.path.exists(path):
+                        backup = f"{path}.txbak.{txid}.{len(applied)}"
+                        os.link(path, backup)
+                    applied.append(("write", path, backup))
+                    if self.wait or dir_path in new_dirs:
+                        # Staged outside the hive, so move next to the value first: the
+                        # service only sees where a rename came from within its watches
+                        tag_path = f"{path}{_WRITER_HOOKS_TAG}.tmp.{txid}.{len(applied)}"
+                        os.rename(temp_file_path, tag_path)
+                        try:
+                            os.replace(tag_path, path)
+                        except OSError:
+                            os.remove(tag_path)
+                            raise
+                        tagged.add(path)
+                    else:
+                        os.replace(temp_file_path, path)
+                    touched_dirs[dir_path] = None
+                elif kind == "key":
+                    if os.path.isdir(path):
+                        continue
+                    top = path
+                    while not os.path.exists(os.path.dirname(top)):
+                        top = os.path.dirname(top)
+                    _ensure_dir(path)
+                    created_dirs.append(top)
+                    new_dirs.update(_dirs_between(top, path))
+                    touched_dirs.update(dict.fromkeys(_dirs_between(os.path.dirname(top), path)))
+                elif os.path.isdir(path):
+                    trash = _trash_dir(root)
+                    _ensure_dir(trash)
+                    moved = os.path.join(trash, f"{txid}.{len(applied)}")
+                    os.rename(path, moved)
+                    applied.append(("delete_key", path, moved))
+                    trashed.append(moved)
+                    touched_dirs[os.path.dirname(path)] = None
+                else:
+                    file_path = _detect_value_file(path)
+                    if file_path is None:
+                        continue
+                    backup = f"{file_path}.txbak.{txid}.{len(applied)}"
+                    os.rename(file_path, backup)
+                    applied.append(("delete_value", file_path, backup))
+                    touched_dirs[os.path.dirname(file_path)] = None
+                # Later operations must see the new state of this directory
+                _invalidate_cached(os.path.dirname(path))
+                _invalidate_cached(path)
+
+        except Exception:
+            self._rollback(applied, created_dirs)
+            for staging in staging_dirs:
+                shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+        # 3. Make the new directory entries durable (those of created keys too): one syncfs
+        #    per hive filesystem, or one fsync per touched key without it
+        roots = {root for _kind, _path, _temp, root in staged}
+        if not (batched and _syncfs(roots)):
+            fsyncs: Dict[Tuple[str, str], List[str]] = {}
+            for dir_path in touched_dirs:
+                fsyncs.setdefault(_subtree_of_any(roots, dir_path), []).append(dir_path)
+            _run_grouped(lambda dirs: [_fsync_dir(d) for d in dirs], fsyncs.values(), self.workers)
+
+        self.committed = True
+        for staging in staging_dirs:
+            shutil.rmtree(staging, ignore_errors=True)
+        leftovers: Dict[Tuple[str, str], List[str]] = {}
+        for kind, path, backup in applied:
+            if kind != "delete_key" and backup is not None:
+                leftovers.setdefault(_subtree_of_any(roots, path), []).append(backup)
+        for moved in trashed:
+            leftovers.setdefault(("", moved), []).append(moved)
+        _run_grouped(_remove_leftovers, leftovers.values(), self.workers)
+
+        if owned or owned_keys:
+            context = for_user(self.as_user)
+            for top in created_dirs:
+                context.forget(top)
+            for root in {root for root, _uid, _gid in owned.values()} | set(owned_keys.values()):
+                context.adopt_key_dirs(root, _trash_dir(root))
+            for key_path, root in owned_keys.items():
+                context.adopt_key_dirs(root, key_path)
+        for file_path, (root, uid, gid) in owned.items():
+            context.adopt_key_dirs(root, os.path.dirname(file_path))
+            try:
+                os.chown(file_path, uid, gid)
+            except (PermissionError, FileNotFoundError):
+                pass  # Ignore if we don't have permission to change ownership
+
+        for registry_path, (rel, data, key, file_path) in hooks.items():
+            _run_hooks(registry_path, rel, data, key, file_path, self.wait, file_path in tagged)
+
+    def _rollback(self, applied: List[Tuple[str, str, Optional[str]]], created_dirs: List[str]) -> None:
+        for kind, path, backup in reversed(applied):
+            try:
+                if kind == "write":
+                    if backup is not None:
+                        os.replace(backup, path)
+                    elif os.path.exists(path):
+                        os.remove(path)
+                else:
+                    os.rename(backup, path)
+            except OSError as e:
+                print(f"Warning: Failed to roll back '{path}': {e}")
+            _invalidate_cached(os.path.dirname(path))
+            _invalidate_cached(path)
+        for top in reversed(created_dirs):
+            if os.path.isdir(top):
+                try:
+                    for root_dir, dirs, files in os.walk(top, topdown=False):
+                        os.rmdir(root_dir)
+                except OSError:
+                    pass  # Not ours alone any more
+
+
+def _dirs_between(top: str, path: str) -> List[str]:
+    """
+    `path` and its parents up to and including `top`.
+    """
+    dirs = [path]
+    while path != top and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+        dirs.append(path)
+    return dirs
+
+
+def _subtree_of(root: str, path: str) -> Tuple[str, str]:
+    """
+    (hive root, key directly below it) that `path` belongs to.
+    """
+    return root, os.path.relpath(path, root).split(os.sep, 1)[0]
+
+
+def _subtree_of_any(roots: set, path: str) -> Tuple[str, str]:
+    for root in roots:
+        if path == root or path.startswith(root + os.sep):
+            return _subtree_of(root, path)
+    return "", path
+
+
+def _stage_files(writes: List[Tuple[str, bytes, str]], durable: bool = True) -> None:
+    for temp_file_path, data, file_path in writes:
+        with open(temp_file_path, "wb") as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        if os.path.exists(file_path):
+            shutil.copymode(file_path, temp_file_path)
+
+
+def _remove_leftovers(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                _remove_tree(path)
+            else:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _run_grouped(job: Callable[[Any], Any], groups: Any, workers: int) -> None:
+    """
+    Call job(group) for every group, on up to `workers` threads. Re-raises the first error.
+    """
+    groups = list(groups)
+    if workers <= 1 or len(groups) <= 1:
+        for group in groups:
+            job(group)
+        return
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="libreg-tx") as pool:
+        for future in [pool.submit(job, group) for group in groups]:
+            future.result()
+
+
+@contextlib.contextmanager
+def transaction(as_user: str, *, hive_map: Optional[Dict[str, str]] = None, wait: bool = False,
+                workers: int = 1):
+    """
+    Context manager yielding a RegistryTransaction that commits when the block exits
+    normally. If the block raises, nothing staged is applied.
+    """
+    tx = RegistryTransaction(as_user, hive_map=hive_map, wait=wait, workers=workers)
+    yield tx
+    tx.commit()
+
+
+def _parse_regtree_line(line: str) -> Optional[Tuple[str, str, Optional[str], Optional[str]]]:
+    """
+    (flag, path, type, raw value) of a .regtree line, or None for blank lines and comments.
+    flag is "?", "-" or ""; type and raw value are None for a key line.
+    """
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    flag = ""
+    if line[0] in "?-":
+        flag = line[0]
+        line = line[1:].strip()
+    if "=" not in line:
+        return flag, line, None, None
+    key_path, raw_value = line.split("=", 1)
+    key_path = key_path.strip()
+    typedef = None
+    if ":" in key_path:
+        key_path, typedef = key_path.rsplit(":", 1)
+        key_path = key_path.strip()
+    return flag, key_path, typedef, raw_value.strip()
+
+
+class UserContext:
+    """
+    One user's view of the registry: HKCU is that user's hive, and what gets written
+    there belongs to them. Get one with for_user().
+
+    The user's uid/gid and hive root are looked up once. Key directories already known
+    to belong to the user are remembered, so writing many values chowns only the
+    directories that get created on the way (or had a wrong owner when first seen).
+    """
+
+    def __init__(self, name: str):
+        import pwd
+        pw_record = pwd.getpwnam(name)
+        self.name = name
+        self.uid = pw_record.pw_uid
+        self.gid = pw_record.pw_gid
+        self.home = pw_record.pw_dir
+        self.hive_map = _HIVE_MAP.copy()
+        self.hive_map["HKEY_CURRENT_USER"] = os.path.join(self.home, _DEFAULT_LOCAL_PATH)
+        self._owned: set = set()
+
+    def read(self, registry_path: str, default: Any = None) -> Any:
+        return read(registry_path, default, hive_map=self.hive_map)
+
+    def write(self, registry_path: str, value: Any, *, typedef: Optional[str] = None, wait: bool = False) -> None:
+        write(self.name, registry_path, value, hive_map=self.hive_map, typedef=typedef, wait=wait)
+
+    def delete(self, registry_path: str, *, background: bool = False) -> bool:
+        return delete(registry_path, hive_map=self.hive_map, background=background)
+
+    def transaction(self, *, wait: bool = False, workers: int = 1):
+        return transaction(self.name, hive_map=self.hive_map, wait=wait, workers=workers)
+
+    def ensure_key_dir(self, root: str, dir_path: str) -> None:
+        """
+        Create dir_path below the hive root if needed, owned by this user.
+        """
+        if dir_path in self._owned and os.path.isdir(dir_path):
+            return
+        current = dir_path
+        while not os.path.isdir(current):
+            self._owned.discard(current)  # Removed since we last saw it
+            if len(current) <= len(root):
+                break
+            current = os.path.dirname(current)
+        _ensure_dir(dir_path)
+        self.adopt_key_dirs(root, dir_path)
+
+    def adopt_key_dirs(self, root: str, dir_path: str) -> None:
+        """
+        chown the hive root and every directory down to dir_path to this user, skipping
+        those already known to be theirs.
+        """
+        paths = []
+        current = dir_path
+        while current not in self._owned:
+            paths.append(current)
+            if len(current) <= len(root):
+                break
+            current = os.path.dirname(current)
+        for path in reversed(paths):
+            try:
+                st = os.stat(path)
+                if (st.st_uid, st.st_gid) != (self.uid, self.gid):
+                    os.chown(path, self.uid, self.gid)
+            except PermissionError:
+                continue  # Ignore if we don't have permission to change ownership
+            except FileNotFoundError:
+                return
+            self._owned.add(path)
+
+    def forget(self, dir_path: str) -> None:
+        """
+        Stop assuming dir_path and the directories below it belong to this user.
+        """
+        prefix = dir_path + os.sep
+        self._owned = {path for path in self._owned if path != dir_path and not path.startswith(prefix)}
+
+
+@functools.lru_cache(maxsize=64)
+def for_user(name: str) -> UserContext:
+    """
+    The UserContext of a user, created on first use. Raises KeyError for unknown users.
+
+        alice = libreg.for_user("alice")
+        alice.write("HKCU/Desktop/Wallpaper", "/usr/share/backgrounds/sea.png")
+    """
+    return UserContext(name)
+
+
+_INSTALL_WORKERS = min(8, os.cpu_count() or 1)
+
+
+class _ExistenceIndex:
+    """
+    Whether registry paths exist, as `read(path) is not None` would tell, answered from
+    one os.scandir per key directory however many paths are asked about.
+    """
+
+    def __init__(self, expanded_map: Dict[str, str]):
+        self._expanded_map = expanded_map
+        self._dirs: Dict[str, Optional[Tuple[Dict[str, Tuple[str, str]], set]]] = {}
+
+    def _entries(self, dir_path: str) -> Optional[Tuple[Dict[str, Tuple[str, str]], set]]:
+        if dir_path not in self._dirs:
+            index = _scan_key_dir(dir_path)
+            self._dirs[dir_path] = None if index is None else (index.values, set(index.subkeys))
+        return self._dirs[dir_path]
+
+    def exists(self, registry_path: str) -> bool:
+        _explicit, bases = _candidate_bases(registry_path, self._expanded_map)
+        for base in bases:
+            base = os.path.normpath(base)
+            entries = self._entries(os.path.dirname(base))
+            if entries is None:
+                continue
+            name = os.path.basename(base)
+            if name in entries[0] or name in entries[1]:
+                return True
+        return False
+
+
+def install(
+    as_user: str,
+    regtree_path: str,
+    *,
+    hive_map: Optional[Dict[str, str]] = None,
+    quiet: bool = False,
+    dry_run: bool = False,
+    workers: Optional[int] = None,
+) -> List[Tuple[str, str]]:
+    """
+    Install a .regtree file as one transaction, and return the plan: (action, line) pairs
+    with action "write", "key", "delete" or "skip", in file order.
+
+    Each line is `path:type=value` (a value) or `path` (a key); `#` starts a comment,
+    a leading `?` skips the line if the key or value already exists and a leading `-`
+    deletes the key or value instead.
+
+    The whole file is planned before anything is written: `?` lines are checked against
+    the hives with one directory scan per key and against earlier lines of the file.
+    With dry_run=True the plan is only reported. `workers` threads share the file work
+    of independent subtrees (default: up to 8, one per CPU).
+    """
+    with open(regtree_path, "r", encoding="utf-8") as f:
+        lines = [parsed for parsed in map(_parse_regtree_line, f.read().splitlines()) if parsed is not None]
+
+    def report(message: str) -> None:
+        if not quiet:
+            print(f"[dry run] {message}" if dry_run else message)
+
+    on_disk = _ExistenceIndex(_expand_hive_paths(hive_map))
+    # Paths written or created by earlier lines; they are not on disk yet
+    planned_paths = set()
+
+    def exists(key_path: str) -> bool:
+        return key_path.strip("/") in planned_paths or on_disk.exists(key_path)
+
+    def plan_path(key_path: str) -> None:
+        parts = key_path.strip("/").split("/")
+        for i in range(1, len(parts) + 1):
+            planned_paths.add("/".join(parts[:i]))
+
+    plan: List[Tuple[str, str]] = []
+    ops: List[Tuple[str, str, Optional[str], Optional[str]]] = []
+    for flag, key_path, typedef, raw_value in lines:
+        if flag == "-":
+            ops.append(("delete", key_path, None, None))
+            planned_paths.discard(key_path.strip("/"))
+            plan.append(("delete", key_path))
+            report(f"Deleted '{key_path}'")
+        elif raw_value is not None:
+            if flag == "?" and exists(key_path):
+                plan.append(("skip", key_path))
+                report(f"Skipping existing key/value '{key_path}'")
+                continue
+            ops.append(("write", key_path, typedef, raw_value))
+            plan_path(key_path)
+            plan.append(("write", f"{key_path}:{typedef}={raw_value}" if typedef else f"{key_path}={raw_value}"))
+            report(f"Wrote '{key_path}': {raw_value}")
+        else:
+            if flag == "?" and exists(key_path):
+                plan.append(("skip", key_path))
+                report(f"Skipping existing key '{key_path}'")
+                continue
+            ops.append(("key", key_path, None, None))
+            plan_path(key_path)
+            plan.append(("key", key_path))
+            report(f"Created key '{key_path}'")
+
+    if dry_run:
+        return plan
+
+    with transaction(as_user, hive_map=hive_map, workers=_INSTALL_WORKERS if workers is None else workers) as tx:
+        for action, key_path, typedef, raw_value in ops:
+            if action == "write":
+                tx.write(key_path, raw_value, typedef=typedef)
+            elif action == "key":
+                tx.create_key(key_path)
+            else:
+                tx.delete(key_path)
+    return plan
+
+
+# ----------------------------
+# Change notifications
+# ----------------------------
+class RegistryChange:
+    """
+    One change below a watched prefix.
+
+    hive: canonical hive the change happened in
+    path: full registry path, e.g. HKEY_LOCAL_MACHINE/SYSTEM/Services/x/Latency
+    kind: "write" (value written), "delete" (value or key removed), "key" (key created)
+    """
+    __slots__ = ("hive", "path", "kind")
+
+    def __init__(self, hive: str, path: str, kind: str):
+        self.hive = hive
+        self.path = path
+        self.kind = kind
+
+    def __repr__(self) -> str:
+        return f"RegistryChange({self.kind} {self.path})"
+
+    def __eq__(self, other: Any) -> bool:
+        return isinstance(other, RegistryChange) and (self.hive, self.path, self.kind) == (other.hive, other.path, other.kind)
+
+
+class _ChangeStream:
+    """
+    inotify watches for one prefix in every hive it resolves to.
+
+    The key (or value) itself is watched recursively and its parent directory without
+    recursion, so values at the prefix and creation or removal of the key are seen too.
+    Where the prefix does not exist yet, its deepest existing ancestor is watched until it does.
+    Keys that appear with contents already in them (created in a burst, or moved in) have
+    those contents reported as well, as a watch on them cannot have seen them arrive.
+    """
+
+    def __init__(self, prefix: str, hive_map: Optional[Dict[str, str]] = None):
+        if pyinotify is None:
+            raise RuntimeError("Registry change notifications need pyinotify.")
+        expanded_map = _expand_hive_paths(hive_map)
+        explicit_hive, rel = _split_hive_and_rel(prefix)
+        rel = rel.strip("/")
+
+        # (hive, root, base): base is the watched key or value path without type extension
+        self._targets: List[Tuple[str, str, str]] = []
+        for hive in ([explicit_hive] if explicit_hive else _priority_hives()):
+            root = expanded_map.get(hive)
+            if root:
+                root = os.path.normpath(root)
+                for base in (_hive_bases(root, rel) if rel else [root]):
+                    self._targets.append((hive, root, base))
+
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._wm, default_proc_fun=self._on_event)
+        self._pending: List[RegistryChange] = []
+        self._rearm = False
+        self._arm(initial=True)
+
+    _MASK = 0 if pyinotify is None else (
+        pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE
+        | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF
+    )
+
+    def _add(self, path: str, rec: bool) -> bool:
+        if self._wm.get_wd(path) is not None:
+            return False
+        self._wm.add_watch(path, self._MASK, rec=rec, auto_add=rec, quiet=True)
+        return True
+
+    def _arm(self, initial: bool = False) -> None:
+        self._rearm = False
+        for hive, root, base in self._targets:
+            if os.path.isdir(base) and self._add(base, rec=True) and not initial:
+                self._pending.append(self._to_change(hive, root, base, "key"))
+                self._report_contents(hive, root, base)
+            anchor = os.path.dirname(base)
+            while not os.path.isdir(anchor) and anchor != os.path.dirname(anchor):
+                anchor = os.path.dirname(anchor)
+            if self._add(anchor, rec=False) and not initial and anchor == os.path.dirname(base):
+                index = _scan_key_dir(anchor)
+                hit = index.values.get(os.path.basename(base)) if index is not None else None
+                if hit is not None:
+                    self._pending.append(self._to_change(hive, root, base, "write"))
+
+    def _report_contents(self, hive: str, root: str, dir_path: str) -> None:
+        for current, dirs, files in os.walk(dir_path):
+            for name in dirs:
+                self._pending.append(self._to_change(hive, root, os.path.join(current, name), "key"))
+            for name in files:
+                try:
+                    key, type_ext, rv = name.rsplit(".", 2)
+                except ValueError:
+                    continue
+                if rv == "rv" and type_ext in _TYPES_AVAILABLE:
+                    self._pending.append(self._to_change(hive, root, os.path.join(current, key), "write"))
+
+    @staticmethod
+    def _to_change(hive: str, root: str, key: str, kind: str) -> RegistryChange:
+        rel = "" if key == root else os.path.relpath(key, root)
+        parts = [decode_key(p) for p in rel.split(os.sep)] if rel else []
+        return RegistryChange(hive, "/".join([hive] + parts), kind)
+
+    def _on_event(self, event) -> None:
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            print("Warning: Registry change notifications overflowed; some changes were not reported.")
+            return
+        if event.mask & (pyinotify.IN_IGNORED | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF):
+            self._rearm = True
+            return
+        if event.dir:
+            # A key on the way to a prefix may have appeared, or the prefix may be gone
+            self._rearm = True
+        change = self._change_of(event)
+        if change is not None:
+            self._pending.append(change)
+            if change.kind == "key":
+                target = next(t for t in self._targets if change.hive == t[0] and event.pathname.startswith(t[1]))
+                self._report_contents(change.hive, target[1], event.pathname)
+
+    def _change_of(self, event) -> Optional[RegistryChange]:
+        path = event.pathname
+        for hive, root, base in self._targets:
+            if event.dir:
+                if path != base and not path.startswith(base + os.sep):
+                    continue
+                key = path
+                kind = "key" if event.mask & (pyinotify.IN_CREATE | pyinotify.IN_MOVED_TO) else "delete"
+            else:
+                if not path.endswith(".rv") or not (path.startswith(base + ".") or path.startswith(base + os.sep)):
+                    continue
+                try:
+                    key, type_ext, _rv = path.rsplit(".", 2)
+                except ValueError:
+                    continue
+                if type_ext not in _TYPES_AVAILABLE or (key != base and not key.startswith(base + os.sep)):
+                    continue
+                if event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO):
+                    kind = "write"
+                elif event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+                    kind = "delete"
+                else:
+                    continue  # Created; reported once written
+            return self._to_change(hive, root, key, kind)
+        return None
+
+    def poll(self, timeout: Optional[float]) -> List[RegistryChange]:
+        """
+        Changes that arrived within `timeout` seconds (None = wait for any).
+        """
+        if self._notifier.check_events(timeout=None if timeout is None else int(timeout * 1000)):
+            self._notifier.read_events()
+            self._notifier.process_events()
+        if self._rearm:
+            self._arm()
+        changes, self._pending = self._pending, []
+        return changes
+
+    def close(self) -> None:
+        self._notifier.stop()
+
+
+def changes(
+    prefix: str = "",
+    *,
+    hive_map: Optional[Dict[str, str]] = None,
+    timeout: Optional[float] = None,
+) -> Iterator[RegistryChange]:
+    """
+    Yield a RegistryChange for every value written or removed and every key created or
+    removed at or below `prefix`, as they happen.
+
+    Hive resolution is as for read(): an explicit hive is watched alone, otherwise every
+    hive in _PRIORITY is. Watches are in place when this returns, before iteration starts.
+    With `timeout`, iteration ends after that many seconds without a change.
+    """
+    return _iter_changes(_ChangeStream(prefix, hive_map), timeout)
+
+
+def _iter_changes(stream: _ChangeStream, timeout: Optional[float]) -> Iterator[RegistryChange]:
+    try:
+        while True:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            batch: List[RegistryChange] = []
+            while not batch:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return
+                batch = stream.poll(remaining)
+            yield from batch
+    finally:
+        stream.close()
+
+
+class RegistryWatch:
+    """
+    A background thread calling `callback(change)` for each change below a prefix.
+    See watch().
+    """
+
+    _POLL_SECONDS = 0.2
+
+    def __init__(self, prefix: str, callback: Callable[[RegistryChange], Any], hive_map: Optional[Dict[str, str]] = None):
+        self.prefix = prefix
+        self._callback = callback
+        self._stream = _ChangeStream(prefix, hive_map)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"libreg-watch {prefix}", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        try:
+            while not self._stop.is_set():
+                for change in self._stream.poll(self._POLL_SECONDS):
+                    try:
+                        self._callback(change)
+                    except Exception as e:
+                        print(f"Warning: Registry watch callback failed for '{change.path}': {e}")
+        finally:
+            self._stream.close()
+
+    def stop(self, timeout: Optional[float] = None) -> None:
+        self._stop.set()
+        if threading.current_thread() is not self._thread:
+            self._thread.join(timeout)
+
+
+def watch(
+    registry_path: str,
+    callback: Callable[[RegistryChange], Any],
+    *,
+    hive_map: Optional[Dict[str, str]] = None,
+) -> RegistryWatch:
+    """
+    Call `callback(change)` from a background thread for every change at or below
+    `registry_path` (see changes()). Returns the watch; stop() ends it.
+    """
+    return RegistryWatch(registry_path, callback, hive_map)
+
+
 # ----------------------------
 # CLI utility
 # ----------------------------
@@ -483,22 +3461,37 @@ def _infer_scalar_or_list(raw: str) -> Any:
         return raw
 
 
+def _print_profile_stats(stats: Dict[str, List[Dict[str, Any]]]) -> None:
+    if not any(stats.values()):
+        print(f"No profile data in {_PROFILE_RING}. Set {_PROFILE_ENV}=1 or "
+              f"HKLM/{_PROFILE_FLAG} to true to record some.")
+        return
+    titles = (("keys", "Hottest keys"), ("hives", "Slowest hives"), ("callers", "Worst callers"))
+    for n, (group, title) in enumerate(titles):
+        if n:
+            print()
+        print(title)
+        print(f"  {'calls':>8} {'read':>8} {'write':>7} {'delete':>6} {'mean us':>9} {'total ms':>10} {'hit %':>6}  name")
+        for row in stats[group]:
+            hit_rate = "-" if row["hit_rate"] is None else f"{row['hit_rate'] * 100:.1f}"
+            print(f"  {row['calls']:>8} {row['read']:>8} {row['write']:>7} {row['delete']:>6} "
+                  f"{row['mean_us']:>9.1f} {row['total_us'] / 1000:>10.1f} {hit_rate:>6}  {row['name'] or '/'}")
+
+
 def _main():
     import sys
 
-    if len(sys.argv) < 4:
+    # stats is the only action without a registry path
+    if len(sys.argv) < 4 and not (len(sys.argv) == 3 and sys.argv[2].lower() == "stats"):
         print("Usage: python libreg.py <user> <action> <registry_path> [type (for write)] [value (for write)]")
         return
 
     user = sys.argv[1]
     action = sys.argv[2].lower()
-    path = sys.argv[3]
+    path = sys.argv[3] if len(sys.argv) >= 4 else ""
 
     # Update hive map to set HKCU to the specified user's home
-    custom_hive_map = _HIVE_MAP.copy()
-    custom_hive_map["HKEY_CURRENT_USER"] = os.path.join(
-        os.path.expanduser(f"~{user}"), _DEFAULT_LOCAL_PATH
-    )
+    custom_hive_map = user_hive_map(user)
 
     if action == "read":
         default = None
@@ -516,56 +3509,48 @@ def _main():
         write(user, path, value, hive_map=custom_hive_map, typedef=typedef)
         # print(f"Wrote to '{path}': {value}")
     elif action == "install":
-        # Read a file as an input value
-        if len(sys.argv) < 4:
+        # One or more .regtree files, installed in order; --dry-run only prints the plan
+        dry_run = "--dry-run" in sys.argv[3:]
+        file_paths = [arg for arg in sys.argv[3:] if arg != "--dry-run"]
+        if not file_paths:
             print("File path is required for install action.")
             return
-        file_path = sys.argv[3]
-        if not os.path.isfile(file_path):
-            print(f"File '{file_path}' does not exist.")
+        for file_path in file_paths:
+            if not os.path.isfile(file_path):
+                print(f"File '{file_path}' does not exist.")
+                return
+        for file_path in file_paths:
+            try:
+                install(user, file_path, hive_map=custom_hive_map, dry_run=dry_run)
+            except Exception as e:
+                # Each file is its own transaction; the others still go in
+                print(f"Failed to install '{file_path}': {e}")
+    elif action == "compact":
+        # Path is the hive to compile, e.g. HKLM
+        print(f"Compacted {path} into {compact(path, hive_map=custom_hive_map)}")
+    elif action == "export":
+        # .regtree lines of the key and everything below it
+        for line in export(path, hive_map=custom_hive_map):
+            print(line)
+    elif action == "diff":
+        # .regtree lines turning the first key or .regtree file into the second
+        if len(sys.argv) < 5:
+            print("A second key or .regtree file is required for diff action.")
             return
-        with open(file_path, "r", encoding="utf-8") as f:
-            file_content = f.read()
-
-        # For each line, parse it.
-        # If line begins with #, skip it (comment)
-        # If line begins with ? and such key or value exists, skip it
-        # If the line does not contain '=', treat it as a key creation
-        # For each line it looks like: name:type=value
-        for line in file_content.splitlines():
-            line = line.strip()
-            if not line or line.startswith("#"):
-                continue
-            skip_if_exists = False
-            if line.startswith("?"):
-                skip_if_exists = True
-                line = line[1:].strip()
-            if "=" in line:
-                key_path, raw_value = line.split("=", 1)
-                key_path = key_path.strip()
-                typedef = key_path.rsplit(":")[-1] if ":" in key_path else None
-                if ":" in key_path:
-                    key_path = key_path.rsplit(":", 1)[0].strip()
-                raw_value = raw_value.strip()
-                if skip_if_exists:
-                    existing = read(key_path, default=None, hive_map=custom_hive_map)
-                    if existing is not None:
-                        print(f"Skipping existing key/value '{key_path}'")
-                        continue
-                write(user, key_path, raw_value, hive_map=custom_hive_map, typedef=typedef)
-                print(f"Wrote '{key_path}': {raw_value}")
-            else:
-                key_path = line
-                if skip_if_exists:
-                    existing = read(key_path, default=None, hive_map=custom_hive_map)
-                    if existing is not None:
-                        print(f"Skipping existing key '{key_path}'")
-                        continue
-                # Create the key by writing a dummy value and then deleting it
-                write(user, os.path.join(key_path, "__dummy__"), "", hive_map=custom_hive_map)
-                delete(os.path.join(key_path, "__dummy__"), hive_map=custom_hive_map)
-                print(f"Created key '{key_path}'")
-
+        for line in diff(path, sys.argv[4], hive_map=custom_hive_map):
+            print(line)
+    elif action == "upgrade":
+        # Path is the hive to migrate to the current value file formats, e.g. HKLM
+        print(f"Upgraded {upgrade(path, hive_map=custom_hive_map)} value files in {path}")
+    elif action == "stats":
+        # Profiler summary, optionally limited to a key and everything below it
+        _print_profile_stats(profile_stats(prefix=path))
+    elif action == "list":
+        # One "name:type" line per value or subkey ("key"); nothing if path is not a key
+        result = read(path, None, hive_map=custom_hive_map)
+        if isinstance(result, dict):
+            for name, type_ext in result.items():
+                print(f"{name}:{type_ext}")
     elif action == "delete":
         ok = delete(path, hive_map=custom_hive_map)
         # print(f"Deleted '{path}': {ok}")
@@ -1,33 +1,57 @@
+import atexit
+import functools
 import os
 import hashlib
 import uuid
 import time
 import errno
 import json
-from typing import Optional, Dict, Any
+import re
+import threading
+from typing import Optional, Dict, Any, Iterator, Tuple
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 # ---------- Configuration ----------
 VFS_ROOT = '/opt/aqua/vfs'
-# Poll interval used by read(wait-for-file) earlier
+# Poll interval used by read(wait-for-file) when inotify is unavailable
 _DEFAULT_POLL = 0.05
+# How long read() timestamps are batched in memory before reaching the access records
+_ACCESS_FLUSH_SECONDS = 1.0
+# Directories read() keeps watching after their last waiter left, to be reused by the next one
+_IDLE_WATCHES_MAX = 64
+# Read without libreg to avoid a circular import
+_PERSISTENT_VFS_FLAG = '/opt/aqua/registry/SYSTEM/Services/VFS/EnablePersistentVFS'
+# Content files live in VFS_ROOT/<h[0:2]>/<h[2:4]>/<h>, h being the SHA-512 hex digest of the key
+_SHARD_WIDTH = 2
+_SHARD_DEPTH = 2
+_SHARD_DIR_MODE = 0o2777  # like the VFS root itself (mkvfs.py): every VFS user creates entries
+# Keys whose content path a VFSClient remembers
+_PATH_CACHE_MAX = 4096
+_HASH_RE = re.compile(r'[0-9a-f]{128}')
+_SHARD_RE = re.compile(r'[0-9a-f]{%d}' % _SHARD_WIDTH)
+# Filesystems whose contents do not survive a reboot anyway; writes to them skip fsync
+_VOLATILE_FS_TYPES = {'tmpfs', 'ramfs'}
 
 
 # ---------- Helpers ----------
+def _persistent_vfs_enabled() -> bool:
+    try:
+        with open(_PERSISTENT_VFS_FLAG, 'r', encoding='utf-8') as f:
+            return f.read().strip().lower() in ('1', 'true', 'yes')
+    except Exception:
+        return False
+
+
 def _ensure_vfs_root():
     if not os.path.exists(VFS_ROOT):
-        # Read registry without libreg to avoid circular import
         # If value of EnablePersistentVFS is true, then mkdirs
         # Otherwise, raise error
         try:
-            enable_persistent = False
-            try:
-                with open('/opt/aqua/registry/SYSTEM/Services/VFS/EnablePersistentVFS', 'r', encoding='utf-8') as f:
-                    val = f.read().strip().lower()
-                    enable_persistent = val in ('1', 'true', 'yes')
-            except Exception:
-                pass
-
-            if enable_persistent:
+            if _persistent_vfs_enabled():
                 os.makedirs(VFS_ROOT, exist_ok=True)
             else:
                 raise RuntimeError(f"VFS root {VFS_ROOT} does not exist and persistent VFS is disabled.")
@@ -35,11 +59,81 @@ def _ensure_vfs_root():
             raise RuntimeError(f"Failed to ensure VFS root {VFS_ROOT}: {e}") from e
 
 
-def _get_vfs_path(filename: str) -> str:
-    _ensure_vfs_root()
-    hash_object = hashlib.sha512(filename.encode())
-    hash_hex = hash_object.hexdigest()
-    return os.path.join(VFS_ROOT, hash_hex)
+def _hash_key(filename: str) -> str:
+    return hashlib.sha512(filename.encode()).hexdigest()
+
+
+def _shard_path(hash_hex: str) -> str:
+    shards = [hash_hex[i * _SHARD_WIDTH:(i + 1) * _SHARD_WIDTH] for i in range(_SHARD_DEPTH)]
+    return os.path.join(VFS_ROOT, *shards, hash_hex)
+
+
+def _ensure_shard_dir(dir_path: str) -> bool:
+    """Create a shard directory (and its parent shard) open to every VFS user. Best-effort."""
+    if os.path.isdir(dir_path):
+        return True
+    parent = os.path.dirname(dir_path)
+    if parent != VFS_ROOT and not _ensure_shard_dir(parent):
+        return False
+    try:
+        os.mkdir(dir_path, _SHARD_DIR_MODE)
+    except FileExistsError:
+        return True
+    except OSError:
+        return False
+    try:
+        os.chmod(dir_path, _SHARD_DIR_MODE)  # mkdir's mode is masked by the umask
+    except OSError:
+        pass
+    return True
+
+
+def _migrate_flat_entry(hash_hex: str) -> bool:
+    """
+    Move an entry of the old flat layout (VFS_ROOT/<hash>) into its shard.
+    Returns True if its content file was moved.
+    """
+    flat = os.path.join(VFS_ROOT, hash_hex)
+    target = _shard_path(hash_hex)
+    if not os.path.isfile(flat) or not _ensure_shard_dir(os.path.dirname(target)):
+        return False
+    moved = False
+    # Access record first, so a reader that sees the content also finds its record
+    for src, dst in ((_get_meta_path_for_target(flat), _get_meta_path_for_target(target)), (flat, target)):
+        try:
+            os.rename(src, dst)
+            moved = dst == target
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+    return moved
+
+
+def migrate_flat_layout() -> int:
+    """
+    Move every entry still stored flat in VFS_ROOT (the layout before sharding) into its
+    shard. Returns the number of entries moved. Entries are also moved one by one when
+    read() or is_file() miss them in their shard.
+    """
+    _default_client()  # validates VFS_ROOT
+    moved = 0
+    with os.scandir(VFS_ROOT) as it:
+        names = {e.name for e in it}
+    for name in names:
+        hash_hex = name[:-len('.access.json')] if name.endswith('.access.json') else name
+        if not _HASH_RE.fullmatch(hash_hex):
+            continue
+        if name == hash_hex:
+            moved += _migrate_flat_entry(hash_hex)
+        elif hash_hex not in names:
+            # Orphaned access record
+            try:
+                if _ensure_shard_dir(os.path.dirname(_shard_path(hash_hex))):
+                    os.rename(os.path.join(VFS_ROOT, name), _get_meta_path_for_target(_shard_path(hash_hex)))
+            except OSError:
+                pass
+    return moved
 
 
 def _get_meta_path_for_target(target_path: str) -> str:
@@ -47,8 +141,44 @@ def _get_meta_path_for_target(target_path: str) -> str:
     return f"{target_path}.access.json"
 
 
+def _filesystem_type(path: str) -> Optional[str]:
+    """Type of the filesystem `path` is on, from the longest matching mount point in /proc/self/mounts."""
+    path = os.path.realpath(path)
+    best, best_type = '', None
+    try:
+        with open('/proc/self/mounts', 'r', encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), fields[1])
+                inside = path == mount_point or path.startswith(mount_point.rstrip('/') + '/')
+                if inside and len(mount_point) >= len(best):
+                    best, best_type = mount_point, fields[2]
+    except OSError:
+        return None
+    return best_type
+
+
+_durable: Optional[bool] = None
+
+
+def _durable_writes() -> bool:
+    """
+    Whether VFS writes are fsynced. Decided once per process: writes are durable when
+    EnablePersistentVFS is set or VFS_ROOT is not on tmpfs (as mounted by mkvfs.py).
+    Without durability, writes are still atomic through the rename.
+    """
+    global _durable
+    if _durable is None:
+        _durable = _persistent_vfs_enabled() or _filesystem_type(VFS_ROOT) not in _VOLATILE_FS_TYPES
+    return _durable
+
+
 def _fsync_dir(path: str) -> None:
     """Best-effort fsync of containing directory."""
+    if not _durable_writes():
+        return
     try:
         dirfd = os.open(os.path.dirname(path) or '.', os.O_DIRECTORY)
         try:
@@ -91,7 +221,8 @@ def _atomic_write_bytes(path: str, data: bytes) -> bool:
             if written == 0:
                 raise IOError("write returned 0")
             total_written += written
-        os.fsync(fd)
+        if _durable_writes():
+            os.fsync(fd)
         os.close(fd)
         fd = None
         # Atomic replace
@@ -133,17 +264,136 @@ def _write_json_file_atomic(path: str, obj: Dict[str, Any]) -> bool:
     return _atomic_write_bytes(path, data)
 
 
-# ---------- Access record (metadata) management ----------
-def get_access_record(filename: str) -> Optional[Dict[str, Any]]:
+# ---------- Waiting for keys ----------
+class _VFSWatcher:
     """
-    Return the access record dict for `filename`, or None if not present or unreadable.
-    Fields: created_at, last_written_at, last_read_at (epoch floats or None).
+    One inotify instance per process that wakes read() calls waiting for a key to appear.
+
+    Waiters register the content path they need and the directory holding it is watched,
+    so many waiters cost one watch; up to _IDLE_WATCHES_MAX watches outlive their last
+    waiter. A background thread turns IN_MOVED_TO (the os.replace() of _atomic_write_bytes)
+    into wake-ups, so a waiter sees a value as soon as the producer's rename lands.
     """
-    target = _get_vfs_path(filename)
-    meta_path = _get_meta_path_for_target(target)
-    return _read_json_file(meta_path)
 
+    _MASK = 0 if pyinotify is None else (
+        pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF
+    )
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters: Dict[str, list] = {}
+        self._dirs: Dict[str, list] = {}  # dir -> [wd, number of waiters]
+        self._wm = pyinotify.WatchManager()
+        self._notifier = pyinotify.Notifier(self._wm, default_proc_fun=self._on_event)
+        self._thread = threading.Thread(target=self._run, name="libvfs-watcher", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            try:
+                if self._notifier.check_events(timeout=None):
+                    self._notifier.read_events()
+                    self._notifier.process_events()
+            except Exception:
+                # Without events every waiter would sleep until its timeout; wake them to poll
+                self._wake_all()
+                time.sleep(_DEFAULT_POLL)
+
+    def _on_event(self, event) -> None:
+        if event.mask & (pyinotify.IN_Q_OVERFLOW | pyinotify.IN_IGNORED | pyinotify.IN_DELETE_SELF | pyinotify.IN_MOVE_SELF):
+            with self._lock:
+                if not event.mask & pyinotify.IN_Q_OVERFLOW:
+                    self._dirs.pop(getattr(event, "path", None), None)
+            self._wake_all()
+            return
+        with self._lock:
+            for ev in self._waiters.get(event.pathname, ()):
+                ev.set()
+
+    def _wake_all(self) -> None:
+        with self._lock:
+            for events in self._waiters.values():
+                for ev in events:
+                    ev.set()
+
+    def register(self, path: str) -> Optional[threading.Event]:
+        """
+        Start waiting for `path`. Returns None when its directory cannot be watched.
+        """
+        dir_path = os.path.dirname(path)
+        ev = threading.Event()
+        with self._lock:
+            watched = self._dirs.get(dir_path)
+            if watched is None:
+                try:
+                    wd = self._wm.add_watch(dir_path, self._MASK, quiet=True).get(dir_path, -1)
+                except Exception:
+                    wd = -1
+                if wd < 0:
+                    return None
+                watched = self._dirs[dir_path] = [wd, 0]
+            watched[1] += 1
+            self._waiters.setdefault(path, []).append(ev)
+        return ev
+
+    def unregister(self, path: str, ev: threading.Event) -> None:
+        dir_path = os.path.dirname(path)
+        with self._lock:
+            events = self._waiters.get(path, [])
+            if ev in events:
+                events.remove(ev)
+            if not events:
+                self._waiters.pop(path, None)
+            watched = self._dirs.get(dir_path)
+            if watched is not None:
+                watched[1] -= 1
+            idle = [d for d, (_wd, count) in self._dirs.items() if count <= 0]
+            for d in idle[:max(0, len(idle) - _IDLE_WATCHES_MAX)]:
+                wd = self._dirs.pop(d)[0]
+                try:
+                    self._wm.rm_watch(wd, quiet=True)
+                except Exception:
+                    pass
+
+
+_watcher: Optional[_VFSWatcher] = None
+_watcher_lock = threading.Lock()
+
+
+def _get_watcher() -> Optional[_VFSWatcher]:
+    global _watcher
+    if pyinotify is None:
+        return None
+    with _watcher_lock:
+        if _watcher is None:
+            try:
+                _watcher = _VFSWatcher()
+            except Exception:
+                return None
+        return _watcher
+
+
+def _wait_for_file(path: str, timeout: float) -> None:
+    """
+    Block until `path` may exist or `timeout` seconds pass. Falls back to sleeping one poll
+    interval when inotify is unavailable.
+    """
+    watcher = _get_watcher()
+    # The writer would create the shard directory, but it has to exist to be watched
+    ev = watcher.register(path) if watcher is not None and _ensure_shard_dir(os.path.dirname(path)) else None
+    if ev is None:
+        time.sleep(min(_DEFAULT_POLL, timeout))
+        return
+    try:
+        # The file may have landed before the watch was in place
+        if not os.path.isfile(path):
+            ev.wait(timeout)
+    finally:
+        watcher.unregister(path, ev)
 
+
+# ---------- Access record (metadata) management ----------
+# These work on resolved content paths; the public functions taking key names are below.
 def _create_initial_access_record(target_path: str, now: float) -> Dict[str, Any]:
     return {
         "created_at": now,
@@ -152,12 +402,7 @@ def _create_initial_access_record(target_path: str, now: float) -> Dict[str, Any
     }
 
 
-def update_access_on_write(filename: str) -> bool:
-    """
-    Called after a successful write: create meta file if missing, otherwise update last_written_at.
-    Returns True on success.
-    """
-    target = _get_vfs_path(filename)
+def _access_record_on_write(target: str) -> bool:
     meta_path = _get_meta_path_for_target(target)
     now = time.time()
 
@@ -175,12 +420,7 @@ def update_access_on_write(filename: str) -> bool:
     return _write_json_file_atomic(meta_path, record)
 
 
-def update_access_on_read(filename: str) -> bool:
-    """
-    Called after a successful read: update last_read_at. Returns True on success.
-    If no access record exists, create one with created_at set to last_read_at (best-effort).
-    """
-    target = _get_vfs_path(filename)
+def _access_record_on_read(target: str) -> bool:
     meta_path = _get_meta_path_for_target(target)
     now = time.time()
 
@@ -200,27 +440,8 @@ def update_access_on_read(filename: str) -> bool:
         }
     return _write_json_file_atomic(meta_path, record)
 
-def get_all_access_records() -> Dict[str, Dict[str, Any]]:
-    """
-    Return a dict mapping filenames (hashed) to their access records.
-    Only includes files that have an access record.
-    """
-    records = {}
-    _ensure_vfs_root()
-    for entry in os.listdir(VFS_ROOT):
-        if entry.endswith('.access.json'):
-            meta_path = os.path.join(VFS_ROOT, entry)
-            target_hash = entry[:-len('.access.json')]
-            record = _read_json_file(meta_path)
-            if record is not None:
-                records[target_hash] = record
-    return records
 
-def delete_access_record(filename: str) -> bool:
-    """
-    Delete the access-record file for `filename`. Return True if file deleted or not present.
-    """
-    target = _get_vfs_path(filename)
+def _delete_access_record(target: str) -> bool:
     meta_path = _get_meta_path_for_target(target)
     try:
         if os.path.exists(meta_path):
@@ -232,94 +453,318 @@ def delete_access_record(filename: str) -> bool:
         return False
 
 
-# ---------- Primary VFS operations (content) ----------
-def write(filename: str, data: str | bytes, enable_public_read: bool = True, timeout: int = 30) -> bool:
+class _AccessBatcher:
     """
-    Atomically write 'data' for key 'filename'. On first write, create access record.
-    On success, update access record's last_written_at.
-    Returns True on success, False on failure.
+    Collects read() timestamps in memory so a read costs no metadata I/O. A background
+    thread folds them into the access records every _ACCESS_FLUSH_SECONDS, and whatever
+    is left is flushed at exit. Records of keys deleted in the meantime are not recreated.
+    Pending reads are keyed by content path, so a flush does not hash keys again.
     """
-    target = _get_vfs_path(filename)
-    _ensure_vfs_root()
 
-    # Normalize bytes
-    if isinstance(data, str):
-        data_bytes = data.encode('utf-8')
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[str, float] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def note_read(self, target: str) -> None:
+        with self._lock:
+            self._pending[target] = time.time()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="libvfs-access", daemon=True)
+                self._thread.start()
+
+    def forget(self, target: str) -> None:
+        with self._lock:
+            self._pending.pop(target, None)
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(_ACCESS_FLUSH_SECONDS)
+            self.flush()
+
+    def flush(self) -> None:
+        """
+        Write every batched read time to its access record.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        with self._flush_lock:
+            for target, read_at in pending.items():
+                try:
+                    _merge_read_time(target, read_at)
+                except Exception:
+                    pass  # access tracking is best-effort
+
+    def _after_fork(self) -> None:
+        # The parent flushes its own reads
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending = {}
+        self._thread = None
+
+
+def _merge_read_time(target: str, read_at: float) -> bool:
+    if not os.path.isfile(target):
+        return True
+    meta_path = _get_meta_path_for_target(target)
+    current = _read_json_file(meta_path)
+    if current is None:
+        record = {"created_at": read_at, "last_written_at": None, "last_read_at": read_at}
     else:
-        data_bytes = bytes(data)
+        record = dict(current)
+        record["last_read_at"] = max(current.get("last_read_at") or 0, read_at)
+    return _write_json_file_atomic(meta_path, record)
+
+
+_access_batcher = _AccessBatcher()
+atexit.register(_access_batcher.flush)
+os.register_at_fork(after_in_child=_access_batcher._after_fork)
+
+
+def _shard_dirs(dir_path: str) -> Iterator[str]:
+    try:
+        with os.scandir(dir_path) as it:
+            for entry in it:
+                if _SHARD_RE.fullmatch(entry.name) and entry.is_dir(follow_symlinks=False):
+                    yield entry.path
+    except FileNotFoundError:
+        return
 
-    # Perform atomic write of content
-    ok = _atomic_write_bytes(target, data_bytes)
-    if not ok:
+
+def delete_by_hash(hash_hex: str) -> bool:
+    """
+    Delete the content file and access record of an entry given by its hashed filename,
+    as returned by iter_access_records(), in both the sharded and the flat layout.
+    Return True if everything was removed or absent, False on error.
+    """
+    if not _HASH_RE.fullmatch(hash_hex):
         return False
-    
-    # Set permissions if needed
-    if enable_public_read:
-        try:
-            os.chmod(target, 0o644)
-        except Exception:
-            pass
-    else:
+    success = True
+    for target in (_shard_path(hash_hex), os.path.join(VFS_ROOT, hash_hex)):
+        for path in (target, _get_meta_path_for_target(target)):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            except Exception:
+                success = False
+    return success
+
+
+# ---------- Client ----------
+class VFSClient:
+    """
+    VFS operations against VFS_ROOT with per-client state, so repeated calls do not redo
+    work: the root is validated once when the client is created (raising RuntimeError
+    like _ensure_vfs_root() if it is missing), and key -> content path resolution (the
+    SHA-512 of the key) is memoized in an LRU of `path_cache_size` entries. Each operation
+    resolves its key once and uses that path for both the content and the access record.
+
+    The module-level functions use a shared client; create your own for a separate cache.
+    """
+
+    def __init__(self, path_cache_size: int = _PATH_CACHE_MAX):
+        _ensure_vfs_root()
+        self.root = VFS_ROOT
+        self.path = functools.lru_cache(maxsize=path_cache_size)(self._resolve)
+
+    def _resolve(self, filename: str) -> str:
+        return _shard_path(_hash_key(filename))
+
+    # -- access records --
+    def get_access_record(self, filename: str) -> Optional[Dict[str, Any]]:
+        _access_batcher.flush()
+        return _read_json_file(_get_meta_path_for_target(self.path(filename)))
+
+    def update_access_on_write(self, filename: str) -> bool:
+        return _access_record_on_write(self.path(filename))
+
+    def update_access_on_read(self, filename: str) -> bool:
+        return _access_record_on_read(self.path(filename))
+
+    def delete_access_record(self, filename: str) -> bool:
+        return _delete_access_record(self.path(filename))
+
+    def iter_access_records(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        _access_batcher.flush()
+        leaves = [self.root]
+        for _ in range(_SHARD_DEPTH):
+            leaves = [shard for parent in leaves for shard in _shard_dirs(parent)]
+        for leaf in leaves:
+            try:
+                with os.scandir(leaf) as it:
+                    names = [e.name for e in it if e.name.endswith('.access.json')]
+            except FileNotFoundError:
+                continue
+            for name in names:
+                record = _read_json_file(os.path.join(leaf, name))
+                if record is not None:
+                    yield name[:-len('.access.json')], record
+
+    # -- content --
+    def write(self, filename: str, data: str | bytes, enable_public_read: bool = True, timeout: int = 30) -> bool:
+        target = self.path(filename)
+        if not _ensure_shard_dir(os.path.dirname(target)):
+            return False
+
+        # Normalize bytes
+        if isinstance(data, str):
+            data_bytes = data.encode('utf-8')
+        else:
+            data_bytes = bytes(data)
+
+        # Perform atomic write of content
+        ok = _atomic_write_bytes(target, data_bytes)
+        if not ok:
+            return False
+
+        # Set permissions if needed
         try:
-            os.chmod(target, 0o600)
+            os.chmod(target, 0o644 if enable_public_read else 0o600)
         except Exception:
             pass
 
-    # Update access record (create if needed)
-    return update_access_on_write(filename)
-
+        # Update access record (create if needed)
+        return _access_record_on_write(target)
 
-def read(filename: str, timeout: int = 30) -> Optional[str]:
-    """
-    Read content for 'filename'. If file not present, wait up to timeout seconds (polling).
-    On successful read, update access record's last_read_at.
-    Returns decoded utf-8 str on success, None on timeout/failure.
-    """
-    target = _get_vfs_path(filename)
-    deadline = time.monotonic() + timeout
+    def read(self, filename: str, timeout: int = 30) -> Optional[str]:
+        target = self.path(filename)
+        deadline = time.monotonic() + timeout
 
-    while True:
-        if os.path.exists(target) and os.path.isfile(target):
+        while True:
             try:
                 with open(target, 'rb') as f:
                     data = f.read()
-                # Update metadata about read (best-effort)
-                try:
-                    update_access_on_read(filename)
-                except Exception:
-                    pass
+            except (FileNotFoundError, IsADirectoryError):
+                # not written yet (or removed again), or still in the flat layout; wait until timeout
+                if _migrate_flat_entry(os.path.basename(target)):
+                    continue
+                data = None
+            except Exception:
+                return None
+            if data is not None:
+                _access_batcher.note_read(target)
                 try:
                     return data.decode('utf-8')
                 except Exception:
                     # fallback: return bytes decoded latin-1 if not utf-8
                     return data.decode('latin-1')
-            except FileNotFoundError:
-                # rare race: file removed between exists() and open(); retry until timeout
-                pass
-            except Exception:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 return None
-        if time.monotonic() >= deadline:
-            return None
-        time.sleep(_DEFAULT_POLL)
+            _wait_for_file(target, remaining)
+
+    def is_file(self, filename: str) -> bool:
+        target = self.path(filename)
+        return os.path.isfile(target) or _migrate_flat_entry(os.path.basename(target))
+
+    def delete(self, filename: str) -> bool:
+        target = self.path(filename)
+        _access_batcher.forget(target)
+        return delete_by_hash(os.path.basename(target))
+
+
+_client: Optional[VFSClient] = None
+_client_lock = threading.Lock()
+
+
+def _default_client() -> VFSClient:
+    """The shared client, recreated if VFS_ROOT was changed since it was made."""
+    global _client
+    client = _client
+    if client is None or client.root != VFS_ROOT:
+        with _client_lock:
+            if _client is None or _client.root != VFS_ROOT:
+                _client = VFSClient()
+            client = _client
+    return client
+
+
+# ---------- Access record (metadata) functions ----------
+def get_access_record(filename: str) -> Optional[Dict[str, Any]]:
+    """
+    Return the access record dict for `filename`, or None if not present or unreadable.
+    Fields: created_at, last_written_at, last_read_at (epoch floats or None).
+    """
+    return _default_client().get_access_record(filename)
+
+
+def update_access_on_write(filename: str) -> bool:
+    """
+    Called after a successful write: create meta file if missing, otherwise update last_written_at.
+    Returns True on success.
+    """
+    return _default_client().update_access_on_write(filename)
+
+
+def update_access_on_read(filename: str) -> bool:
+    """
+    Called after a successful read: update last_read_at. Returns True on success.
+    If no access record exists, create one with created_at set to last_read_at (best-effort).
+    """
+    return _default_client().update_access_on_read(filename)
+
+
+def flush_access_records() -> None:
+    """
+    Write read times batched by read() to the access records now.
+    """
+    _access_batcher.flush()
+
+
+def iter_access_records() -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """
+    Yield (hashed filename, access record) for every entry that has a readable access
+    record, one shard directory at a time. Entries still in the flat layout are not seen
+    until migrate_flat_layout() has moved them.
+    """
+    return _default_client().iter_access_records()
+
+
+def get_all_access_records() -> Dict[str, Dict[str, Any]]:
+    """
+    Return a dict mapping filenames (hashed) to their access records.
+    Only includes files that have an access record.
+    """
+    return dict(iter_access_records())
+
+def delete_access_record(filename: str) -> bool:
+    """
+    Delete the access-record file for `filename`. Return True if file deleted or not present.
+    """
+    return _default_client().delete_access_record(filename)
+
+
+# ---------- Primary VFS operations (content) ----------
+def write(filename: str, data: str | bytes, enable_public_read: bool = True, timeout: int = 30) -> bool:
+    """
+    Atomically write 'data' for key 'filename'. On first write, create access record.
+    On success, update access record's last_written_at.
+    Returns True on success, False on failure.
+    """
+    return _default_client().write(filename, data, enable_public_read, timeout)
+
+
+def read(filename: str, timeout: int = 30) -> Optional[str]:
+    """
+    Read content for 'filename'. If file not present, wait up to timeout seconds for a writer
+    (woken by inotify where available, polling otherwise).
+    On successful read, the access record's last_read_at is updated in the background
+    (see _AccessBatcher); the read itself is one open and read.
+    Returns decoded utf-8 str on success, None on timeout/failure.
+    """
+    return _default_client().read(filename, timeout)
 
 
 def is_file(filename: str) -> bool:
-    target = _get_vfs_path(filename)
-    return os.path.exists(target) and os.path.isfile(target)
+    return _default_client().is_file(filename)
 
 
 def delete(filename: str) -> bool:
     """
     Delete content file and its access record. Return True if both removed or absent, False on error.
     """
-    target = _get_vfs_path(filename)
-    success = True
-    try:
-        if os.path.exists(target):
-            os.unlink(target)
-    except Exception:
-        success = False
-    # remove meta
-    if not delete_access_record(filename):
-        success = False
-    return success
+    return _default_client().delete(filename)
@@ -1,8 +1,19 @@
 #!/bin/bash
 
 # Install all default registries in /opt/aqua/sys/registry/
+# One process for all files: each is still its own transaction, installed in order
+regtree_files=(/opt/aqua/sys/registry/*.regtree)
+if [[ -e "${regtree_files[0]}" ]]; then
+    /opt/aqua/sys/sbin/reg.sh root install "${regtree_files[@]}"
+fi
 
-for regtree_file in /opt/aqua/sys/registry/*.regtree; do
-    /opt/aqua/sys/sbin/reg.sh root install "$regtree_file"
+# Rewrite value files still in older formats; they stay readable if this fails
+for hive in HKLM HKNS; do
+    /opt/aqua/sys/sbin/reg.sh root upgrade "$hive" || echo "Could not upgrade $hive. Skipping..."
+done
+
+# Compile the read-mostly hives into images; reads fall back to the files if this fails
+for hive in HKLM HKNS; do
+    /opt/aqua/sys/sbin/reg.sh root compact "$hive" || echo "Could not compact $hive. Skipping..."
 done
 # End of script
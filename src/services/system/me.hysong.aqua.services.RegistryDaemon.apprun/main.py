@@ -0,0 +1,218 @@
+import json
+import os
+import pwd
+import signal
+import socket
+import socketserver
+import stat
+import sys
+
+from oscore import libreg as reg
+from oscore import libapplog as logger
+
+# regd: persistent registry server
+#
+# Answers libreg and reg.sh requests over a Unix socket (see the regd section of libreg
+# for the framing), so short-lived callers skip interpreter startup, hive path expansion
+# and cold directory scans. Reads are served from libreg's inotify-backed cache.
+#
+# Any user may connect. Root peers may read, write and delete. Other peers may only read,
+# and only if the file mode bits would have let them read every file and directory the
+# answer came from; everything else is declined and the caller falls back to direct access.
+
+_MISSING = object()
+_CRED = reg._REGD_CRED
+
+
+class Peer:
+    def __init__(self, uid: int, gid: int):
+        self.uid = uid
+        self.groups = {gid}
+        try:
+            self.groups.update(os.getgrouplist(pwd.getpwuid(uid).pw_name, gid))
+        except KeyError:
+            pass
+
+    def _granted(self, st: os.stat_result, bits: int) -> bool:
+        if st.st_uid == self.uid:
+            mode = st.st_mode >> 6
+        elif st.st_gid in self.groups:
+            mode = st.st_mode >> 3
+        else:
+            mode = st.st_mode
+        return mode & bits == bits
+
+    def may_read(self, path: str) -> bool:
+        """
+        Whether this peer could have read `path` (or seen that it is missing) itself.
+        """
+        if self.uid == 0:
+            return True
+        components = os.path.abspath(path).strip("/").split("/")
+        chain = ["/"] + ["/" + "/".join(components[:i]) for i in range(1, len(components) + 1) if components[0]]
+        for i, current in enumerate(chain):
+            try:
+                st = os.stat(current)
+            except (FileNotFoundError, NotADirectoryError):
+                return True  # The peer got this far, so it can see the rest is missing
+            except OSError:
+                return False
+            last = i == len(chain) - 1
+            if stat.S_ISDIR(st.st_mode):
+                bits = 0o5 if last else 0o1
+            elif last:
+                bits = 0o4
+            else:
+                return True  # A file in the middle of the path: lookup fails for anyone
+            if not self._granted(st, bits):
+                return False
+        return True
+
+
+def traced_read(peer: Peer, path: str, hive_map: dict):
+    """
+    read() for a peer. Returns (allowed, result); result is _MISSING if nothing was found.
+    """
+    result, probed, opened = reg.read_traced(path, _MISSING, hive_map=hive_map)
+    allowed = all(peer.may_read(p) for p in probed + opened)
+    return allowed, result
+
+
+def handle_request(peer: Peer, message: dict) -> dict:
+    op = message.get("op")
+    path = message.get("path")
+    hive_map = message.get("hive_map")
+    if not isinstance(path, str) or not (hive_map is None or isinstance(hive_map, dict)):
+        return {"ok": False, "error": "malformed request"}
+
+    if op == "read":
+        allowed, result = traced_read(peer, path, hive_map)
+        if not allowed:
+            return {"ok": False, "error": "permission denied"}
+        if result is _MISSING:
+            return {"ok": True, "found": False}
+        if isinstance(result, bytes):
+            return {"ok": False, "error": "bytes values are read directly"}  # No JSON form
+        return {"ok": True, "found": True, "value": result}
+
+    if peer.uid != 0:
+        return {"ok": False, "error": "permission denied"}
+    if op == "write":
+        reg.write(message.get("user") or "root", path, message.get("value"), hive_map=hive_map,
+                  typedef=message.get("typedef"), wait=bool(message.get("wait")))
+        return {"ok": True}
+    if op == "delete":
+        return {"ok": True, "value": reg.delete(path, hive_map=hive_map, background=bool(message.get("background")))}
+    return {"ok": False, "error": f"unknown op: {op}"}
+
+
+def handle_command(peer: Peer, argv: list[str]):
+    """
+    A reg.sh command line. Returns (exit code, output), or None to decline.
+    """
+    if len(argv) < 3:
+        return None
+    user, action, path = argv[0], argv[1].lower(), argv[2]
+    hive_map = reg.user_hive_map(user)
+
+    if action in ("read", "list"):
+        allowed, result = traced_read(peer, path, hive_map)
+        if not allowed:
+            return None
+        if action == "list":
+            if not isinstance(result, dict):
+                return 0, ""
+            return 0, "".join(f"{name}:{type_ext}\n" for name, type_ext in result.items())
+        if result is _MISSING:
+            result = argv[3] if len(argv) >= 4 else None
+        return 0, f"{result}\n"
+
+    if peer.uid != 0:
+        return None
+    if action == "write" and len(argv) >= 5:
+        reg.write(user, path, argv[4], hive_map=hive_map, typedef=argv[3])
+        return 0, ""
+    if action == "delete":
+        # This process outlives the call, so the trash can be reaped after answering
+        reg.delete(path, hive_map=hive_map, background=True)
+        return 0, ""
+    return None
+
+
+class RegdHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        _pid, uid, gid = _CRED.unpack(self.connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, _CRED.size))
+        peer = Peer(uid, gid)
+
+        while True:
+            try:
+                payload = reg.regd_read_frame(self.rfile)
+            except (OSError, ValueError):
+                return
+            if payload is None:
+                return
+
+            if payload.startswith(b"{"):
+                try:
+                    reply = handle_request(peer, json.loads(payload))
+                except Exception as e:
+                    reply = {"ok": False, "error": str(e)}
+                data = json.dumps(reply).encode("utf-8")
+            else:
+                try:
+                    outcome = handle_command(peer, payload.decode("utf-8").split("\t"))
+                except Exception:
+                    outcome = None  # libreg.py reports it the usual way
+                data = b"DECLINED" if outcome is None else f"{outcome[0]}\t{outcome[1]}".encode("utf-8")
+
+            try:
+                self.wfile.write(reg.regd_frame(data))
+            except OSError:
+                return
+
+
+class RegdServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
+
+def main():
+    signal.signal(signal.SIGTERM, _terminate)
+
+    # Serve from the files, never from ourselves
+    reg.use_daemon(False)
+    reg.enable_cache()
+    # Profiled clients time their own calls, including the round trip to us
+    reg.disable_profiler()
+
+    reg.ensure_run_dir()
+    socket_path = reg._REGD_SOCKET
+    staging_path = f"{socket_path}.{os.getpid()}"
+    if os.path.exists(staging_path):
+        os.remove(staging_path)
+
+    # Bind aside and rename into place, so clients never connect to a half-set-up socket
+    server = RegdServer(staging_path, RegdHandler)
+    os.chmod(staging_path, 0o666)
+    os.replace(staging_path, socket_path)
+    logger.info(f"regd listening on {socket_path}")
+
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        try:
+            os.remove(socket_path)
+        except FileNotFoundError:
+            pass
+        reg.wait_for_hooks(timeout=10)
+        reg.wait_for_deletes(timeout=10)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
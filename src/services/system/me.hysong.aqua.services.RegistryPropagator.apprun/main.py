@@ -1,14 +1,194 @@
+import os
+import signal
+import stat
 import sys
+import time
+
+import pyinotify
 
 from oscore import libreg as reg
 from oscore import libapplog as logger
 
-from nanodir.client import request as client_request
-
 # Reading hooks for registry propagation
 # HKEY_LOCAL_MACHINE/SYSTEM/Services/me.hysong.aqua/RegistryPropagator/ActionHooks/*
+#
+# This service watches the machine hive roots only root can write with inotify and fires
+# ActionHooks for value changes no matter who made them (libreg, the Java libreg, reg.sh,
+# regedit's helper). Hooks of HKCU run in the writing process, as the user.
+# It also owns the compiled ActionHook index (see libreg.ActionHookIndex): the index
+# is rebuilt whenever the ActionHooks subtree changes, and it tells libreg.write()
+# which hive roots this service dispatches for, so writers do not fire hooks twice.
+# libreg writers that still run hooks themselves (waited writes, first values of a new key)
+# rename the value into place from a tagged temp file, and this service skips those.
+# Any change to a compacted hive also removes its image (see libreg.compact), so writers
+# that do not go through libreg never leave a stale image behind.
+
+SERVICE_KEY = "HKEY_LOCAL_MACHINE/SYSTEM/Services/me.hysong.aqua/RegistryPropagator"
+
+# Quiet period after the last change before the index is rebuilt (seconds)
+REBUILD_DEBOUNCE = 0.2
+# Quiet period after the last change to a value before its hooks fire (seconds)
+DISPATCH_DEBOUNCE = 0.05
+
+WATCH_MASK = (pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MODIFY
+              | pyinotify.IN_MOVED_FROM | pyinotify.IN_MOVED_TO | pyinotify.IN_DELETE_SELF)
+
+
+def root_only(root: str) -> bool:
+    """
+    Whether only root can change the hive at `root`. This service runs hooks as root, so it
+    only takes over hooks that root's own writes would have run.
+    """
+    try:
+        st = os.lstat(root)
+    except OSError:
+        return False
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == 0 and not st.st_mode & 0o022
+
+
+def watched_hives() -> list[tuple[str, str]]:
+    """
+    (canonical hive, root) pairs to watch: the machine hives only root can write. Hooks of
+    HKCU (and of any hive users can write) stay with the writing process, which runs them
+    as the user that made the change.
+    """
+    return [(hive, root) for hive, root in reg.get_hive_roots().items()
+            if hive != "HKEY_CURRENT_USER" and root_only(root)]
+
+
+class HiveChangeHandler(pyinotify.ProcessEvent):
+    def my_init(self, state: dict):
+        self.state = state
+
+    def process_IN_Q_OVERFLOW(self, event):
+        logger.warning("inotify queue overflowed; some registry changes were not dispatched")
+
+    def process_default(self, event):
+        now = time.monotonic()
+        path = event.pathname
+        for hive, root in self.state["imaged"]:
+            if path.startswith(root + os.sep):
+                reg._discard_hive_image(hive, root)
+        if path == self.state["hooks_dir"] or path.startswith(self.state["hooks_dir"] + os.sep):
+            self.state["index_dirty_since"] = now
+
+        # A value was (re)written: in place, or renamed over by an atomic writer
+        if event.mask & (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO) and not event.dir:
+            if event.name.endswith(".rv") and not reg.hooks_run_by_writer(getattr(event, "src_pathname", "")):
+                self.state["pending"][path] = now
+
+
+def split_value_path(path: str, hives: list[tuple[str, str]]):
+    """
+    Map a value file path back to (hive, registry-relative path), or None.
+    """
+    for hive, root in hives:
+        if path.startswith(root + os.sep):
+            try:
+                encoded, type_ext, _rv = path[len(root) + 1:].rsplit(".", 2)
+            except ValueError:
+                return None
+            if type_ext not in reg._TYPES_AVAILABLE:
+                return None
+            return hive, "/".join(reg.decode_key(p) for p in encoded.split(os.sep))
+    return None
+
+
+def dispatch_due(state: dict, index, hives, dispatcher) -> None:
+    now = time.monotonic()
+    pending: dict = state["pending"]
+    due = [(path, t) for path, t in pending.items() if now - t >= DISPATCH_DEBOUNCE]
+    for path, t in due:
+        del pending[path]
+        split = split_value_path(path, hives)
+        if split is None:
+            continue
+        hive, rel = split
+        hooks = index.hooks_for_change(hive, rel)
+        if not hooks:
+            continue
+        try:
+            data = reg._read_hook_text(path)
+        except OSError:
+            continue  # Gone again already
+        except ValueError as e:  # Including UnicodeDecodeError
+            logger.warning(f"Not firing ActionHooks of {hive}/{rel}, its value cannot be decoded: {e}")
+            continue
+        # Never run hooks on this thread: it has to keep draining inotify. While the hook
+        # workers are saturated, changes wait here, coalesced per value, and go in later.
+        if not dispatcher.try_submit(f"{hive}/{rel}", hooks, data):
+            pending[path] = t
+            if not state.get("backlogged"):
+                state["backlogged"] = True
+                logger.warning("ActionHook queue is full; holding back changes until it drains")
+            return
+    if state.get("backlogged"):
+        state["backlogged"] = False
+        logger.info("ActionHook backlog cleared")
+
+
+def _terminate(signum, frame):
+    raise SystemExit(0)
+
 
 def main():
+    signal.signal(signal.SIGTERM, _terminate)
+
+    hooks_dir = reg.get_action_hooks_dir()
+    os.makedirs(hooks_dir, exist_ok=True)
+
+    try:
+        workers = int(reg.read(f"{SERVICE_KEY}/Workers", 4))
+    except (TypeError, ValueError):
+        workers = 4
+    dispatcher = reg.HookDispatcher(workers=workers, max_pending=4096)
+
+    hives = watched_hives()
+    wm = pyinotify.WatchManager()
+    imaged = [(hive, root) for hive, root in hives if hive in reg._IMAGE_HIVES]
+    state = {"hooks_dir": hooks_dir, "index_dirty_since": None, "pending": {}, "imaged": imaged}
+    notifier = pyinotify.Notifier(wm, HiveChangeHandler(state=state), timeout=int(DISPATCH_DEBOUNCE * 1000))
+    # Watch first, then build, so no change can slip in between.
+    # Hive roots missing at startup stay with libreg's own hook dispatch.
+    for hive, root in hives:
+        wm.add_watch(root, WATCH_MASK, rec=True, auto_add=True, quiet=True)
+        logger.info(f"Watching {hive} at {root}")
+    roots = [root for _hive, root in hives]
+    # Writers run the hooks the index names, so it may only be published where only root writes
+    reg.ensure_run_dir()
+
+    try:
+        index = reg.rebuild_action_hook_index(dispatch_roots=roots)
+        logger.info(f"ActionHook index published from {index.source}")
+
+        while True:
+            try:
+                if notifier.check_events():
+                    notifier.read_events()
+                    notifier.process_events()
+
+                dirty_since = state["index_dirty_since"]
+                if dirty_since is not None and time.monotonic() - dirty_since >= REBUILD_DEBOUNCE:
+                    state["index_dirty_since"] = None
+                    try:
+                        index = reg.rebuild_action_hook_index(dispatch_roots=roots)
+                        logger.info("ActionHook index rebuilt")
+                    except Exception as e:
+                        # Writers must not trust a stale index
+                        logger.error(f"Failed to rebuild ActionHook index: {e}")
+                        reg.remove_action_hook_index()
+
+                if state["pending"]:
+                    dispatch_due(state, index, hives, dispatcher)
+            except Exception as e:
+                # Exiting would withdraw the index and leave hooks to writers; keep serving
+                logger.error(f"RegistryPropagator loop failed: {e}")
+                time.sleep(DISPATCH_DEBOUNCE)
+    finally:
+        reg.remove_action_hook_index()
+        notifier.stop()
+        dispatcher.drain(timeout=10)
+
     return 0
 
 
@@ -1,3 +1,4 @@
+import threading
 import time
 
 from oscore import libapplog as log
@@ -5,11 +6,53 @@ from oscore import libvfs as vfs
 from oscore import libreg as reg
 
 
+SERVICE_KEY = "/SYSTEM/Services/me.hysong.aqua/VFSGC"
+
+# 다른 프로세스가 메모리에 모아 둔 읽기 시간이 접근 기록에 반영될 때까지 더 기다리는 시간 (초)
+ACCESS_GRACE = 10 * vfs._ACCESS_FLUSH_SECONDS
+
+
+def last_activity(record: dict) -> float | None:
+    """
+    접근 기록의 마지막 읽기/쓰기/생성 시간 중 가장 최근 것. 기록된 시간이 없으면 None.
+    """
+    times = [t for t in (record.get("last_read_at"), record.get("last_written_at"), record.get("created_at"))
+             if isinstance(t, (int, float)) and not isinstance(t, bool)]
+    return max(times) if times else None
+
+
+def is_expired(record: dict, global_ttl: int, now: float) -> bool:
+    """
+    TTL 과 ACCESS_GRACE 를 넘도록 읽히지도 쓰이지도 않은 항목인지.
+    TTL 이 0 이하이거나 언제 쓰였는지 알 수 없는 항목은 지우지 않는다.
+    """
+    ttl = record.get("ttl", global_ttl)
+    if not isinstance(ttl, (int, float)) or isinstance(ttl, bool):
+        ttl = global_ttl
+
+    # TTL이 0 이하인 경우 무한대
+    if ttl <= 0:
+        return False
+
+    last_accessed = last_activity(record)
+    if last_accessed is None:
+        return False
+    return now - last_accessed > ttl + ACCESS_GRACE
+
+
 def main():
 
+    # 설정이 바뀌면 대기 중이어도 바로 깨어나 새 값으로 다시 계산
+    config_changed = threading.Event()
+    try:
+        reg.watch(SERVICE_KEY, lambda change: config_changed.set())
+    except Exception as e:
+        log.warning(f"Cannot watch registry for configuration changes, re-reading it every cycle only: {e}")
+
+    last_run = time.monotonic()
     while True:
         # 레지스트리에서 대기 시간 읽기 (기본값 60초)
-        latency_reg = reg.read("/SYSTEM/Services/me.hysong.aqua/VFSGC/Latency", 60)
+        latency_reg = reg.read(f"{SERVICE_KEY}/Latency", 60)
         try:
             latency = int(latency_reg)
         except Exception as e:
@@ -17,14 +60,25 @@ def main():
             latency = 60
 
         # 레이턴시 시작
-        time.sleep(latency)
-        
-        # VFS 에서 액세스 파일 읽어들이기
+        remaining = last_run + latency - time.monotonic()
+        if remaining > 0:
+            if config_changed.wait(remaining):
+                config_changed.clear()
+                continue
+        last_run = time.monotonic()
+
+        # 예전(평면) 구조로 남아 있는 항목을 샤드 디렉터리로 옮기기
         try:
-            all_access_files: dict[str, dict[str, any]] = vfs.get_all_access_records()
+            migrated = vfs.migrate_flat_layout()
+            if migrated:
+                log.info(f"Moved {migrated} VFS files from the flat layout into shards")
+        except Exception as e:
+            log.error(f"Failed to migrate flat VFS layout: {e}")
 
+        # VFS 에서 액세스 파일 읽어들이기 (샤드 디렉터리 하나씩)
+        try:
             # TTL 값 읽기 (기본값 3600초)
-            global_ttl = reg.read("/SYSTEM/Services/me.hysong.aqua/VFSGC/TTL", 3600)
+            global_ttl = reg.read(f"{SERVICE_KEY}/TTL", 3600)
             try:
                 global_ttl = int(global_ttl)
             except Exception as e:
@@ -34,30 +88,18 @@ def main():
             # 현재 시간
             current_time = time.time()
 
-            # 각 파일에 대해 검사
-            for filename, record in all_access_files.items():
-                last_accessed = record.get("last_read_at", 0)
-                last_wrote = record.get("last_wrote_at", 0)
-                last_accessed = max(last_accessed, last_wrote)  # 읽기/쓰기 중 더 최근 시간 사용
-                ttl = record.get("ttl", global_ttl)
-
-                # TTL이 0 이하인 경우 무한대
-                if ttl <= 0:
-                    continue
-
-                # 마지막 액세스 시간과 현재 시간의 차이 계산
-                time_diff = current_time - last_accessed
-
+            # 각 파일에 대해 검사 (이름은 이미 해시된 값이므로 delete_by_hash 로 지운다)
+            for hashed_name, record in vfs.iter_access_records():
                 # TTL 초과 시 파일 삭제
-                if time_diff > ttl:
+                if is_expired(record, global_ttl, current_time):
                     try:
-                        success: bool = vfs.delete(filename)
+                        success: bool = vfs.delete_by_hash(hashed_name)
                         if success:
-                            log.info(f"Deleted VFS file due to TTL expiry: {filename}")
+                            log.info(f"Deleted VFS file due to TTL expiry: {hashed_name}")
                         else:
-                            log.warning(f"Failed to delete VFS file (not found or inaccessible): {filename}")
+                            log.warning(f"Failed to delete VFS file (not found or inaccessible): {hashed_name}")
                     except Exception as e:
-                        log.error(f"Failed to delete VFS file {filename}: {e}")
+                        log.error(f"Failed to delete VFS file {hashed_name}: {e}")
 
         except Exception as e:
             log.error(f"Error during VFS GC: {e}")
@@ -1,6 +1,7 @@
 import os
 import stat
 import subprocess
+import threading
 import pyinotify
 from oscore import libreg as reg
 
@@ -16,22 +17,16 @@ def load_watch_dirs():
     """
     watch_dirs = []
     try:
-        # Read the key content to get value names and types
-        key_content = reg.read(REGISTRY_KEY, default={})
+        # Read all values of the key in one pass
+        key_content = reg.read_tree(REGISTRY_KEY, {}, depth=0)
 
-        for value_name, value_type in key_content.items():
+        for value_name, dir_path in key_content.items():
             # The prompt specifies we only care about 'str' typed values
-            if value_type == 'str':
-                # Construct path to the specific value to read the actual data
-                # Assuming standard registry path syntax (Key/ValueName)
-                full_value_path = f"{REGISTRY_KEY}/{value_name}"
-                dir_path = reg.read(full_value_path)
-
-                if dir_path and isinstance(dir_path, str):
-                    if os.path.exists(dir_path):
-                        watch_dirs.append(dir_path)
-                    else:
-                        print(f"Warning: Registry path does not exist on disk: {dir_path}")
+            if dir_path and isinstance(dir_path, str):
+                if os.path.exists(dir_path):
+                    watch_dirs.append(dir_path)
+                else:
+                    print(f"Warning: Registry path does not exist on disk: {dir_path}")
 
     except Exception as e:
         print(f"Error reading registry: {e}")
@@ -188,37 +183,66 @@ class ChangeHandler(pyinotify.ProcessEvent):
                     # Force run chmod +x to ensure it's executable
                     subprocess.call(['chmod', '+x', filename])
 
+def apply_watch_dirs(wm, watched, watch_dirs):
+    """
+    Bring the directory watches in line with watch_dirs.
+    watched maps each watched directory to its watch descriptor.
+    """
+    mask = pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB
+
+    for directory in list(watched):
+        if directory not in watch_dirs:
+            wm.rm_watch(watched.pop(directory), quiet=True)
+            print(f"Stopped watching: {directory}")
+
+    new_dirs = [directory for directory in watch_dirs if directory not in watched]
+    # Scan existing files in new watch dirs and create links/wrappers if missing
+    if new_dirs:
+        initial_scan(new_dirs)
+    for directory in new_dirs:
+        watched[directory] = wm.add_watch(directory, mask, rec=False)[directory]
+        print(f"Watching: {directory}")
+
+
 def main():
-    # 1. Load configuration from Registry
+    # 1. Follow the configuration in the registry from the start, so no edit is missed
+    config_changed = threading.Event()
+    reg.watch(REGISTRY_KEY, lambda change: config_changed.set())
+
+    # 2. Load configuration from Registry
     watch_dirs = load_watch_dirs()
 
     if not watch_dirs:
-        print("No valid directories found in registry. Exiting.")
-        return
+        print("No valid directories found in registry. Waiting for configuration...")
 
-    # 2. Clean up broken links in the target directory
+    # 3. Clean up broken links in the target directory
     cleanup_broken_links()
 
-    # 3. Scan existing files in watch dirs and create links/wrappers if missing
-    initial_scan(watch_dirs)
-
-    # 4. Start the inotify monitor
+    # 4. Start the inotify monitor, scanning existing files in watch dirs first
     wm = pyinotify.WatchManager()
-    mask = pyinotify.IN_MOVED_TO | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_ATTRIB
 
     handler = ChangeHandler()
-    notifier = pyinotify.Notifier(wm, handler)
+    # Wake up regularly to pick up configuration changes
+    notifier = pyinotify.Notifier(wm, handler, timeout=500)
 
     print("\nStarting AquariusOS Directory Monitor...")
 
-    for directory in watch_dirs:
-        wm.add_watch(directory, mask, rec=False)
-        print(f"Watching: {directory}")
+    watched = {}
+    apply_watch_dirs(wm, watched, watch_dirs)
 
     try:
-        notifier.loop()
+        while True:
+            if notifier.check_events():
+                notifier.read_events()
+                notifier.process_events()
+            if config_changed.is_set():
+                config_changed.clear()
+                print("Prober configuration changed. Reloading...")
+                apply_watch_dirs(wm, watched, load_watch_dirs())
     except KeyboardInterrupt:
         print("\nStopping monitor.")
+    finally:
+        notifier.stop()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,192 @@
+"""
+ActionHooks fire exactly once per write while the RegistryPropagator service is active.
+
+The service's own handler and dispatch loop are driven in-process against a temporary
+HKLM, so writers and the service see the same published hook index.
+"""
+import importlib.util
+import os
+import sys
+import time
+
+import pytest
+
+pyinotify = pytest.importorskip("pyinotify")
+pytest.importorskip("AppContext")  # Provided to services by the app runner
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(REPO, "src", "libraries", "system", "python"))
+
+from oscore import libreg as reg  # noqa: E402
+
+PROPAGATOR_MAIN = os.path.join(REPO, "src", "services", "system",
+                               "me.hysong.aqua.services.RegistryPropagator.apprun", "main.py")
+VALUE = "SYSTEM/Test/Value"
+NEW_KEY_VALUE = "SYSTEM/New/Key/Value"
+
+
+class Propagator:
+    """
+    RegistryPropagator's event handling and dispatch, pumped by the test instead of main().
+    """
+
+    def __init__(self, hive: str, root: str):
+        spec = importlib.util.spec_from_file_location("registry_propagator", PROPAGATOR_MAIN)
+        self.service = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.service)
+
+        self.hives = [(hive, root)]
+        self.state = {"hooks_dir": reg.get_action_hooks_dir(), "index_dirty_since": None, "pending": {}, "imaged": []}
+        self.wm = pyinotify.WatchManager()
+        self.notifier = pyinotify.Notifier(self.wm, self.service.HiveChangeHandler(state=self.state), timeout=10)
+        self.wm.add_watch(root, self.service.WATCH_MASK, rec=True, auto_add=True, quiet=True)
+        self.index = reg.rebuild_action_hook_index(reg._ACTION_HOOK_INDEX_FILE, dispatch_roots=[root])
+        self.dispatcher = reg.HookDispatcher(workers=1)
+
+    def pump(self, seconds: float = 0.5) -> None:
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            if self.notifier.check_events():
+                self.notifier.read_events()
+                self.notifier.process_events()
+            if self.state["pending"]:
+                self.service.dispatch_due(self.state, self.index, self.hives, self.dispatcher)
+        assert self.dispatcher.drain(timeout=10)
+
+    def close(self) -> None:
+        self.notifier.stop()
+        self.dispatcher.drain(timeout=10)
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    hive_map = {hive: str(tmp_path / hive) for hive in reg._HIVE_MAP}
+    monkeypatch.setattr(reg, "_HIVE_MAP", hive_map)
+    monkeypatch.setattr(reg, "_ACTION_HOOK_INDEX_FILE", str(tmp_path / "registry.actionhooks.json"))
+    monkeypatch.setattr(reg, "_hook_index_cache", None)
+    monkeypatch.setattr(reg, "_regd", None)
+
+    counter = tmp_path / "fired"
+    hook = f"/bin/sh -c 'echo \"$1\" >> \"$0\"' {counter} {{}}"
+    for path in (VALUE, NEW_KEY_VALUE):
+        reg.write("root", f"{reg._ACTION_HOOKS_PATH}{path}", [hook], typedef="list")
+    os.makedirs(os.path.join(hive_map["HKEY_LOCAL_MACHINE"], "SYSTEM", "Test"), exist_ok=True)
+
+    propagator = Propagator("HKEY_LOCAL_MACHINE", hive_map["HKEY_LOCAL_MACHINE"])
+    yield propagator, counter
+    propagator.close()
+
+
+def fired(counter) -> list:
+    return counter.read_text().splitlines() if counter.exists() else []
+
+
+def test_background_write_fires_once(registry):
+    propagator, counter = registry
+    reg.write("root", f"HKLM/{VALUE}", "a")
+    assert reg.wait_for_hooks(timeout=10)
+    propagator.pump()
+    assert fired(counter) == ["a"]
+
+
+def test_waited_write_fires_once(registry):
+    propagator, counter = registry
+    reg.write("root", f"HKLM/{VALUE}", "b", wait=True)
+    assert fired(counter) == ["b"]
+    propagator.pump()
+    assert fired(counter) == ["b"]
+
+
+def test_waited_transaction_fires_once(registry):
+    propagator, counter = registry
+    with reg.transaction("root", wait=True) as tx:
+        tx.write(f"HKLM/{VALUE}", "c")
+    assert fired(counter) == ["c"]
+    propagator.pump()
+    assert fired(counter) == ["c"]
+
+
+@pytest.mark.parametrize("wait", [False, True])
+def test_write_to_new_key_fires_once(registry, wait):
+    # The service may not watch a key directory created by the write yet
+    propagator, counter = registry
+    reg.write("root", f"HKLM/{NEW_KEY_VALUE}", "d", wait=wait)
+    assert reg.wait_for_hooks(timeout=10)
+    propagator.pump()
+    assert fired(counter) == ["d"]
+
+
+@pytest.mark.parametrize("wait", [False, True])
+def test_transaction_to_new_key_fires_once(registry, wait):
+    propagator, counter = registry
+    with reg.transaction("root", wait=wait) as tx:
+        tx.write(f"HKLM/{NEW_KEY_VALUE}", "e")
+        tx.write(f"HKLM/{VALUE}", "f")
+    assert reg.wait_for_hooks(timeout=10)
+    propagator.pump()
+    assert sorted(fired(counter)) == ["e", "f"]
+
+
+@pytest.mark.parametrize("value, typedef, text", [
+    (["a", "b,c"], "list", "a, b\\,c"),
+    (b"\x00\xff", None, "00ff"),
+    (7, None, "7"),
+])
+def test_service_passes_writer_text(registry, value, typedef, text):
+    # Hooks fired by the service get the same {} text as hooks run by the writer
+    propagator, counter = registry
+    reg.write("root", f"HKLM/{VALUE}", value, typedef=typedef)
+    propagator.pump()
+    assert fired(counter) == [text]
+
+
+def test_string_hook_fires(registry):
+    # A single hook may be stored as a str value instead of a list
+    propagator, counter = registry
+    hook = f"/bin/sh -c 'echo \"$1\" >> \"$0\"' {counter} {{}}"
+    reg.write("root", f"{reg._ACTION_HOOKS_PATH}SYSTEM/Test/Single", hook, typedef="str")
+    propagator.index = reg.rebuild_action_hook_index(reg._ACTION_HOOK_INDEX_FILE, dispatch_roots=[propagator.hives[0][1]])
+    reg.write("root", "HKLM/SYSTEM/Test/Single", "g")
+    propagator.pump()
+    assert fired(counter) == ["g"]
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="hive roots must be owned by root")
+def test_user_writable_hives_are_not_dispatched(registry):
+    # The service runs hooks as root; hives users can write keep their hooks in the writer
+    propagator, _counter = registry
+    hive_roots = reg.get_hive_roots()
+    os.chmod(hive_roots["HKEY_LOCAL_MACHINE"], 0o755)
+    os.makedirs(hive_roots["HKEY_VOLATILE_MEMORY"], mode=0o777)
+    os.chmod(hive_roots["HKEY_VOLATILE_MEMORY"], 0o777)
+    os.makedirs(hive_roots["HKEY_CURRENT_USER"], mode=0o755)
+    watched = dict(propagator.service.watched_hives())
+    assert watched.get("HKEY_LOCAL_MACHINE") == hive_roots["HKEY_LOCAL_MACHINE"]
+    assert "HKEY_VOLATILE_MEMORY" not in watched
+    assert "HKEY_CURRENT_USER" not in watched
+
+
+def test_full_hook_queue_holds_changes_back(registry):
+    # With the workers saturated, the service must keep draining inotify, not run hooks itself
+    propagator, counter = registry
+    slow = f"/bin/sh -c 'sleep 0.2; echo \"$1\" >> \"$0\"' {counter} {{}}"
+    names = [f"SYSTEM/Test/Slow{i}" for i in range(4)]
+    for name in names:
+        reg.write("root", f"{reg._ACTION_HOOKS_PATH}{name}", [slow], typedef="list")
+    propagator.index = reg.rebuild_action_hook_index(reg._ACTION_HOOK_INDEX_FILE, dispatch_roots=[propagator.hives[0][1]])
+    propagator.dispatcher = reg.HookDispatcher(workers=1, max_pending=1)
+
+    dispatch_due = propagator.service.dispatch_due
+    longest = []
+
+    def timed(*args):
+        start = time.monotonic()
+        dispatch_due(*args)
+        longest.append(time.monotonic() - start)
+
+    propagator.service.dispatch_due = timed
+    for i, name in enumerate(names):
+        reg.write("root", f"HKLM/{name}", str(i))
+    propagator.pump(2.0)
+    assert sorted(fired(counter)) == ["0", "1", "2", "3"]
+    assert max(longest) < 0.1
@@ -0,0 +1,57 @@
+"""
+VFSGC's expiry threshold: an entry is deleted only once it has been idle for longer than
+its TTL plus the grace for read times still batched in other processes.
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("AppContext")  # Provided to services by the app runner
+
+REPO = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(REPO, "src", "libraries", "system", "python"))
+
+VFSGC_MAIN = os.path.join(REPO, "src", "services", "system", "me.hysong.aqua.services.VFSGC.apprun", "main.py")
+NOW = 1_800_000_000.0
+TTL = 3600
+
+
+@pytest.fixture(scope="module")
+def gc():
+    spec = importlib.util.spec_from_file_location("vfsgc", VFSGC_MAIN)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def record(read=None, written=None, created=None, **extra):
+    return {"created_at": created, "last_written_at": written, "last_read_at": read, **extra}
+
+
+def test_threshold_includes_grace(gc):
+    limit = TTL + gc.ACCESS_GRACE
+    assert not gc.is_expired(record(written=NOW - limit), TTL, NOW)
+    assert gc.is_expired(record(written=NOW - limit - 1), TTL, NOW)
+
+
+def test_latest_of_read_write_and_creation_counts(gc):
+    old = NOW - 10 * TTL
+    assert not gc.is_expired(record(read=NOW - 1, written=old, created=old), TTL, NOW)
+    assert not gc.is_expired(record(read=None, written=None, created=NOW - 1), TTL, NOW)
+    assert gc.is_expired(record(read=old, written=None, created=old), TTL, NOW)
+
+
+def test_records_without_times_are_kept(gc):
+    # Left by older versions or a failed write: when the entry was last used is unknown
+    assert not gc.is_expired(record(), TTL, NOW)
+    assert not gc.is_expired({}, TTL, NOW)
+
+
+def test_per_entry_ttl(gc):
+    idle = NOW - 2 * TTL
+    assert not gc.is_expired(record(written=idle, ttl=0), TTL, NOW)
+    assert not gc.is_expired(record(written=idle, ttl=10 * TTL), TTL, NOW)
+    assert gc.is_expired(record(written=idle, ttl=TTL // 2), 10 * TTL, NOW)
+    assert gc.is_expired(record(written=idle, ttl="bogus"), TTL, NOW)
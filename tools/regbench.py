@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks for libreg.
+
+Builds synthetic hives in a temporary directory and times the registry operations every
+service and shell wrapper depends on. Results are printed as JSON: per operation the
+number of runs, ops/sec and p50/p99/mean latency in microseconds.
+
+    python3 tools/regbench.py --depth 3 --fanout 4 --values 8 --types str:4,dword:2,list:1,bool:1
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src", "libraries", "system", "python"))
+
+from oscore import libreg as reg  # noqa: E402
+
+
+SAMPLE_VALUES = {
+    "dword": "42",
+    "qword": "9000000000",
+    "bool": "true",
+    "str": "Hello, AquariusOS",
+    "list": "alpha,beta\\,gamma,delta",
+    "hex": "ff00",
+    "float": "1.5",
+    "double": "2.25",
+}
+
+
+def parse_type_mix(spec: str) -> Dict[str, int]:
+    """
+    "str:4,dword:2" -> {"str": 4, "dword": 2}
+    """
+    mix: Dict[str, int] = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition(":")
+        name = name.strip()
+        if name not in SAMPLE_VALUES:
+            raise argparse.ArgumentTypeError(f"Unknown value type: {name}")
+        mix[name] = int(weight or 1)
+    return mix
+
+
+def key_paths(depth: int, fanout: int, sep: str) -> List[str]:
+    """
+    Every key of a tree `depth` levels deep with `fanout` subkeys per key.
+    """
+    keys: List[str] = []
+    level = [""]
+    for d in range(depth):
+        level = [f"{parent}/Key{sep}{d}.{i}".lstrip("/") for parent in level for i in range(fanout)]
+        keys.extend(level)
+    return keys
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.temp = tempfile.mkdtemp(prefix="regbench-")
+        self.hive_map = {hive: os.path.join(self.temp, hive) for hive in reg._HIVE_MAP}
+        self.results: Dict[str, dict] = {}
+
+        # Everything libreg resolves on its own (ActionHooks, hook index) must stay in here too
+        reg._HIVE_MAP = dict(self.hive_map)
+        reg._ACTION_HOOK_INDEX_FILE = os.path.join(self.temp, "registry.actionhooks.json")
+        reg.use_daemon(False)
+        if args.cache:
+            reg.enable_cache()
+
+        types = list(args.types)
+        weights = [args.types[t] for t in types]
+        # Names with spaces need URL encoding on disk
+        self.sep = " " if args.spaces else "_"
+        self.keys = key_paths(args.depth, args.fanout, self.sep)
+        self.values: List[str] = []
+        with reg.transaction("root", hive_map=self.hive_map) as tx:
+            for key in self.keys:
+                for i in range(args.values):
+                    type_ext = self.rng.choices(types, weights)[0]
+                    path = f"{key}/Value{self.sep}{i}"
+                    tx.write(f"HKLM/{path}", SAMPLE_VALUES[type_ext], typedef=type_ext)
+                    self.values.append(path)
+                    # Shadow some values in HKCU, so implicit reads hit different hives
+                    if i % 4 == 0:
+                        tx.write(f"HKCU/{path}", SAMPLE_VALUES[type_ext], typedef=type_ext)
+
+    def close(self) -> None:
+        reg.wait_for_hooks()
+        reg.wait_for_deletes()
+        shutil.rmtree(self.temp, ignore_errors=True)
+
+    def sample(self, population: List[str]) -> List[str]:
+        return [self.rng.choice(population) for _ in range(self.args.iterations)]
+
+    def time(self, name: str, inputs: List, op: Callable, setup: Optional[Callable] = None) -> None:
+        samples: List[int] = []
+        for item in inputs:
+            if setup is not None:
+                setup(item)
+            start = time.perf_counter_ns()
+            op(item)
+            samples.append(time.perf_counter_ns() - start)
+        samples.sort()
+        total = sum(samples)
+        self.results[name] = {
+            "runs": len(samples),
+            "ops_per_sec": round(len(samples) / (total / 1e9), 1) if total else None,
+            "p50_us": round(samples[len(samples) // 2] / 1000, 1),
+            "p99_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] / 1000, 1),
+            "mean_us": round(total / len(samples) / 1000, 1),
+        }
+
+    def run(self) -> dict:
+        hm = self.hive_map
+        values = self.values
+        missing = [f"{key}/Missing{self.sep}{i}" for i, key in enumerate(self.sample(self.keys))]
+
+        self.time("read_explicit_hit", self.sample(values), lambda p: reg.read(f"HKLM/{p}", hive_map=hm))
+        self.time("read_explicit_miss", missing, lambda p: reg.read(f"HKLM/{p}", hive_map=hm))
+        self.time("read_implicit_hit", self.sample(values), lambda p: reg.read(p, hive_map=hm))
+        self.time("read_implicit_miss", missing, lambda p: reg.read(p, hive_map=hm))
+        self.time("list_explicit", self.sample(self.keys), lambda k: reg.read(f"HKLM/{k}", hive_map=hm))
+        self.time("list_implicit", self.sample(self.keys), lambda k: reg.read(k, hive_map=hm))
+
+        writes = self.sample(values)
+        self.time("write", writes, lambda p: reg.write("root", f"HKLM/{p}", "bench", hive_map=hm, typedef="str"))
+
+        # ActionHooks on some values; "true" keeps the hook itself negligible
+        hook_key = reg._ACTION_HOOKS_PATH.rstrip("/")
+        hooked = sorted(set(self.sample(values)[:100]))
+        with reg.transaction("root", hive_map=hm) as tx:
+            for path in hooked:
+                tx.write(f"{hook_key}/{path}", "true {}", typedef="list")
+        self.time("write_hooks_async", self.sample(hooked),
+                  lambda p: reg.write("root", f"HKLM/{p}", "bench", hive_map=hm, typedef="str"))
+        reg.wait_for_hooks()
+        self.time("write_hooks_wait", self.sample(hooked),
+                  lambda p: reg.write("root", f"HKLM/{p}", "bench", hive_map=hm, typedef="str", wait=True))
+        reg.delete(f"HKLM/{hook_key}", hive_map=hm)
+
+        # Subtrees of subtree_size values each, built before every timed delete
+        def build_subtree(path: str) -> None:
+            with reg.transaction("root", hive_map=hm) as tx:
+                for i in range(self.args.subtree_size):
+                    tx.write(f"{path}/Group{self.sep}{i % 16}/Value{self.sep}{i}", "x", typedef="str")
+
+        subtrees = [f"HKLM/Trash/Subtree{self.sep}{i}" for i in range(self.args.subtree_runs)]
+        self.time("delete_subtree", subtrees, lambda p: reg.delete(p, hive_map=hm), setup=build_subtree)
+        self.time("delete_subtree_background", subtrees,
+                  lambda p: reg.delete(p, hive_map=hm, background=True), setup=build_subtree)
+        reg.wait_for_deletes()
+
+        regtree = os.path.join(self.temp, "bench.regtree")
+        with open(regtree, "w", encoding="utf-8") as f:
+            for i, path in enumerate(values[:self.args.regtree_lines]):
+                f.write(f"{'?' if i % 2 else ''}HKLM/Installed/{path}:str=value {i}\n")
+        installs = list(range(self.args.regtree_runs))
+        self.time("install_regtree", installs, lambda _i: reg.install("root", regtree, hive_map=hm, quiet=True),
+                  setup=lambda _i: reg.delete("HKLM/Installed", hive_map=hm))
+        self.results["install_regtree"]["lines"] = min(len(values), self.args.regtree_lines)
+
+        return {
+            "config": {
+                "depth": self.args.depth,
+                "fanout": self.args.fanout,
+                "values_per_key": self.args.values,
+                "types": self.args.types,
+                "keys": len(self.keys),
+                "values": len(values),
+                "cache": self.args.cache,
+                "spaces": self.args.spaces,
+                "seed": self.args.seed,
+            },
+            "results": self.results,
+            "cache_stats": reg.cache_stats(),
+        }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Microbenchmarks for libreg on synthetic hives.")
+    parser.add_argument("--depth", type=int, default=3, help="Key levels below the hive root")
+    parser.add_argument("--fanout", type=int, default=4, help="Subkeys per key")
+    parser.add_argument("--values", type=int, default=8, help="Values per key")
+    parser.add_argument("--types", type=parse_type_mix, default=parse_type_mix("str:4,dword:2,list:1,bool:1"),
+                        help="Value type mix as type:weight pairs")
+    parser.add_argument("--iterations", type=int, default=2000, help="Runs per read/write benchmark")
+    parser.add_argument("--subtree-size", type=int, default=1000, help="Values per deleted subtree")
+    parser.add_argument("--subtree-runs", type=int, default=5, help="Subtrees deleted")
+    parser.add_argument("--regtree-lines", type=int, default=500, help="Lines of the installed .regtree")
+    parser.add_argument("--regtree-runs", type=int, default=5, help=".regtree installs")
+    parser.add_argument("--cache", action="store_true", help="Enable the libreg read cache")
+    parser.add_argument("--spaces", action="store_true", help="Put spaces in key and value names")
+    parser.add_argument("--seed", type=int, default=410)
+    parser.add_argument("--output", help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    try:
+        report = bench.run()
+    finally:
+        bench.close()
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())